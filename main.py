@@ -18,8 +18,23 @@ class SpectreCore(Star):
         super().__init__(context)
         self.config = config
         # 初始化各个工具类
+        IOPool.init(config)
         HistoryStorage.init(config)
         ImageCaptionUtils.init(context, config)
+        CaptionPipeline.init(config)
+        ReplyDebouncer.init(config)
+        LLMScheduler.init(config)
+        BudgetTracker.init()
+        MentionDetector.init(config)
+
+    async def terminate(self):
+        """插件卸载时写入所有未保存的历史记录喵"""
+        await CaptionPipeline.shutdown()
+        await HistoryStorage.shutdown()
+        await BudgetTracker.shutdown()
+        ImageCaptionUtils.shutdown()
+        # 等待线程池中剩余的任务时不阻塞事件循环
+        await IOPool.shutdown_async()
 
     @event_message_type(EventMessageType.GROUP_MESSAGE)
     async def on_group_message(self, event: AstrMessageEvent):
@@ -52,6 +67,18 @@ class SpectreCore(Star):
         # 保存用户消息到历史记录
         await HistoryStorage.process_and_save_user_message(event)
 
+        # 更新群的消息速率，只统计使用自适应回复方式且启用了回复的群
+        group_id = event.get_group_id()
+        if not event.is_private_chat() and group_id:
+            policy = ChatPolicy.current(self.config)
+            if policy.method == "自适应" and policy.rule(False, group_id).enabled:
+                chat_key = LLMUtils.get_chat_key(event.get_platform_name(), False, group_id)
+                ActivityTracker.record(chat_key, policy.adaptive_window)
+
+        # 提前获取机器人昵称，用于判断消息是否提到了机器人
+        if not event.is_private_chat():
+            await PromptBuilder.resolve_bot_name(event)
+
         # 尝试自动回复
         if ReplyDecision.should_reply(event, self.config):
             async for result in ReplyDecision.process_and_reply(event, self.config, self.context):
@@ -82,6 +109,13 @@ class SpectreCore(Star):
         try:
             if resp.role != "assistant":
                 return
+            # 按聊天累计插件自己发起的请求的token用量，AstrBot默认对话等其他请求不计入
+            is_private = event.is_private_chat()
+            chat_id = event.get_sender_id() if is_private else event.get_group_id()
+            if chat_id and LLMUtils.is_own_request(event):
+                prompt_tokens, completion_tokens = BudgetTracker.extract_usage(resp)
+                chat_key = LLMUtils.get_chat_key(event.get_platform_name(), is_private, chat_id)
+                BudgetTracker.record(chat_key, prompt_tokens, completion_tokens)
             # 只进行文本过滤，不处理读空气逻辑
             resp.completion_text = TextFilter.process_model_text(resp.completion_text, self.config)
         except Exception as e:
@@ -127,7 +161,10 @@ class SpectreCore(Star):
             "   你也可以重置指定群聊天记录 如/sc reset 群号\n"
             "使用history指令可以查看最近聊天记录 如/sc history\n"
             "使用mute/闭嘴指令临时禁用自动回复 如/sc mute 5 或 /sc 闭嘴 10\n"
-            "使用unmute/说话指令解除禁用 如/sc unmute 或 /sc 说话"
+            "使用unmute/说话指令解除禁用 如/sc unmute 或 /sc 说话\n"
+            "使用migrate指令将历史记录文件导入当前存储引擎 如/sc migrate\n"
+            "使用stats指令查看大模型调用队列和图片描述缓存的统计 如/sc stats\n"
+            "使用budget指令查看今天的token用量 如/sc budget"
         )
         platform_name = event.get_platform_name()
         if platform_name in ("qq_official", "qq_official_webhook"):
@@ -153,19 +190,17 @@ class SpectreCore(Star):
                 yield event.plain_result("获取聊天ID失败喵，无法显示历史记录")
                 return
                 
-            # 获取历史记录
-            history = HistoryStorage.get_history(platform_name, is_private, chat_id)
-            
-            if not history:
-                yield event.plain_result("暂无聊天记录喵")
-                return
-                
             # 限制记录数量
             if count > 20:
                 count = 20  # 限制最大显示数量为20条
+            count = max(count, 1)
+            
+            # 只读取最近的记录
+            recent_history = await HistoryStorage.get_recent(platform_name, is_private, chat_id, count)
             
-            # 只取最近的记录
-            recent_history = history[-count:] if len(history) > count else history
+            if not recent_history:
+                yield event.plain_result("暂无聊天记录喵")
+                return
             
             # 格式化历史记录
             formatted_history = await MessageUtils.format_history_for_llm(recent_history, umo=event.unified_msg_origin)
@@ -213,15 +248,16 @@ class SpectreCore(Star):
                     return
             
             # 先检查是否存在历史记录
-            history = HistoryStorage.get_history(platform_name, is_private, chat_id)
+            history = await HistoryStorage.get_recent(platform_name, is_private, chat_id, 1)
             if not history:
                 yield event.plain_result(f"{chat_type}没有历史记录喵，无需重置")
                 return
                 
             # 重置历史记录
-            success = HistoryStorage.clear_history(platform_name, is_private, chat_id)
+            success = await HistoryStorage.clear_history(platform_name, is_private, chat_id)
             
             if success:
+                PromptBuilder.clear_chat(LLMUtils.get_chat_key(platform_name, is_private, chat_id))
                 yield event.plain_result(f"已成功重置{chat_type}的历史记录喵~")
             else:
                 yield event.plain_result(f"重置{chat_type}的历史记录失败喵，可能发生错误")
@@ -230,6 +266,82 @@ class SpectreCore(Star):
             logger.error(f"重置历史记录时发生错误: {e}")
             yield event.plain_result(f"重置历史记录失败喵：{str(e)}")
 
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @spectrecore.command("migrate")
+    async def migrate(self, event: AstrMessageEvent):
+        """将历史记录文件导入当前存储引擎喵，切换存储引擎后使用"""
+        try:
+            yield event.plain_result("开始迁移历史记录喵，请稍候~")
+            chat_count, record_count = await HistoryStorage.migrate_history_files()
+            if chat_count == 0:
+                yield event.plain_result("没有需要迁移的历史记录喵")
+            else:
+                yield event.plain_result(f"迁移完成喵，共导入 {chat_count} 个聊天的 {record_count} 条记录~")
+        except Exception as e:
+            logger.error(f"迁移历史记录时发生错误: {e}")
+            yield event.plain_result(f"迁移历史记录失败喵：{str(e)}")
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @spectrecore.command("stats")
+    async def stats(self, event: AstrMessageEvent):
+        """查看大模型调用队列和图片描述缓存的统计喵"""
+        try:
+            scheduler_stats = LLMScheduler.stats()
+            caption_stats = ImageCaptionUtils.cache_stats()
+            max_concurrency = scheduler_stats["max_concurrency"] or "不限"
+            stats_text = (
+                "SpectreCore运行统计喵：\n"
+                f"大模型调用：进行中 {scheduler_stats['running']}/{max_concurrency}，"
+                f"排队 {scheduler_stats['queue_priority']}(优先) + {scheduler_stats['queue_normal']}(普通)，"
+                f"涉及 {scheduler_stats['queued_chats']} 个聊天\n"
+                f"累计放行 {scheduler_stats['granted']} 次，排队 {scheduler_stats['queued']} 次，"
+                f"超时放弃 {scheduler_stats['expired']} 次，最长队列 {scheduler_stats['peak_queue']}\n"
+                f"平均等待 {scheduler_stats['avg_wait']} 秒，最长等待 {scheduler_stats['max_wait']} 秒\n"
+                f"图片描述缓存：内存命中 {caption_stats['memory_hits']} 次，数据库命中 {caption_stats['disk_hits']} 次，"
+                f"未命中 {caption_stats['misses']} 次，内存 {caption_stats['memory_entries']} 条，数据库 {caption_stats['disk_entries']} 条"
+            )
+            yield event.plain_result(stats_text)
+        except Exception as e:
+            logger.error(f"获取运行统计时发生错误: {e}")
+            yield event.plain_result(f"获取运行统计失败喵：{str(e)}")
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @spectrecore.command("budget")
+    async def budget(self, event: AstrMessageEvent):
+        """查看今天的token用量喵"""
+        try:
+            day_usage = BudgetTracker.get_day_usage()
+            prompt_total = sum(usage[0] for usage in day_usage.values())
+            completion_total = sum(usage[1] for usage in day_usage.values())
+            calls_total = sum(usage[2] for usage in day_usage.values())
+            budget_text = (
+                "今天的token用量喵：\n"
+                f"全部聊天：调用 {calls_total} 次，输入 {prompt_total}，输出 {completion_total}"
+            )
+
+            # 当前聊天的用量和预算
+            is_private = event.is_private_chat()
+            chat_id = event.get_sender_id() if is_private else event.get_group_id()
+            if chat_id:
+                chat_key = LLMUtils.get_chat_key(event.get_platform_name(), is_private, chat_id)
+                prompt_tokens, completion_tokens, calls = BudgetTracker.get_usage(chat_key)
+                rule = ChatPolicy.current(self.config).rule(is_private, chat_id)
+                chat_type = "私聊" if is_private else f"群聊({chat_id})"
+                budget_text += f"\n当前{chat_type}：调用 {calls} 次，输入 {prompt_tokens}，输出 {completion_tokens}"
+                if rule.daily_tokens:
+                    budget_text += f"，预算 {prompt_tokens + completion_tokens}/{rule.daily_tokens}"
+
+            # 用量最多的几个聊天
+            top_chats = sorted(day_usage.items(), key=lambda item: item[1][0] + item[1][1], reverse=True)[:5]
+            if top_chats:
+                budget_text += "\n用量最多的聊天："
+                for chat_key, (prompt_tokens, completion_tokens, calls) in top_chats:
+                    budget_text += f"\n  {chat_key}：{prompt_tokens + completion_tokens}（{calls} 次）"
+            yield event.plain_result(budget_text)
+        except Exception as e:
+            logger.error(f"获取token用量时发生错误: {e}")
+            yield event.plain_result(f"获取token用量失败喵：{str(e)}")
+
     @filter.permission_type(filter.PermissionType.ADMIN)
     @spectrecore.command("mute", alias=['闭嘴', 'shutup'])
     async def mute(self, event: AstrMessageEvent, minutes: int = 5):
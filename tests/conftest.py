@@ -0,0 +1,15 @@
+"""
+测试配置
+
+测试依赖 AstrBot，未安装时跳过全部测试
+"""
+import os
+import sys
+
+try:
+    import astrbot.api.all  # noqa: F401
+except ImportError:
+    collect_ignore_glob = ["test_*.py"]
+
+# 以仓库根目录为导入路径，测试中直接 import utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,34 @@
+from utils.activity_tracker import ActivityTracker
+
+WINDOW = 1800
+
+
+def setup_function():
+    ActivityTracker._counters = {}
+
+
+def test_rate_converges_to_steady_rate():
+    now = 0.0
+    for _ in range(1800):
+        now += 6
+        ActivityTracker.record("busy", WINDOW, now)
+    assert abs(ActivityTracker.rate_per_hour("busy", WINDOW, now) - 600) < 10
+
+
+def test_warmup_uses_base_probability():
+    now = 1000.0
+    for _ in range(ActivityTracker.WARMUP_MESSAGES - 1):
+        now += 0.5
+        ActivityTracker.record("g", WINDOW, now)
+    assert not ActivityTracker.is_warm("g", WINDOW, now)
+    ActivityTracker.record("g", WINDOW, now + 0.5)
+    assert ActivityTracker.is_warm("g", WINDOW, now + 0.5)
+    # 刚开始统计时按实际统计时间修正，不会把每秒两条的群当作冷清的群
+    assert ActivityTracker.rate_per_hour("g", WINDOW, now + 0.5) > 5000
+
+
+def test_quiet_group_warms_up_after_window():
+    ActivityTracker.record("quiet", WINDOW, 0.0)
+    assert not ActivityTracker.is_warm("quiet", WINDOW, WINDOW - 1)
+    assert ActivityTracker.is_warm("quiet", WINDOW, WINDOW)
+    assert ActivityTracker.probability("unknown", 0.3, 6, WINDOW, 0.01, 1.0) == 0.3
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+import pytest
+
+from utils.caption_store import CaptionStore
+from utils.io_pool import IOPool
+
+
+@pytest.fixture
+def store(tmp_path):
+    IOPool.init({})
+    CaptionStore.init(str(tmp_path / "captions.db"), memory_entries=8, max_entries=100, ttl_days=1)
+    yield
+    CaptionStore.close()
+    IOPool.shutdown()
+
+
+def test_memory_and_disk_hits(store):
+    key = CaptionStore.make_key("hash", "prompt", "provider")
+    asyncio.run(CaptionStore.put(key, "一只猫"))
+    assert asyncio.run(CaptionStore.get(key)) == "一只猫"
+    CaptionStore._memory.clear()
+    assert asyncio.run(CaptionStore.get(key)) == "一只猫"
+    assert asyncio.run(CaptionStore.get("missing")) is None
+    stats = CaptionStore.stats()
+    assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_expired_memory_entry_is_not_returned(store, monkeypatch):
+    key = CaptionStore.make_key("hash", "prompt", "provider")
+    asyncio.run(CaptionStore.put(key, "一只猫"))
+    later = time.time() + 2 * 86400
+    monkeypatch.setattr(time, "time", lambda: later)
+    assert asyncio.run(CaptionStore.get(key)) is None
+    assert key not in CaptionStore._memory
+    stats = CaptionStore.stats()
+    assert (stats["memory_hits"], stats["misses"], stats["disk_entries"]) == (0, 1, 0)
+
+
+def test_disk_hit_keeps_original_creation_time(store, monkeypatch):
+    key = CaptionStore.make_key("hash", "prompt", "provider")
+    asyncio.run(CaptionStore.put(key, "一只猫"))
+    CaptionStore._memory.clear()
+    now = time.time()
+    # 半天后从数据库读入进程内缓存，再过一天应按原创建时间过期
+    monkeypatch.setattr(time, "time", lambda: now + 43200)
+    assert asyncio.run(CaptionStore.get(key)) == "一只猫"
+    monkeypatch.setattr(time, "time", lambda: now + 86400 + 60)
+    assert asyncio.run(CaptionStore.get(key)) is None
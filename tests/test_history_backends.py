@@ -0,0 +1,30 @@
+from utils.history_backends import SegmentLogBackend
+
+
+def _write(path, lines, trailing_newline=True):
+    data = "\n".join(lines) + ("\n" if trailing_newline else "")
+    path.write_bytes(data.encode("utf-8"))
+
+
+def test_read_tail_across_blocks(tmp_path, monkeypatch):
+    # 块很小时记录和多字节字符都会跨块
+    monkeypatch.setattr(SegmentLogBackend, "TAIL_BLOCK_SIZE", 7)
+    lines = [f"记录{i}-" + "字" * (i % 5) for i in range(50)]
+    path = tmp_path / "chat.jsonl"
+    _write(path, lines)
+    for limit in (1, 3, 17, 50, 80):
+        assert SegmentLogBackend._read_tail(str(path), limit) == lines[-limit:]
+
+
+def test_read_tail_skips_blank_lines_and_handles_missing_newline(tmp_path, monkeypatch):
+    monkeypatch.setattr(SegmentLogBackend, "TAIL_BLOCK_SIZE", 5)
+    path = tmp_path / "chat.jsonl"
+    _write(path, ["first", "", "second\r", "  ", "third"], trailing_newline=False)
+    assert SegmentLogBackend._read_tail(str(path), 10) == ["first", "second", "third"]
+    assert SegmentLogBackend._read_tail(str(path), 2) == ["second", "third"]
+
+
+def test_read_tail_empty_file(tmp_path):
+    path = tmp_path / "chat.jsonl"
+    path.write_bytes(b"")
+    assert SegmentLogBackend._read_tail(str(path), 5) == []
@@ -0,0 +1,34 @@
+from utils.history_cache import HistoryCache
+
+
+def _chat(chat_id):
+    return ("qq", False, chat_id)
+
+
+def test_load_never_evicts_the_loaded_chat():
+    cache = HistoryCache(retention=10, max_messages=5, max_bytes=10 ** 6)
+    cache.load("a", _chat("a"), [(i, 1) for i in range(3)])
+    # 刚载入的聊天单独就超出预算，淘汰的是更早使用的聊天
+    cache.load("b", _chat("b"), [(i, 1) for i in range(8)])
+    assert "b" in cache and "a" not in cache
+    assert cache.append("b", 8, "record", 1)
+    assert cache.get("b")[-1] == 8
+
+
+def test_append_keeps_recent_and_pending_chats():
+    cache = HistoryCache(retention=10, max_messages=4, max_bytes=10 ** 6)
+    cache.load("a", _chat("a"), [(0, 1), (1, 1)])
+    assert cache.append("a", 2, "record", 1)
+    cache.load("b", _chat("b"), [(0, 1), (1, 1)])
+    # a有待写入记录，不会被淘汰
+    assert "a" in cache and "b" in cache
+    cache.take_pending("a")
+    cache.load("c", _chat("c"), [(0, 1), (1, 1)])
+    assert "a" not in cache and "c" in cache
+    assert cache.stats()["messages"] == 4
+
+
+def test_append_to_missing_chat():
+    cache = HistoryCache(retention=10, max_messages=4, max_bytes=10 ** 6)
+    assert not cache.append("a", 0, "record", 1)
+    assert cache.dirty_keys() == []
@@ -0,0 +1,114 @@
+import asyncio
+import os
+
+import jsonpickle
+import pytest
+
+from astrbot.api.all import AstrBotMessage, Image, MessageMember, Plain
+from utils.history_storage import HistoryStorage
+from utils.image_store import ImageStore
+from utils.io_pool import IOPool
+
+
+def _message(i, group_id, image_path):
+    message = AstrBotMessage()
+    message.group_id = group_id
+    message.sender = MessageMember("u1", "nick")
+    message.message = [Plain(text=f"hi {i}"), Image(file="file:///" + image_path)]
+    message.message_id = str(i)
+    message.timestamp = i
+    return message
+
+
+def _refcounts():
+    return dict(ImageStore._conn.execute("SELECT sha256, refcount FROM images").fetchall())
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    images_dir = tmp_path / "data" / "chat_history" / "images"
+    images_dir.mkdir(parents=True)
+    for name in ("old1.jpg", "old2.jpg", "old3.jpg"):
+        (images_dir / name).write_text(name)
+    # 存储只通过 get 读取配置，用普通字典代替 AstrBotConfig
+    config = {"storage": {"flush_interval": 0}}
+    IOPool.init(config)
+    HistoryStorage.init(config)
+    yield images_dir
+    asyncio.run(HistoryStorage.shutdown())
+    IOPool.shutdown()
+
+
+def test_backfill_counts_legacy_files_and_concurrent_saves(storage):
+    old1, old2, old3 = (str(storage / name) for name in ("old1.jpg", "old2.jpg", "old3.jpg"))
+
+    async def main():
+        await HistoryStorage.save_message(_message(1, "a", old1), "qq")
+        # 停止保存消息时启动的后台维护，由测试控制登记的时机
+        HistoryStorage._maintenance_task.cancel()
+        # 旧版整文件存储中的引用
+        legacy_dir = os.path.join("data", "chat_history", "qq", "group")
+        with open(os.path.join(legacy_dir, "b.json"), "w", encoding="utf-8") as f:
+            f.write(jsonpickle.encode([_message(2, "b", old2)]))
+
+        # 聊天a统计完之后、登记之前保存的引用不能丢
+        original = HistoryStorage._count_chat_image_references
+
+        def count_then_save(*args):
+            paths = original(*args)
+            if args[2] == "b":
+                future = asyncio.run_coroutine_threadsafe(
+                    HistoryStorage.save_message(_message(3, "a", old3), "qq"), loop
+                )
+                saved.append(future)
+            return paths
+
+        loop = asyncio.get_running_loop()
+        saved = []
+        HistoryStorage._count_chat_image_references = staticmethod(count_then_save)
+        try:
+            sources = await IOPool.run(HistoryStorage._list_reference_sources)
+            # 保证先统计a再统计b
+            assert [chat[2] for chat in sources] == ["a", "b"]
+            assert await HistoryStorage.collect_images() == 0
+            assert await HistoryStorage.backfill_image_index()
+        finally:
+            HistoryStorage._count_chat_image_references = original
+        for future in saved:
+            assert await asyncio.wrap_future(future)
+
+    asyncio.run(main())
+    counts = _refcounts()
+    # 登记期间重新启动的后台维护不会重复登记
+    assert counts["legacy/old1.jpg"] == 1
+    assert counts["legacy/old2.jpg"] == 1
+    assert counts["legacy/old3.jpg"] == 1
+
+
+def test_release_clamps_at_zero(storage):
+    asyncio.run(HistoryStorage.backfill_image_index())
+    old1 = str(storage / "old1.jpg")
+    ImageStore.release([old1, old1])
+    assert _refcounts()["legacy/old1.jpg"] == 0
+    assert ImageStore.acquire(old1)
+    assert _refcounts()["legacy/old1.jpg"] == 1
+
+
+def test_failed_save_releases_image_refs(storage, tmp_path, monkeypatch):
+    asyncio.run(HistoryStorage.backfill_image_index())
+    old1 = str(storage / "old1.jpg")
+    new_image = tmp_path / "new.png"
+    new_image.write_bytes(b"new image")
+
+    def fail(message):
+        raise ValueError("encode failed")
+
+    monkeypatch.setattr(HistoryStorage, "_encode_record", staticmethod(fail))
+    message = _message(1, "a", old1)
+    message.message.append(Image(file=str(new_image)))
+    assert not asyncio.run(HistoryStorage.save_message(message, "qq"))
+    # 已在存储中的图片和新存入的图片的引用都已释放
+    counts = _refcounts()
+    assert counts["legacy/old1.jpg"] == 0
+    assert [count for key, count in counts.items() if not key.startswith("legacy/")] == [0]
@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+from utils.io_pool import IOPool
+
+
+def test_reinit_does_not_wait_for_running_tasks():
+    async def main():
+        IOPool.init({})
+        slow = asyncio.ensure_future(IOPool.run(time.sleep, 0.5))
+        await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        IOPool.init({"storage": {"io_workers": 2}})
+        elapsed = time.perf_counter() - start
+        # 旧线程池中的任务照常完成，新任务交给新线程池
+        assert await IOPool.run(sum, [1, 2]) == 3
+        await slow
+        return elapsed
+
+    assert asyncio.run(main()) < 0.2
+    assert IOPool.max_workers == 2
+    IOPool.shutdown()
+
+
+def test_shutdown_async_keeps_the_loop_running():
+    async def main():
+        IOPool.init({})
+        slow = asyncio.ensure_future(IOPool.run(time.sleep, 0.3))
+        await asyncio.sleep(0.05)
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.02)
+                ticks += 1
+
+        task = asyncio.ensure_future(ticker())
+        await IOPool.shutdown_async()
+        task.cancel()
+        await slow
+        return ticks
+
+    assert asyncio.run(main()) >= 5
+    assert IOPool._executor is None
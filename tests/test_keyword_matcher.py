@@ -0,0 +1,56 @@
+import random
+
+from utils.keyword_matcher import KeywordMatcher
+
+
+def _expected(keywords, blacklist, text):
+    found = 0
+    if any(keyword in text for keyword in keywords):
+        found |= KeywordMatcher.TRIGGER
+    if any(keyword in text for keyword in blacklist):
+        found |= KeywordMatcher.BLACKLIST
+    return found
+
+
+def test_matches_brute_force():
+    rng = random.Random(1)
+
+    def word():
+        return "".join(rng.choice("abc") for _ in range(rng.randint(1, 4)))
+
+    for _ in range(500):
+        keywords = [word() for _ in range(rng.randint(1, 6))]
+        blacklist = [word() for _ in range(rng.randint(0, 4))]
+        text = "".join(rng.choice("abcd") for _ in range(rng.randint(0, 20)))
+        assert KeywordMatcher(keywords, blacklist).scan(text) == _expected(keywords, blacklist, text), (keywords, blacklist, text)
+
+
+def test_overlapping_keywords():
+    matcher = KeywordMatcher(["he", "she"], ["hers"])
+    assert matcher.scan("ushers") == KeywordMatcher.TRIGGER | KeywordMatcher.BLACKLIST
+    assert matcher.scan("xhe") == KeywordMatcher.TRIGGER
+    assert matcher.scan("hi") == 0
+
+
+def test_regex_entries():
+    matcher = KeywordMatcher(["re:^在吗$"], ["re:\\d{11}"])
+    assert matcher.scan("在吗") == KeywordMatcher.TRIGGER
+    assert matcher.scan("你在吗") == 0
+    assert matcher.scan("电话13800000000") == KeywordMatcher.BLACKLIST
+    # 无效的正则被忽略
+    assert KeywordMatcher(["re:("]).size == 0
+
+
+def test_normalize():
+    matcher = KeywordMatcher(["Bot"], ["ＡＢＣ"], normalize=True)
+    assert matcher.scan("hey BOT") == KeywordMatcher.TRIGGER
+    assert matcher.scan("ＢＯＴ") == KeywordMatcher.TRIGGER
+    assert matcher.scan("abc") == KeywordMatcher.BLACKLIST
+    assert KeywordMatcher(["Bot"]).scan("bot") == 0
+
+
+def test_empty_matcher():
+    matcher = KeywordMatcher()
+    assert not matcher
+    assert matcher.scan("anything") == 0
+    assert matcher.scan(None) == 0
@@ -0,0 +1,113 @@
+import asyncio
+
+from utils.llm_scheduler import LLMScheduler
+from utils.llm_utils import LLMUtils
+from utils.reply_decision import ReplyDecision
+from utils.reply_debouncer import ReplyDebouncer
+
+
+async def _call(order, chat_key, lane=LLMScheduler.LANE_NORMAL, hold=0.05, delay=0.0):
+    await asyncio.sleep(delay)
+    if not await LLMScheduler.acquire(chat_key, lane):
+        order.append((chat_key, "expired"))
+        return
+    order.append(chat_key)
+    try:
+        await asyncio.sleep(hold)
+    finally:
+        LLMScheduler.release()
+
+
+def test_round_robin_and_priority_lane():
+    LLMScheduler.init({"llm_scheduler": {"max_concurrency": 2, "max_queue_age": 5}})
+    order = []
+
+    async def main():
+        await asyncio.gather(
+            *[_call(order, "A", hold=0.1) for _ in range(6)],
+            _call(order, "B", delay=0.01),
+            _call(order, "B", delay=0.01),
+            _call(order, "P", LLMScheduler.LANE_PRIORITY, delay=0.02),
+        )
+
+    asyncio.run(main())
+    # 前两个名额被A占用，之后优先通道的P最先放行，A和B轮流放行
+    assert order[:3] == ["A", "A", "P"]
+    assert order[3:7] in (["A", "B", "A", "B"], ["B", "A", "B", "A"])
+    stats = LLMScheduler.stats()
+    assert stats["running"] == 0 and stats["queue_normal"] == 0 and stats["granted"] == 9
+
+
+def test_stale_triggers_expire():
+    LLMScheduler.init({"llm_scheduler": {"max_concurrency": 1, "max_queue_age": 0.05}})
+    order = []
+
+    async def main():
+        await asyncio.gather(_call(order, "X", hold=0.2), _call(order, "Y", delay=0.01))
+
+    asyncio.run(main())
+    assert order == ["X", ("Y", "expired")]
+    assert LLMScheduler.stats()["expired"] == 1
+    assert LLMScheduler.queue_depth() == 0
+
+
+class _Event:
+    def get_platform_name(self):
+        return "test"
+
+    def is_private_chat(self):
+        return False
+
+    def get_sender_id(self):
+        return "u"
+
+    def get_group_id(self):
+        return "burst"
+
+    def get_self_id(self):
+        return "bot"
+
+    def get_message_outline(self):
+        return "hello"
+
+    message_obj = None
+
+
+def test_one_call_per_chat_while_queued(monkeypatch):
+    """名额用完时同一聊天的一串触发只排队一次，不会在名额空出后并发调用"""
+    config = {
+        "enabled_groups": ["burst"],
+        "model_frequency": {"probability": {"probability": 1.0}},
+        "llm_scheduler": {"max_concurrency": 1, "max_queue_age": 5},
+    }
+    LLMScheduler.init(config)
+    ReplyDebouncer.init(config)
+    running = {"now": 0, "peak": 0, "calls": 0}
+
+    async def fake_call_llm(event, config, context, directed=False):
+        return "request"
+
+    monkeypatch.setattr(LLMUtils, "call_llm", staticmethod(fake_call_llm))
+
+    async def handle():
+        # 模拟插件的消息处理：回复决策通过后，请求在流水线中执行完才恢复生成器
+        if not ReplyDecision.should_reply(_Event(), config):
+            return
+        async for _ in ReplyDecision.process_and_reply(_Event(), config, None):
+            running["calls"] += 1
+            running["now"] += 1
+            running["peak"] = max(running["peak"], running["now"])
+            await asyncio.sleep(0.05)
+            running["now"] -= 1
+
+    async def main():
+        # 另一个聊天先占住唯一的名额
+        blocker = asyncio.ensure_future(_call([], "other", hold=0.1))
+        await asyncio.sleep(0)
+        await asyncio.gather(*[handle() for _ in range(5)])
+        await blocker
+
+    asyncio.run(main())
+    assert running["calls"] == 1
+    assert running["peak"] == 1
+    assert not LLMUtils.is_llm_in_progress("test", False, "burst")
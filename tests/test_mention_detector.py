@@ -0,0 +1,72 @@
+import asyncio
+
+from astrbot.api.all import At, Plain, Reply
+from utils.mention_detector import MentionDetector
+from utils.prompt_builder import PromptBuilder
+
+
+class _Message:
+    def __init__(self, chain):
+        self.message = chain
+
+
+class _Api:
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.calls = 0
+
+    async def get_login_info(self):
+        self.calls += 1
+        return {"nickname": self.nickname}
+
+
+class _Bot:
+    def __init__(self, nickname):
+        self.api = _Api(nickname)
+
+
+class _Event:
+    def __init__(self, chain, platform="test", is_at_or_wake_command=False, bot=None):
+        self.message_obj = _Message(chain)
+        self.platform = platform
+        self.is_at_or_wake_command = is_at_or_wake_command
+        if bot is not None:
+            self.bot = bot
+
+    def get_platform_name(self):
+        return self.platform
+
+    def get_self_id(self):
+        return "10000"
+
+
+def setup_function():
+    PromptBuilder._names = {}
+    MentionDetector.init({})
+
+
+def test_structural_mentions():
+    assert MentionDetector.detect(_Event([At(qq="10000"), Plain("在吗")])) == MentionDetector.REASON_AT
+    assert MentionDetector.detect(_Event([Reply(id="1", sender_id=10000), Plain("对")])) == MentionDetector.REASON_REPLY
+    assert MentionDetector.detect(_Event([At(qq="20000"), Plain("在吗")])) is None
+
+
+def test_wake_command_is_not_directed():
+    # 唤醒词指令由AstrBot标记，但不是对机器人说话
+    assert not MentionDetector.is_directed(_Event([Plain("/sc help")], is_at_or_wake_command=True))
+
+
+def test_configured_nickname():
+    MentionDetector.init({"bot_nicknames": ["小灵", "x", " 灵灵 "]})
+    assert MentionDetector.nicknames == ("小灵", "灵灵")
+    assert MentionDetector.detect(_Event([Plain("灵灵你怎么看")])) == MentionDetector.REASON_NAME
+    assert MentionDetector.detect(_Event([Plain("x是什么")])) is None
+
+
+def test_resolved_nickname():
+    bot = _Bot("阿灵")
+    event = _Event([Plain("阿灵早")], platform="aiocqhttp", bot=bot)
+    assert asyncio.run(PromptBuilder.resolve_bot_name(event)) == "阿灵"
+    assert asyncio.run(PromptBuilder.resolve_bot_name(event)) == "阿灵"
+    assert bot.api.calls == 1
+    assert MentionDetector.detect(event) == MentionDetector.REASON_NAME
@@ -0,0 +1,70 @@
+import random
+
+from astrbot.api.all import AstrBotMessage, MessageMember, Plain
+
+from utils.prompt_builder import PromptBuilder
+
+
+def make_message(index: int) -> AstrBotMessage:
+    message = AstrBotMessage()
+    message.sender = MessageMember("u", "n")
+    message.message = [Plain(text=f"m{index}")]
+    message.timestamp = 1700000000 + index
+    message.message_id = str(index)
+    message.group_id = "g"
+    return message
+
+
+def test_window_start_moves_in_chunks():
+    limit, chunk = 10, 4
+    history = [make_message(i) for i in range(30)]
+    PromptBuilder.clear_chat("chunks")
+    random.seed(0)
+    previous_start = None
+    for _ in range(200):
+        # 两次调用之间新增的消息不超过 limit 条
+        history.extend(make_message(len(history)) for _ in range(random.randint(1, limit)))
+        fetched = history[-PromptBuilder.fetch_count(limit, chunk):]
+        window = PromptBuilder.select_window("chunks", fetched, limit, chunk)
+        start = int(window[0].message_id)
+        assert window[-1] is history[-1]
+        assert limit - chunk + 1 <= len(window) <= limit
+        if previous_start is not None:
+            assert (start - previous_start) % chunk == 0
+        previous_start = start
+
+
+def test_window_prefix_is_stable_between_drops():
+    limit, chunk = 10, 5
+    history = [make_message(i) for i in range(20)]
+    PromptBuilder.clear_chat("stable")
+    starts = []
+    for _ in range(10):
+        history.append(make_message(len(history)))
+        fetched = history[-PromptBuilder.fetch_count(limit, chunk):]
+        starts.append(PromptBuilder.select_window("stable", fetched, limit, chunk)[0].message_id)
+    # 第一次窗口已满，下一条消息到来时丢弃一整块，之后每5条新消息起点才移动一次
+    assert starts[0] == "11"
+    assert starts[1:6] == ["16"] * 5
+    assert starts[6:] == ["21"] * 4
+
+
+def test_window_token_budget_drops_whole_chunks():
+    limit, chunk = 10, 2
+    history = [make_message(i) for i in range(20)]
+    for message in history:
+        message.token_estimate = 10
+    PromptBuilder.clear_chat("budget")
+    window = PromptBuilder.select_window(
+        "budget", history[-PromptBuilder.fetch_count(limit, chunk):], limit, chunk, token_budget=55
+    )
+    assert sum(m.token_estimate for m in window) <= 55
+    assert len(window) == 4
+
+
+def test_join_history_appends_only_new_texts():
+    PromptBuilder.clear_chat("join")
+    first = PromptBuilder.join_history("join", ["a", "b"])
+    second = PromptBuilder.join_history("join", ["a", "b", "c"])
+    assert second.startswith(first)
+    assert PromptBuilder.join_history("join", ["b", "c"]).startswith("b")
@@ -0,0 +1,76 @@
+import jsonpickle
+import pytest
+
+from astrbot.api.all import AstrBotMessage, At, Face, Image, MessageMember, MessageType, Plain, Reply
+from utils.record_codec import RecordCodec
+
+
+def _message():
+    message = AstrBotMessage()
+    message.message_id = "42"
+    message.timestamp = 1700000000
+    message.type = MessageType.GROUP_MESSAGE
+    message.group_id = "123"
+    message.self_id = "10000"
+    message.session_id = "123"
+    message.sender = MessageMember("u1", "昵称")
+    message.message_str = "你好 [图片]"
+    message.message = [
+        Reply(id="7", sender_id="u2", sender_nickname="别人", time=1, message_str="原消息", chain=[Plain("原消息")]),
+        At(qq="10000", name="机器人"),
+        Plain("你好"),
+        Face(id="14"),
+        Image(file="file:///data/images/a.jpg", url="http://example.com/a.jpg"),
+    ]
+    message.token_estimate = 12
+    return message
+
+
+def _assert_same(decoded, original):
+    assert decoded.message_id == original.message_id
+    assert decoded.timestamp == original.timestamp
+    assert decoded.type == original.type
+    assert decoded.group_id == original.group_id
+    assert decoded.self_id == original.self_id
+    assert decoded.session_id == original.session_id
+    assert (decoded.sender.user_id, decoded.sender.nickname) == ("u1", "昵称")
+    assert decoded.message_str == original.message_str
+    assert decoded.token_estimate == original.token_estimate
+    assert RecordCodec.to_record(decoded) == RecordCodec.to_record(original)
+
+
+def test_json_round_trip():
+    original = _message()
+    data = RecordCodec.dumps(original)
+    assert isinstance(data, str) and RecordCodec.is_current(data)
+    decoded = RecordCodec.loads(data)
+    _assert_same(decoded, original)
+    assert [type(c) for c in decoded.message] == [Reply, At, Plain, Face, Image]
+    assert decoded.message[0].chain[0].text == "原消息"
+    assert decoded.message[4].file == "file:///data/images/a.jpg"
+
+
+def test_msgpack_round_trip():
+    if not RecordCodec.msgpack_available():
+        pytest.skip("未安装msgpack")
+    original = _message()
+    data = RecordCodec.dumps(original, use_msgpack=True)
+    assert isinstance(data, bytes)
+    _assert_same(RecordCodec.loads(data), original)
+
+
+def test_private_message_without_optional_fields():
+    message = AstrBotMessage()
+    message.sender = MessageMember("u1")
+    message.message = [Plain("hi")]
+    decoded = RecordCodec.loads(RecordCodec.dumps(message))
+    assert decoded.type == MessageType.FRIEND_MESSAGE
+    assert decoded.token_estimate is None
+    assert decoded.message[0].text == "hi"
+
+
+def test_legacy_jsonpickle_record():
+    data = jsonpickle.encode(_message())
+    assert not RecordCodec.is_current(data)
+    decoded = RecordCodec.loads(data)
+    assert decoded.message_id == "42" and decoded.message[2].text == "你好"
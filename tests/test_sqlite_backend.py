@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+
+import jsonpickle
+import pytest
+
+from astrbot.api.all import AstrBotMessage, MessageMember, Plain
+from utils.history_backends import HistoryRecord, RetentionPolicy, SqliteBackend
+from utils.history_storage import HistoryStorage
+from utils.io_pool import IOPool
+from utils.record_codec import RecordCodec
+
+
+def _message(message_id, timestamp, group_id="g"):
+    message = AstrBotMessage()
+    message.group_id = group_id
+    message.sender = MessageMember("u1", "nick")
+    message.message = [Plain(text=f"msg {message_id}")]
+    message.message_str = f"msg {message_id}"
+    message.message_id = str(message_id)
+    message.timestamp = timestamp
+    return message
+
+
+def _record(message_id, timestamp, size=10):
+    data = json.dumps({"v": 1, "id": str(message_id), "pad": "x" * size})
+    return HistoryRecord(timestamp, str(message_id), data)
+
+
+def _ids(records):
+    return [json.loads(record)["id"] if isinstance(record, str) else RecordCodec.loads(record).message_id for record in records]
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SqliteBackend(str(tmp_path / "history.db"))
+    yield backend
+    backend.close()
+
+
+def test_load_orders_by_timestamp(backend):
+    backend.append("qq", False, "g", [_record(1, 100), _record(2, 300), _record(3, 300)])
+    backend.append("qq", False, "g", [_record(4, 200)])
+    backend.append("qq", True, "g", [_record(5, 50)])
+    # 时间戳相同的按写入顺序
+    assert _ids(backend.load("qq", False, "g")) == ["1", "4", "2", "3"]
+    assert _ids(backend.load("qq", False, "g", limit=2)) == ["2", "3"]
+    assert sorted(backend.list_chats()) == [("qq", False, "g"), ("qq", True, "g")]
+
+
+def test_import_keeps_batch_order_and_merges(backend):
+    backend.append("qq", False, "g", [_record(10, 500)])
+    # 导入的记录时间戳乱序，读取时仍按导入顺序排列在已有的新记录之前
+    backend.import_records("qq", False, "g", [_record(1, 100), _record(2, 90), _record(3, 120)])
+    assert _ids(backend.load("qq", False, "g")) == ["1", "2", "3", "10"]
+
+
+def test_compact_with_retention_policy(backend):
+    now = 100 * 86400
+    records = [_record(i, now - (10 - i) * 86400, size=100) for i in range(10)]
+    backend.append("qq", False, "g", records)
+
+    assert backend.compact("qq", False, "g", RetentionPolicy(max_messages=20), now) == []
+    # 按条数：删除最早的2条，返回被删除的记录
+    assert _ids(backend.compact("qq", False, "g", RetentionPolicy(max_messages=8), now)) == ["0", "1"]
+    # 按天数：早于5天前的记录被删除
+    assert _ids(backend.compact("qq", False, "g", RetentionPolicy(max_messages=100, max_age_days=5.5), now)) == ["2", "3", "4"]
+    # 按体积：保留的记录总字节数不超过上限
+    size = len(records[0].data)
+    dropped = backend.compact("qq", False, "g", RetentionPolicy(max_messages=100, max_bytes=size * 3), now)
+    assert _ids(dropped) == ["5", "6"]
+    assert _ids(backend.load("qq", False, "g")) == ["7", "8", "9"]
+
+
+@pytest.fixture
+def sqlite_storage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = {"storage": {"engine": "sqlite", "flush_interval": 0}}
+    IOPool.init(config)
+    HistoryStorage.init(config)
+    yield tmp_path / "data" / "chat_history"
+    asyncio.run(HistoryStorage.shutdown())
+    IOPool.shutdown()
+
+
+def test_migrate_legacy_files_into_sqlite(sqlite_storage):
+    group_dir = sqlite_storage / "qq" / "group"
+    private_dir = sqlite_storage / "qq" / "private"
+    group_dir.mkdir(parents=True)
+    private_dir.mkdir(parents=True)
+    # 旧版整文件存储，时间戳乱序
+    (group_dir / "g.json").write_text(
+        jsonpickle.encode([_message(1, 1000), _message(2, 990), _message(3, 1010)]), encoding="utf-8"
+    )
+    # 追加写日志，混合旧版jsonpickle记录和紧凑记录
+    (group_dir / "g.jsonl").write_text(
+        jsonpickle.encode(_message(4, 1005)) + "\n" + RecordCodec.dumps(_message(5, 1020)) + "\n",
+        encoding="utf-8",
+    )
+    (private_dir / "u1.jsonl").write_text(RecordCodec.dumps(_message(6, 1000, group_id="")) + "\n", encoding="utf-8")
+
+    assert asyncio.run(HistoryStorage.migrate_history_files()) == (2, 6)
+
+    backend = HistoryStorage._get_backend()
+    records = backend.load("qq", False, "g")
+    assert all(RecordCodec.is_current(record) for record in records)
+    assert _ids(records) == ["1", "2", "3", "4", "5"]
+    assert _ids(backend.load("qq", True, "u1")) == ["6"]
+    history = asyncio.run(HistoryStorage.get_history("qq", False, "g"))
+    assert [message.message_id for message in history] == ["1", "2", "3", "4", "5"]
+    # 导入后的文件保留为备份
+    assert sorted(os.listdir(group_dir)) == ["g.json.migrated", "g.jsonl.migrated"]
+    assert os.listdir(private_dir) == ["u1.jsonl.migrated"]
+
+    # 再次迁移没有需要处理的内容
+    assert asyncio.run(HistoryStorage.migrate_history_files()) == (0, 0)
@@ -9,6 +9,19 @@ from .llm_utils import LLMUtils
 from .persona_utils import PersonaUtils
 from .text_filter import TextFilter
 from .reply_decision import ReplyDecision
+from .io_pool import IOPool
+from .image_store import ImageStore
+from .caption_store import CaptionStore
+from .caption_pipeline import CaptionPipeline
+from .prompt_builder import PromptBuilder
+from .token_estimator import TokenEstimator
+from .chat_policy import ChatPolicy
+from .keyword_matcher import KeywordMatcher
+from .reply_debouncer import ReplyDebouncer
+from .llm_scheduler import LLMScheduler
+from .budget_tracker import BudgetTracker
+from .activity_tracker import ActivityTracker
+from .mention_detector import MentionDetector
 
 __all__ = [
     "HistoryStorage",
@@ -17,5 +30,18 @@ __all__ = [
     "LLMUtils",
     "PersonaUtils",
     "TextFilter",
-    "ReplyDecision"
+    "ReplyDecision",
+    "IOPool",
+    "ImageStore",
+    "CaptionStore",
+    "CaptionPipeline",
+    "PromptBuilder",
+    "TokenEstimator",
+    "ChatPolicy",
+    "KeywordMatcher",
+    "ReplyDebouncer",
+    "LLMScheduler",
+    "BudgetTracker",
+    "ActivityTracker",
+    "MentionDetector"
 ] 
\ No newline at end of file
@@ -0,0 +1,115 @@
+from typing import Dict, List, Optional
+import math
+import time
+
+
+class ActivityTracker:
+    """
+    群消息速率统计工具类
+
+    每个群只保存一个按时间指数衰减的消息计数和上次更新时间，
+    计数除以衰减时间常数即为最近一段时间的平均消息速率（EWMA）。
+    自适应回复方式按 目标每小时回复次数 / 每小时消息数 计算回复概率，
+    群越活跃概率越低，每个群每小时的期望回复次数保持在目标附近。
+    重启后计数从零开始，统计到 WARMUP_MESSAGES 条消息或满一个时间常数之前使用基础回复概率。
+    """
+
+    # 预热需要的消息数
+    WARMUP_MESSAGES = 20
+
+    # 每个群的状态 {聊天标识: [衰减后的消息计数, 上次更新时间, 开始统计的时间, 统计到的消息数]}
+    _counters: Dict[str, List[float]] = {}
+
+    @staticmethod
+    def record(chat_key: str, window: float, now: Optional[float] = None) -> None:
+        """
+        记录一条消息
+
+        Args:
+            chat_key: 聊天标识
+            window: 衰减时间常数（秒）
+            now: 消息时间，默认为当前时间
+        """
+        now = time.time() if now is None else now
+        counter = ActivityTracker._counters.get(chat_key)
+        if counter is None:
+            ActivityTracker._counters[chat_key] = [1.0, now, now, 1]
+            return
+        counter[0] = counter[0] * math.exp(-max(0.0, now - counter[1]) / window) + 1
+        counter[1] = max(counter[1], now)
+        counter[3] += 1
+
+    @staticmethod
+    def is_warm(chat_key: str, window: float, now: Optional[float] = None) -> bool:
+        """
+        统计的消息数或时间是否足以估计消息速率
+
+        Args:
+            chat_key: 聊天标识
+            window: 衰减时间常数（秒）
+            now: 当前时间，默认为当前时间
+
+        Returns:
+            统计到 WARMUP_MESSAGES 条消息或已统计满一个时间常数时为True
+        """
+        counter = ActivityTracker._counters.get(chat_key)
+        if counter is None:
+            return False
+        now = time.time() if now is None else now
+        return counter[3] >= ActivityTracker.WARMUP_MESSAGES or now - counter[2] >= window
+
+    @staticmethod
+    def rate_per_hour(chat_key: str, window: float, now: Optional[float] = None) -> float:
+        """
+        获取群最近的消息速率
+
+        统计时间不足一个时间常数时，按实际统计的时间修正计数，避免刚开始统计时低估速率
+
+        Args:
+            chat_key: 聊天标识
+            window: 衰减时间常数（秒）
+            now: 当前时间，默认为当前时间
+
+        Returns:
+            每小时的消息数
+        """
+        counter = ActivityTracker._counters.get(chat_key)
+        if counter is None:
+            return 0.0
+        now = time.time() if now is None else now
+        count = counter[0] * math.exp(-max(0.0, now - counter[1]) / window)
+        # 速率恒定时计数为 速率 × 时间常数 × (1 - e^(-统计时间/时间常数))
+        coverage = 1 - math.exp(-max(0.0, now - counter[2]) / window)
+        if coverage <= 0:
+            return 0.0
+        return count / (window * coverage) * 3600
+
+    @staticmethod
+    def probability(
+            chat_key: str,
+            base_probability: float,
+            target_per_hour: float,
+            window: float,
+            min_probability: float,
+            max_probability: float
+        ) -> float:
+        """
+        计算使每小时期望回复次数接近目标的回复概率
+
+        Args:
+            chat_key: 聊天标识
+            base_probability: 基础回复概率，预热期间使用
+            target_per_hour: 每小时的目标回复次数
+            window: 衰减时间常数（秒）
+            min_probability: 概率下限
+            max_probability: 概率上限
+
+        Returns:
+            限制在上下限之间的回复概率，预热期间返回基础回复概率
+        """
+        now = time.time()
+        if not ActivityTracker.is_warm(chat_key, window, now):
+            return base_probability
+        rate = ActivityTracker.rate_per_hour(chat_key, window, now)
+        probability = target_per_hour / rate if rate > 0 else max_probability
+        return min(max_probability, max(min_probability, probability))
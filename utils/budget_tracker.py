@@ -0,0 +1,264 @@
+from astrbot.api.all import *
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import json
+import os
+import time
+from .io_pool import IOPool
+from .token_estimator import TokenEstimator
+
+
+class TokenBucket:
+    """
+    令牌桶
+
+    每分钟补充 rate 个令牌，最多积攒 rate 个（至少1个），每次回复消耗一个
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+
+    def _refill(self, now: float) -> None:
+        """按经过的时间补充令牌"""
+        if now <= self.updated_at:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate / 60)
+        self.updated_at = now
+
+    def available(self, now: float) -> bool:
+        """是否至少有一个令牌"""
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self) -> None:
+        """消耗一个令牌，调用前先用 available 检查"""
+        self.tokens -= 1
+
+
+class BudgetTracker:
+    """
+    回复频率和token用量统计工具类
+
+    令牌桶回复方式下，每个群每分钟最多回复 group_per_minute 次，所有聊天合计每分钟最多
+    global_per_minute 次。每次大模型回复的输入和输出token数按聊天按天累计，
+    群当天的用量超过预算后回复概率乘以 exhausted_factor。
+    用量保存在 chat_history/budget.json 中，修改后由后台任务定时写入，插件卸载时写入一次。
+    """
+
+    # 用量保留的天数
+    KEEP_DAYS = 7
+    # 用量写入磁盘的间隔（秒）
+    FLUSH_INTERVAL = 60
+
+    _path: Optional[str] = None
+    # 每个聊天的令牌桶 {聊天标识: 令牌桶}
+    _buckets: Dict[str, TokenBucket] = {}
+    _global_bucket: Optional[TokenBucket] = None
+    # 每天每个聊天的用量 {日期: {聊天标识: [输入token, 输出token, 调用次数]}}
+    _usage: Dict[str, Dict[str, List[int]]] = {}
+    _dirty = False
+    _flush_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def init() -> None:
+        """读取保存的用量"""
+        from astrbot.core.utils.astrbot_path import get_astrbot_data_path
+        data_dir = os.path.join(get_astrbot_data_path(), "chat_history")
+        os.makedirs(data_dir, exist_ok=True)
+        BudgetTracker._path = os.path.join(data_dir, "budget.json")
+        BudgetTracker._buckets = {}
+        BudgetTracker._global_bucket = None
+        BudgetTracker._usage = {}
+        BudgetTracker._dirty = False
+        BudgetTracker._flush_task = None
+        try:
+            if os.path.exists(BudgetTracker._path):
+                with open(BudgetTracker._path, "r", encoding="utf-8") as f:
+                    BudgetTracker._usage = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取token用量记录失败，重新开始统计: {e}")
+            BudgetTracker._usage = {}
+
+    @staticmethod
+    def _today() -> str:
+        """当天的日期"""
+        return time.strftime("%Y-%m-%d")
+
+    @staticmethod
+    def _get_bucket(chat_key: Optional[str], rate: float) -> TokenBucket:
+        """获取令牌桶，速率变化时重新创建"""
+        bucket = BudgetTracker._global_bucket if chat_key is None else BudgetTracker._buckets.get(chat_key)
+        if bucket is None or bucket.rate != rate:
+            bucket = TokenBucket(rate)
+            if chat_key is None:
+                BudgetTracker._global_bucket = bucket
+            else:
+                BudgetTracker._buckets[chat_key] = bucket
+        return bucket
+
+    @staticmethod
+    def take_token(chat_key: str, per_minute: float, global_per_minute: float) -> bool:
+        """
+        从聊天的令牌桶和全局令牌桶中各取一个令牌
+
+        Args:
+            chat_key: 聊天标识
+            per_minute: 聊天每分钟的回复次数，0为不限制
+            global_per_minute: 所有聊天每分钟的回复次数，0为不限制
+
+        Returns:
+            两个桶都有令牌时消耗并返回True，否则不消耗并返回False
+        """
+        now = time.time()
+        buckets = []
+        if per_minute > 0:
+            buckets.append(BudgetTracker._get_bucket(chat_key, per_minute))
+        if global_per_minute > 0:
+            buckets.append(BudgetTracker._get_bucket(None, global_per_minute))
+        if not all(bucket.available(now) for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.take()
+        return True
+
+    @staticmethod
+    def extract_usage(resp) -> Tuple[int, int]:
+        """
+        从大模型回复中读取输入和输出token数
+
+        提供商没有返回用量时，输入记为0，输出按回复文本估算
+
+        Args:
+            resp: 大模型回复
+
+        Returns:
+            (输入token数, 输出token数)
+        """
+        for usage in (getattr(resp, "usage", None), getattr(getattr(resp, "raw_completion", None), "usage", None)):
+            if usage is None:
+                continue
+            prompt_tokens = getattr(usage, "input", None)
+            if prompt_tokens is None:
+                prompt_tokens = getattr(usage, "prompt_tokens", None)
+            completion_tokens = getattr(usage, "output", None)
+            if completion_tokens is None:
+                completion_tokens = getattr(usage, "completion_tokens", None)
+            if prompt_tokens is not None or completion_tokens is not None:
+                return int(prompt_tokens or 0), int(completion_tokens or 0)
+        return 0, TokenEstimator.estimate_text(getattr(resp, "completion_text", "") or "")
+
+    @staticmethod
+    def record(chat_key: str, prompt_tokens: int, completion_tokens: int) -> None:
+        """
+        累计一次大模型调用的用量
+
+        Args:
+            chat_key: 聊天标识
+            prompt_tokens: 输入token数
+            completion_tokens: 输出token数
+        """
+        today = BudgetTracker._today()
+        usage = BudgetTracker._usage.setdefault(today, {})
+        entry = usage.setdefault(chat_key, [0, 0, 0])
+        entry[0] += prompt_tokens
+        entry[1] += completion_tokens
+        entry[2] += 1
+
+        if len(BudgetTracker._usage) > BudgetTracker.KEEP_DAYS:
+            for day in sorted(BudgetTracker._usage)[:-BudgetTracker.KEEP_DAYS]:
+                del BudgetTracker._usage[day]
+        BudgetTracker._dirty = True
+        BudgetTracker._ensure_flush_task()
+
+    @staticmethod
+    def get_usage(chat_key: str, day: Optional[str] = None) -> Tuple[int, int, int]:
+        """
+        获取聊天某天的用量
+
+        Returns:
+            (输入token数, 输出token数, 调用次数)
+        """
+        entry = BudgetTracker._usage.get(day or BudgetTracker._today(), {}).get(chat_key)
+        return tuple(entry) if entry else (0, 0, 0)
+
+    @staticmethod
+    def get_day_usage(day: Optional[str] = None) -> Dict[str, Tuple[int, int, int]]:
+        """获取某天所有聊天的用量 {聊天标识: (输入token数, 输出token数, 调用次数)}"""
+        return {key: tuple(entry) for key, entry in BudgetTracker._usage.get(day or BudgetTracker._today(), {}).items()}
+
+    @staticmethod
+    def probability_factor(chat_key: str, daily_tokens: int, exhausted_factor: float) -> float:
+        """
+        回复概率的调整系数
+
+        Args:
+            chat_key: 聊天标识
+            daily_tokens: 聊天每天的token预算，0为不限制
+            exhausted_factor: 超出预算后的系数
+
+        Returns:
+            未超出预算时为1，否则为 exhausted_factor
+        """
+        if daily_tokens <= 0:
+            return 1.0
+        prompt_tokens, completion_tokens, _ = BudgetTracker.get_usage(chat_key)
+        if prompt_tokens + completion_tokens < daily_tokens:
+            return 1.0
+        return exhausted_factor
+
+    @staticmethod
+    def _write(path: str, data: str) -> None:
+        """写入临时文件后替换，避免写入中途退出导致文件损坏"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    async def flush() -> None:
+        """用量有修改时写入磁盘"""
+        if not BudgetTracker._dirty or not BudgetTracker._path:
+            return
+        BudgetTracker._dirty = False
+        data = json.dumps(BudgetTracker._usage, ensure_ascii=False)
+        try:
+            await IOPool.run(BudgetTracker._write, BudgetTracker._path, data)
+        except OSError as e:
+            BudgetTracker._dirty = True
+            logger.error(f"写入token用量记录失败: {e}")
+
+    @staticmethod
+    async def _flush_loop() -> None:
+        """后台定时写入任务"""
+        while True:
+            await asyncio.sleep(BudgetTracker.FLUSH_INTERVAL)
+            await BudgetTracker.flush()
+
+    @staticmethod
+    def _ensure_flush_task() -> None:
+        """确保后台写入任务已启动"""
+        task = BudgetTracker._flush_task
+        if task is None or task.done():
+            try:
+                BudgetTracker._flush_task = asyncio.get_running_loop().create_task(BudgetTracker._flush_loop())
+            except RuntimeError:
+                # 不在事件循环中时等待下次记录或卸载时写入
+                pass
+
+    @staticmethod
+    async def shutdown() -> None:
+        """停止后台任务并写入用量，在插件卸载时调用"""
+        task = BudgetTracker._flush_task
+        BudgetTracker._flush_task = None
+        if task and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await BudgetTracker.flush()
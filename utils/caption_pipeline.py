@@ -0,0 +1,142 @@
+from astrbot.api.all import *
+from typing import List, Optional
+import asyncio
+import itertools
+import time
+from .image_caption import ImageCaptionUtils
+from .message_utils import MessageUtils
+from .mention_detector import MentionDetector
+
+
+class CaptionPipeline:
+    """
+    后台图片转述流水线
+
+    新消息保存后，其中的图片进入优先级队列，由固定数量的后台任务提前转述并写入描述缓存，
+    构建上下文时直接命中缓存，转述的耗时不再落在回复路径上。
+    私聊和对机器人说的消息（@机器人、回复机器人等）最优先，其次是最近回复过的群聊，其余群聊最后。
+    """
+
+    # 优先级，数值越小越先处理
+    PRIORITY_DIRECT = 0
+    PRIORITY_ACTIVE = 1
+    PRIORITY_NORMAL = 2
+    # 最近多少秒内回复过的群聊视为活跃
+    ACTIVE_WINDOW = 600
+
+    config: Optional[AstrBotConfig] = None
+    _queue: Optional[asyncio.PriorityQueue] = None
+    _workers: List[asyncio.Task] = []
+    # 同优先级按提交顺序处理
+    _counter = itertools.count()
+
+    @staticmethod
+    def init(config: AstrBotConfig):
+        """保存配置，后台任务在第一次提交时启动"""
+        CaptionPipeline.config = config
+        CaptionPipeline._queue = None
+        CaptionPipeline._workers = []
+
+    @staticmethod
+    def _get_config() -> dict:
+        """获取图片处理相关配置"""
+        if not CaptionPipeline.config:
+            return {}
+        return CaptionPipeline.config.get("image_processing", {})
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """是否启用后台转述"""
+        image_processing_config = CaptionPipeline._get_config()
+        return bool(
+            image_processing_config.get("use_image_caption", False)
+            and image_processing_config.get("caption_pipeline", False)
+        )
+
+    @staticmethod
+    def _ensure_workers() -> asyncio.PriorityQueue:
+        """确保队列和后台任务已启动"""
+        if CaptionPipeline._queue is None:
+            image_processing_config = CaptionPipeline._get_config()
+            queue_size = max(1, int(image_processing_config.get("caption_pipeline_queue_size", 256)))
+            CaptionPipeline._queue = asyncio.PriorityQueue(maxsize=queue_size)
+        CaptionPipeline._workers = [task for task in CaptionPipeline._workers if not task.done()]
+        if not CaptionPipeline._workers:
+            worker_count = max(1, int(CaptionPipeline._get_config().get("caption_pipeline_workers", 2)))
+            loop = asyncio.get_running_loop()
+            CaptionPipeline._workers = [
+                loop.create_task(CaptionPipeline._worker()) for _ in range(worker_count)
+            ]
+        return CaptionPipeline._queue
+
+    @staticmethod
+    def _get_priority(event: AstrMessageEvent) -> int:
+        """根据消息判断转述的优先级"""
+        if event.is_private_chat() or MentionDetector.is_directed(event):
+            return CaptionPipeline.PRIORITY_DIRECT
+
+        from .llm_utils import LLMUtils
+        last_call_time = LLMUtils.get_last_call_time(event.get_platform_name(), False, event.get_group_id())
+        if last_call_time and time.time() - last_call_time < CaptionPipeline.ACTIVE_WINDOW:
+            return CaptionPipeline.PRIORITY_ACTIVE
+        return CaptionPipeline.PRIORITY_NORMAL
+
+    @staticmethod
+    def submit(event: AstrMessageEvent) -> int:
+        """
+        将消息中的图片加入转述队列，不等待转述完成
+
+        Args:
+            event: 已保存到历史记录的消息事件
+
+        Returns:
+            加入队列的图片数
+        """
+        if not CaptionPipeline.is_enabled():
+            return 0
+        message = getattr(event.message_obj, "message", None)
+        if not message:
+            return 0
+        images = MessageUtils.collect_image_sources(message)
+        if not images:
+            return 0
+
+        queue = CaptionPipeline._ensure_workers()
+        priority = CaptionPipeline._get_priority(event)
+        submitted = 0
+        for image in dict.fromkeys(images):
+            try:
+                queue.put_nowait((priority, next(CaptionPipeline._counter), image, event.unified_msg_origin))
+                submitted += 1
+            except asyncio.QueueFull:
+                # 队列已满时放弃，构建上下文时会按需转述
+                logger.debug("图片转述队列已满，跳过后台转述")
+                break
+        return submitted
+
+    @staticmethod
+    async def _worker() -> None:
+        """后台转述任务，结果由ImageCaptionUtils写入描述缓存"""
+        queue = CaptionPipeline._queue
+        while True:
+            _, _, image, umo = await queue.get()
+            try:
+                await ImageCaptionUtils.generate_image_caption(image, umo=umo)
+            except Exception as e:
+                logger.error(f"后台图片转述失败: {e}")
+            finally:
+                queue.task_done()
+
+    @staticmethod
+    async def shutdown() -> None:
+        """停止后台任务，未处理的图片直接丢弃"""
+        workers = CaptionPipeline._workers
+        CaptionPipeline._workers = []
+        CaptionPipeline._queue = None
+        for task in workers:
+            task.cancel()
+        for task in workers:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
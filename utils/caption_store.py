@@ -0,0 +1,204 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from astrbot.api.all import logger
+from .io_pool import IOPool
+
+
+class CaptionStore:
+    """
+    图片描述缓存工具类
+
+    按 (图片内容哈希, 提示词, 提供商) 缓存图片描述，进程内LRU在前，SQLite数据库在后，
+    重启后仍可复用已生成的描述。数据库按条数和有效期限制大小，并统计命中情况。
+    """
+
+    # 数据库连接，会在I/O线程池的不同线程中使用，由锁保证同一时间只有一个线程访问
+    _conn: Optional[sqlite3.Connection] = None
+    _lock = threading.Lock()
+    # 进程内LRU缓存 {缓存键: (描述, 创建时间)}，只在事件循环中访问
+    _memory: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+    memory_entries: int = 512
+    max_entries: int = 10000
+    ttl_seconds: float = 30 * 86400
+    # 数据库中的大致条数，超出上限一定比例后再统一清理
+    _disk_count: int = 0
+    # 命中统计
+    _stats: Dict[str, int] = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    # 超出上限多少比例后清理，避免每次写入都清理
+    PRUNE_SLACK = 0.1
+
+    @staticmethod
+    def init(db_path: str, memory_entries: int = 512, max_entries: int = 10000, ttl_days: float = 30) -> None:
+        """
+        打开图片描述缓存
+
+        Args:
+            db_path: 数据库路径
+            memory_entries: 进程内缓存的条数
+            max_entries: 数据库最多保存的条数
+            ttl_days: 描述的有效天数，0为不过期
+        """
+        CaptionStore.close()
+        CaptionStore.memory_entries = max(0, int(memory_entries))
+        CaptionStore.max_entries = max(1, int(max_entries))
+        CaptionStore.ttl_seconds = max(0.0, float(ttl_days)) * 86400
+        CaptionStore._memory = OrderedDict()
+        CaptionStore._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        with CaptionStore._lock:
+            conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS captions (
+                    key TEXT PRIMARY KEY,
+                    caption TEXT NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    last_used_at INTEGER NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_captions_last_used ON captions (last_used_at)"
+            )
+            CaptionStore._disk_count = conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+            CaptionStore._conn = conn
+        logger.debug(f"图片描述缓存初始化: {db_path}，已有 {CaptionStore._disk_count} 条")
+
+    @staticmethod
+    def close() -> None:
+        """关闭数据库"""
+        with CaptionStore._lock:
+            if CaptionStore._conn is not None:
+                CaptionStore._conn.close()
+                CaptionStore._conn = None
+
+    @staticmethod
+    def make_key(content_hash: str, prompt: str, provider: str) -> str:
+        """由图片内容哈希、提示词和提供商生成缓存键"""
+        return hashlib.sha256(f"{content_hash}\0{prompt}\0{provider}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _expired(created_at: int, now: float) -> bool:
+        """描述是否已超过有效期"""
+        return bool(CaptionStore.ttl_seconds) and now - created_at > CaptionStore.ttl_seconds
+
+    @staticmethod
+    def _remember(key: str, caption: str, created_at: int) -> None:
+        """放入进程内缓存，超出条数时淘汰最久未使用的描述"""
+        if CaptionStore.memory_entries <= 0:
+            return
+        CaptionStore._memory[key] = (caption, created_at)
+        CaptionStore._memory.move_to_end(key)
+        while len(CaptionStore._memory) > CaptionStore.memory_entries:
+            CaptionStore._memory.popitem(last=False)
+
+    @staticmethod
+    def _load(key: str) -> Optional[Tuple[str, int]]:
+        """从数据库读取描述及其创建时间，过期的描述视为不存在（阻塞，在线程池中执行）"""
+        if CaptionStore._conn is None:
+            return None
+        now = int(time.time())
+        with CaptionStore._lock:
+            conn = CaptionStore._conn
+            row = conn.execute(
+                "SELECT caption, created_at FROM captions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if CaptionStore._expired(row[1], now):
+                conn.execute("DELETE FROM captions WHERE key = ?", (key,))
+                CaptionStore._disk_count -= 1
+                return None
+            conn.execute("UPDATE captions SET last_used_at = ? WHERE key = ?", (now, key))
+            return row[0], row[1]
+
+    @staticmethod
+    def _save(key: str, caption: str) -> None:
+        """写入描述，超出条数上限时清理过期和最久未使用的描述（阻塞，在线程池中执行）"""
+        if CaptionStore._conn is None:
+            return
+        now = int(time.time())
+        with CaptionStore._lock:
+            conn = CaptionStore._conn
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO captions (key, caption, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+                (key, caption, now, now),
+            )
+            CaptionStore._disk_count += max(cursor.rowcount, 0)
+            if CaptionStore._disk_count > CaptionStore.max_entries * (1 + CaptionStore.PRUNE_SLACK):
+                CaptionStore._prune(now)
+
+    @staticmethod
+    def _prune(now: int) -> None:
+        """删除过期的描述，再按最近使用时间删除到条数上限以内，调用方需持有锁"""
+        conn = CaptionStore._conn
+        if CaptionStore.ttl_seconds:
+            conn.execute(
+                "DELETE FROM captions WHERE created_at < ?", (int(now - CaptionStore.ttl_seconds),)
+            )
+        conn.execute(
+            """
+            DELETE FROM captions WHERE key IN (
+                SELECT key FROM captions ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (CaptionStore.max_entries,),
+        )
+        CaptionStore._disk_count = conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+        logger.debug(f"图片描述缓存已清理，保留 {CaptionStore._disk_count} 条")
+
+    @staticmethod
+    async def get(key: str) -> Optional[str]:
+        """
+        读取缓存的描述
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            缓存的描述，未命中返回None
+        """
+        entry = CaptionStore._memory.get(key)
+        if entry is not None:
+            if not CaptionStore._expired(entry[1], time.time()):
+                CaptionStore._memory.move_to_end(key)
+                CaptionStore._stats["memory_hits"] += 1
+                return entry[0]
+            # 过期的描述从进程内缓存移除，数据库中的由读取时删除
+            del CaptionStore._memory[key]
+
+        entry = await IOPool.run(CaptionStore._load, key)
+        if entry is not None:
+            CaptionStore._remember(key, *entry)
+            CaptionStore._stats["disk_hits"] += 1
+            return entry[0]
+
+        CaptionStore._stats["misses"] += 1
+        return None
+
+    @staticmethod
+    async def put(key: str, caption: str) -> None:
+        """
+        保存描述
+
+        Args:
+            key: 缓存键
+            caption: 图片描述
+        """
+        CaptionStore._remember(key, caption, int(time.time()))
+        await IOPool.run(CaptionStore._save, key, caption)
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        """缓存使用情况和命中统计"""
+        return {
+            **CaptionStore._stats,
+            "memory_entries": len(CaptionStore._memory),
+            "disk_entries": CaptionStore._disk_count,
+        }
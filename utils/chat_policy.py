@@ -0,0 +1,266 @@
+from astrbot.api.all import *
+from typing import Dict, NamedTuple, Optional, Tuple
+import json
+import time
+from .history_backends import RetentionPolicy
+from .keyword_matcher import KeywordMatcher
+
+
+class ChatRule(NamedTuple):
+    """单个聊天编译后的规则"""
+    # 是否保存历史记录并允许回复
+    enabled: bool
+    # 概率回复的回复概率
+    probability: float
+    # 触发回复的关键词
+    keywords: Tuple[str, ...]
+    # 历史记录保留策略
+    retention: RetentionPolicy
+    # 由触发关键词和黑名单关键词编译的匹配器
+    matcher: KeywordMatcher
+    # 令牌桶回复方式下每分钟最多回复的次数，0为不限制
+    per_minute: float
+    # 每天的token预算，0为不限制
+    daily_tokens: int
+    # 自适应回复方式下每小时的目标回复次数
+    target_per_hour: float
+
+
+class ChatPolicy:
+    """
+    编译后的聊天策略
+
+    由配置一次性编译出群聊黑白名单、回复概率、关键词匹配器和保留策略，
+    以及 group_overrides 中按群覆盖的配置，按聊天查询规则时不再逐项读取配置。
+    HistoryStorage 和 ReplyDecision 通过 ChatPolicy.current(config) 共用同一个策略，
+    配置对象被替换或其中的相关配置被修改后自动重新编译。
+    """
+
+    # 默认保留的历史记录条数
+    HISTORY_RETENTION = 200
+    # 检查配置是否被修改的最小间隔（秒）
+    FINGERPRINT_INTERVAL = 5
+    # 参与编译的配置项，其余配置的修改不会触发重新编译
+    POLICY_KEYS = (
+        "enabled_private", "enable_all_groups", "enabled_groups", "blocked_groups",
+        "group_overrides", "model_frequency", "storage", "directed_fast_path",
+    )
+    # 每个聊天缓存的规则条数上限
+    MAX_RULES = 4096
+
+    # 当前的策略及对应的配置
+    _current: Optional["ChatPolicy"] = None
+    _config_id: Optional[int] = None
+    _fingerprint: Optional[str] = None
+    _checked_at: float = 0.0
+
+    def __init__(self, config: Optional[AstrBotConfig]):
+        config = config or {}
+        self.enabled_private = bool(config.get("enabled_private", False))
+        self.enable_all_groups = bool(config.get("enable_all_groups", False))
+        self.blocked_groups = frozenset(str(g).strip() for g in config.get("blocked_groups", []) if str(g).strip())
+        self.enabled_groups = frozenset(str(g).strip() for g in config.get("enabled_groups", []) if str(g).strip())
+        # @机器人、回复机器人的消息是否总是回复
+        self.directed_fast_path = bool(config.get("directed_fast_path", True))
+
+        frequency_config = config.get("model_frequency", {})
+        self.method = frequency_config.get("method", "概率回复")
+        self.probability = frequency_config.get("probability", {}).get("probability", 0.1)
+        self.keywords = tuple(k for k in frequency_config.get("keywords", []) if k)
+        self.blacklist_keywords = tuple(k for k in frequency_config.get("blacklist_keywords", []) if k)
+        self.normalize_keywords = bool(frequency_config.get("keyword_normalize", False))
+        bucket_config = frequency_config.get("token_bucket", {})
+        self.per_minute = max(0.0, float(bucket_config.get("group_per_minute", 2)))
+        self.global_per_minute = max(0.0, float(bucket_config.get("global_per_minute", 20)))
+        adaptive_config = frequency_config.get("adaptive", {})
+        self.target_per_hour = max(0.0, float(adaptive_config.get("target_per_hour", 6)))
+        self.adaptive_window = max(1.0, float(adaptive_config.get("window_minutes", 30))) * 60
+        self.min_probability = min(1.0, max(0.0, float(adaptive_config.get("min_probability", 0.01))))
+        self.max_probability = min(1.0, max(self.min_probability, float(adaptive_config.get("max_probability", 1.0))))
+        budget_config = frequency_config.get("budget", {})
+        self.daily_tokens = max(0, int(budget_config.get("daily_tokens", 0)))
+        self.exhausted_factor = min(1.0, max(0.0, float(budget_config.get("exhausted_factor", 0.2))))
+        # 按触发关键词缓存的匹配器，关键词相同的群共用一个
+        self._matchers: Dict[Tuple[str, ...], KeywordMatcher] = {}
+
+        storage_config = config.get("storage", {})
+        self.retention = ChatPolicy.parse_retention(
+            {
+                "max_messages": storage_config.get("retention_max_messages", ChatPolicy.HISTORY_RETENTION),
+                "max_age_days": storage_config.get("retention_max_age_days", 0),
+                "max_mb": storage_config.get("retention_max_mb", 0),
+            },
+            RetentionPolicy(ChatPolicy.HISTORY_RETENTION),
+        )
+
+        self.overrides = ChatPolicy.parse_overrides(config.get("group_overrides", []))
+        self._rules: Dict[Tuple[bool, str], ChatRule] = {}
+
+    @staticmethod
+    def current(config: Optional[AstrBotConfig]) -> "ChatPolicy":
+        """
+        获取配置对应的策略
+
+        配置对象不是上次编译时的对象时立即重新编译；同一配置对象每隔
+        FINGERPRINT_INTERVAL 秒比较一次相关配置的指纹，被修改时重新编译
+
+        Args:
+            config: 插件配置
+
+        Returns:
+            编译后的策略
+        """
+        now = time.time()
+        policy = ChatPolicy._current
+        if policy is not None and ChatPolicy._config_id == id(config):
+            if now - ChatPolicy._checked_at < ChatPolicy.FINGERPRINT_INTERVAL:
+                return policy
+            ChatPolicy._checked_at = now
+            fingerprint = ChatPolicy._fingerprint_of(config)
+            if fingerprint == ChatPolicy._fingerprint:
+                return policy
+            logger.debug("聊天策略相关配置已修改，重新编译")
+        else:
+            fingerprint = ChatPolicy._fingerprint_of(config)
+
+        policy = ChatPolicy(config)
+        ChatPolicy._current = policy
+        ChatPolicy._config_id = id(config)
+        ChatPolicy._fingerprint = fingerprint
+        ChatPolicy._checked_at = now
+        return policy
+
+    @staticmethod
+    def _fingerprint_of(config: Optional[AstrBotConfig]) -> str:
+        """相关配置的指纹"""
+        if not config:
+            return ""
+        return json.dumps(
+            {key: config.get(key) for key in ChatPolicy.POLICY_KEYS},
+            sort_keys=True, ensure_ascii=False, default=str,
+        )
+
+    @staticmethod
+    def parse_retention(values: dict, base: RetentionPolicy) -> RetentionPolicy:
+        """从配置值构建保留策略，缺少或无效的项沿用base"""
+        max_messages, max_age_days, max_bytes = base
+        try:
+            if "max_messages" in values:
+                max_messages = max(1, int(values["max_messages"]))
+            if "max_age_days" in values:
+                max_age_days = max(0.0, float(values["max_age_days"]))
+            if "max_mb" in values:
+                max_bytes = int(max(0.0, float(values["max_mb"])) * 1024 * 1024)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"历史记录保留策略配置无效: {values}，{e}")
+        return RetentionPolicy(max_messages, max_age_days, max_bytes)
+
+    @staticmethod
+    def parse_overrides(entries: list) -> Dict[str, Dict[str, str]]:
+        """
+        解析按群覆盖的配置
+
+        格式为 "群号:键=值,键=值"，如 "123456:max_messages=500,probability=0.3,keywords=早安|晚安,per_minute=1,daily_tokens=200000,target_per_hour=3"
+
+        Returns:
+            {群号: {键: 值}}
+        """
+        overrides: Dict[str, Dict[str, str]] = {}
+        for entry in entries or []:
+            group_id, _, options = str(entry).partition(":")
+            group_id = group_id.strip()
+            if not group_id or not options:
+                continue
+            values = overrides.setdefault(group_id, {})
+            for option in options.split(","):
+                key, _, value = option.partition("=")
+                if key.strip() and value.strip():
+                    values[key.strip()] = value.strip()
+        return overrides
+
+    def rule(self, is_private_chat: bool, chat_id: str) -> ChatRule:
+        """
+        获取聊天的规则
+
+        Args:
+            is_private_chat: 是否为私聊
+            chat_id: 群号或私聊对象ID
+
+        Returns:
+            聊天的规则
+        """
+        chat_id = str(chat_id).strip()
+        key = (is_private_chat, chat_id)
+        rule = self._rules.get(key)
+        if rule is None:
+            rule = self._compile_rule(is_private_chat, chat_id)
+            if len(self._rules) >= ChatPolicy.MAX_RULES:
+                self._rules.clear()
+            self._rules[key] = rule
+        return rule
+
+    def _compile_rule(self, is_private_chat: bool, chat_id: str) -> ChatRule:
+        """编译单个聊天的规则"""
+        if is_private_chat:
+            # 私聊固定概率为1，总是回复，不限制单个私聊的频率和预算
+            return ChatRule(
+                self.enabled_private, 1.0, self.keywords, self.retention, self.matcher_for(self.keywords), 0.0, 0, 0.0
+            )
+
+        # 优先级: 黑名单 > 全局开关 > 白名单
+        if not chat_id or chat_id in self.blocked_groups:
+            enabled = False
+        else:
+            enabled = self.enable_all_groups or chat_id in self.enabled_groups
+
+        probability = self.probability
+        keywords = self.keywords
+        retention = self.retention
+        per_minute = self.per_minute
+        daily_tokens = self.daily_tokens
+        target_per_hour = self.target_per_hour
+        values = self.overrides.get(chat_id)
+        if values:
+            if "probability" in values:
+                try:
+                    probability = min(1.0, max(0.0, float(values["probability"])))
+                except ValueError:
+                    logger.warning(f"群 {chat_id} 的回复概率配置无效: {values['probability']}")
+            if "per_minute" in values:
+                try:
+                    per_minute = max(0.0, float(values["per_minute"]))
+                except ValueError:
+                    logger.warning(f"群 {chat_id} 的每分钟回复次数配置无效: {values['per_minute']}")
+            if "daily_tokens" in values:
+                try:
+                    daily_tokens = max(0, int(values["daily_tokens"]))
+                except ValueError:
+                    logger.warning(f"群 {chat_id} 的token预算配置无效: {values['daily_tokens']}")
+            if "target_per_hour" in values:
+                try:
+                    target_per_hour = max(0.0, float(values["target_per_hour"]))
+                except ValueError:
+                    logger.warning(f"群 {chat_id} 的每小时目标回复次数配置无效: {values['target_per_hour']}")
+            if "keywords" in values:
+                keywords = tuple(k.strip() for k in values["keywords"].split("|") if k.strip())
+            if values.keys() & {"max_messages", "max_age_days", "max_mb"}:
+                retention = ChatPolicy.parse_retention(values, self.retention)
+        return ChatRule(
+            enabled, probability, keywords, retention, self.matcher_for(keywords), per_minute, daily_tokens, target_per_hour
+        )
+
+    def matcher_for(self, keywords: Tuple[str, ...]) -> KeywordMatcher:
+        """获取由触发关键词和全局黑名单关键词编译的匹配器"""
+        matcher = self._matchers.get(keywords)
+        if matcher is None:
+            matcher = KeywordMatcher(keywords, self.blacklist_keywords, normalize=self.normalize_keywords)
+            self._matchers[keywords] = matcher
+        return matcher
+
+    def store_allowed(self, is_private_chat: bool, chat_id: str) -> bool:
+        """是否保存该聊天的历史记录"""
+        return self.rule(is_private_chat, chat_id).enabled
+
+    def reply_allowed(self, is_private_chat: bool, chat_id: str) -> bool:
+        """是否允许回复该聊天"""
+        return self.rule(is_private_chat, chat_id).enabled
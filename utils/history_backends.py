@@ -0,0 +1,447 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from typing import List, NamedTuple, Optional, Tuple
+from astrbot.api.all import logger
+
+
+class HistoryRecord(NamedTuple):
+    """一条已编码的历史记录"""
+    timestamp: int
+    message_id: str
+    # 紧凑JSON文本，sqlite引擎下也可以是msgpack二进制
+    data: str | bytes
+
+
+class RetentionPolicy(NamedTuple):
+    """聊天的历史记录保留策略，时间和体积为0表示不限制"""
+    max_messages: int
+    max_age_days: float = 0
+    max_bytes: int = 0
+
+
+def _count_expired(entries: List[Tuple[int, int]], policy: RetentionPolicy, now: float) -> int:
+    """
+    计算按保留策略需要从头部删除的记录数
+
+    Args:
+        entries: 按时间顺序排列的 (时间戳, 字节数) 列表
+        policy: 保留策略
+        now: 当前时间戳
+
+    Returns:
+        需要删除的最早记录条数
+    """
+    total = len(entries)
+    drop = max(0, total - policy.max_messages)
+    if policy.max_age_days > 0:
+        cutoff = now - policy.max_age_days * 86400
+        while drop < total and entries[drop][0] < cutoff:
+            drop += 1
+    if policy.max_bytes > 0:
+        kept_bytes = sum(size for _, size in entries[drop:])
+        while drop < total and kept_bytes > policy.max_bytes:
+            kept_bytes -= entries[drop][1]
+            drop += 1
+    return drop
+
+
+class SegmentLogBackend:
+    """
+    追加写日志存储后端
+
+    每个聊天对应一个 {chat_id}.jsonl 文件，一行一条文本记录
+    写入只追加新的行，超出保留策略的记录由后台压缩任务统一删除
+    """
+
+    def __init__(self, base_path: str):
+        self.base_path = base_path
+
+    def _get_chat_dir(self, platform_name: str, is_private_chat: bool) -> str:
+        """获取聊天类型对应的存储目录"""
+        chat_type = "private" if is_private_chat else "group"
+        directory = os.path.join(self.base_path, platform_name, chat_type)
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def get_log_path(self, platform_name: str, is_private_chat: bool, chat_id: str) -> str:
+        """获取日志文件路径"""
+        directory = self._get_chat_dir(platform_name, is_private_chat)
+        return os.path.join(directory, f"{chat_id}.jsonl")
+
+    def get_legacy_path(self, platform_name: str, is_private_chat: bool, chat_id: str) -> str:
+        """获取旧版整文件存储的路径"""
+        directory = self._get_chat_dir(platform_name, is_private_chat)
+        return os.path.join(directory, f"{chat_id}.json")
+
+    def append(self, platform_name: str, is_private_chat: bool, chat_id: str, records: List[HistoryRecord]) -> None:
+        """
+        追加记录到日志末尾
+
+        Args:
+            platform_name: 平台名称
+            is_private_chat: 是否为私聊
+            chat_id: 聊天ID
+            records: 待写入的记录列表
+        """
+        if not records:
+            return
+
+        log_path = self.get_log_path(platform_name, is_private_chat, chat_id)
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write("".join(record.data + "\n" for record in records))
+
+    # 从文件末尾倒序读取时每次读取的块大小
+    TAIL_BLOCK_SIZE = 64 * 1024
+
+    @staticmethod
+    def _read_tail(log_path: str, limit: int) -> List[str]:
+        """
+        从文件末尾按块倒序读取，凑够 limit 条记录即停止
+
+        UTF-8 编码中换行符不会出现在多字节字符内部，可以直接按字节切分行
+        """
+        lines: List[bytes] = []
+        with open(log_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b""
+            while position > 0 and len(lines) < limit:
+                read_size = min(SegmentLogBackend.TAIL_BLOCK_SIZE, position)
+                position -= read_size
+                f.seek(position)
+                block = f.read(read_size) + remainder
+                parts = block.split(b"\n")
+                # 第一段可能是被块边界截断的半行，留到下一轮拼接
+                remainder = parts[0]
+                for part in reversed(parts[1:]):
+                    if part.strip():
+                        lines.append(part)
+                        if len(lines) >= limit:
+                            break
+            if len(lines) < limit and position == 0 and remainder.strip():
+                lines.append(remainder)
+
+        return [line.decode("utf-8").rstrip("\r") for line in reversed(lines)]
+
+    def load(self, platform_name: str, is_private_chat: bool, chat_id: str, limit: Optional[int] = None) -> List[str]:
+        """
+        读取日志中的记录
+
+        指定 limit 时只从文件末尾读取需要的部分，代价与 limit 成正比而不是与文件大小成正比
+
+        Args:
+            platform_name: 平台名称
+            is_private_chat: 是否为私聊
+            chat_id: 聊天ID
+            limit: 只返回最后若干条记录，为空则返回全部
+
+        Returns:
+            按时间顺序排列的已编码记录列表
+        """
+        log_path = self.get_log_path(platform_name, is_private_chat, chat_id)
+        if not os.path.exists(log_path):
+            return []
+
+        if limit is not None:
+            return self._read_tail(log_path, limit) if limit > 0 else []
+
+        with open(log_path, "r", encoding="utf-8") as f:
+            return [line.rstrip("\n") for line in f if line.strip()]
+
+    @staticmethod
+    def _record_timestamp(record: str) -> int:
+        """读取记录的时间戳，兼容旧版jsonpickle记录"""
+        try:
+            data = json.loads(record)
+            return int(data.get("ts", data.get("timestamp", 0)) or 0)
+        except Exception:
+            return 0
+
+    def compact(self, platform_name: str, is_private_chat: bool, chat_id: str, policy: RetentionPolicy, now: Optional[float] = None) -> List[str]:
+        """
+        按保留策略压缩日志
+
+        先写入临时文件再原子替换，避免压缩中途崩溃导致历史记录损坏
+
+        Args:
+            platform_name: 平台名称
+            is_private_chat: 是否为私聊
+            chat_id: 聊天ID
+            policy: 保留策略
+            now: 当前时间戳，为空则使用当前时间
+
+        Returns:
+            被删除的记录
+        """
+        log_path = self.get_log_path(platform_name, is_private_chat, chat_id)
+        records = self.load(platform_name, is_private_chat, chat_id)
+        if not records:
+            return []
+
+        # 只有按时间保留时才需要解析每条记录的时间戳
+        check_age = policy.max_age_days > 0
+        entries = [
+            (self._record_timestamp(record) if check_age else 0, len(record.encode("utf-8")) + 1)
+            for record in records
+        ]
+        drop = _count_expired(entries, policy, now if now is not None else time.time())
+        if drop == 0:
+            return []
+
+        tmp_path = log_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("".join(record + "\n" for record in records[drop:]))
+        os.replace(tmp_path, log_path)
+
+        logger.debug(f"历史记录日志已压缩: {log_path}，删除 {drop} 条，保留 {len(records) - drop} 条")
+        return records[:drop]
+
+    def replace_records(self, platform_name: str, is_private_chat: bool, chat_id: str, records: List[HistoryRecord]) -> None:
+        """用给定记录整体替换日志内容，用于迁移和格式转换"""
+        log_path = self.get_log_path(platform_name, is_private_chat, chat_id)
+        tmp_path = log_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("".join(record.data + "\n" for record in records))
+        os.replace(tmp_path, log_path)
+
+    def list_chats(self) -> List[tuple]:
+        """列出所有有日志文件的聊天，返回 (平台名称, 是否私聊, 聊天ID) 列表"""
+        chats = []
+        if not os.path.isdir(self.base_path):
+            return chats
+        for platform_name in os.listdir(self.base_path):
+            for chat_type in ("group", "private"):
+                directory = os.path.join(self.base_path, platform_name, chat_type)
+                if not os.path.isdir(directory):
+                    continue
+                for filename in os.listdir(directory):
+                    if filename.endswith(".jsonl"):
+                        chats.append((platform_name, chat_type == "private", filename[:-len(".jsonl")]))
+        return chats
+
+    def clear(self, platform_name: str, is_private_chat: bool, chat_id: str) -> None:
+        """删除聊天的日志文件及旧版存储文件"""
+        log_path = self.get_log_path(platform_name, is_private_chat, chat_id)
+        legacy_path = self.get_legacy_path(platform_name, is_private_chat, chat_id)
+        for path in (log_path, legacy_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self) -> None:
+        """日志文件每次写入后即关闭，无需额外处理"""
+        pass
+
+
+class SqliteBackend:
+    """
+    SQLite存储后端
+
+    所有聊天的消息存放在同一个WAL模式的数据库中，
+    按 (平台, 聊天类型, 聊天ID, 时间戳) 建立索引，读取最近N条是一次索引范围查询
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # 连接会在I/O线程池的不同线程中使用，由锁保证同一时间只有一个线程访问
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    platform TEXT NOT NULL,
+                    chat_type TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    timestamp INTEGER NOT NULL,
+                    message_id TEXT,
+                    data BLOB NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_chat "
+                "ON messages (platform, chat_type, chat_id, timestamp)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id)"
+            )
+        logger.info(f"SQLite历史记录数据库: {db_path}")
+
+    @staticmethod
+    def _chat_params(platform_name: str, is_private_chat: bool, chat_id: str) -> tuple:
+        """聊天在数据库中的键"""
+        return (platform_name, "private" if is_private_chat else "group", str(chat_id))
+
+    def _insert(self, chat: tuple, records: List[HistoryRecord]) -> None:
+        """插入记录，调用方需持有锁并处于事务中"""
+        self._conn.executemany(
+            "INSERT INTO messages (platform, chat_type, chat_id, timestamp, message_id, data) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [chat + (record.timestamp, record.message_id, record.data) for record in records],
+        )
+
+    def append(self, platform_name: str, is_private_chat: bool, chat_id: str, records: List[HistoryRecord]) -> None:
+        """
+        插入新记录
+
+        Args:
+            platform_name: 平台名称
+            is_private_chat: 是否为私聊
+            chat_id: 聊天ID
+            records: 待写入的记录列表
+        """
+        if not records:
+            return
+
+        chat = self._chat_params(platform_name, is_private_chat, chat_id)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._insert(chat, records)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def load(self, platform_name: str, is_private_chat: bool, chat_id: str, limit: Optional[int] = None) -> List[str | bytes]:
+        """
+        读取最近的记录
+
+        Args:
+            platform_name: 平台名称
+            is_private_chat: 是否为私聊
+            chat_id: 聊天ID
+            limit: 只返回最后若干条记录，为空则返回全部
+
+        Returns:
+            按时间顺序排列的已编码记录列表
+        """
+        chat = self._chat_params(platform_name, is_private_chat, chat_id)
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT data FROM messages
+                WHERE platform = ? AND chat_type = ? AND chat_id = ?
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+                """,
+                chat + (limit if limit is not None else -1,),
+            ).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def compact(self, platform_name: str, is_private_chat: bool, chat_id: str, policy: RetentionPolicy, now: Optional[float] = None) -> List[str | bytes]:
+        """
+        按保留策略删除旧记录
+
+        Args:
+            platform_name: 平台名称
+            is_private_chat: 是否为私聊
+            chat_id: 聊天ID
+            policy: 保留策略
+            now: 当前时间戳，为空则使用当前时间
+
+        Returns:
+            被删除的记录
+        """
+        chat = self._chat_params(platform_name, is_private_chat, chat_id)
+        with self._lock:
+            entries = self._conn.execute(
+                """
+                SELECT id, timestamp, length(CAST(data AS BLOB)) FROM messages
+                WHERE platform = ? AND chat_type = ? AND chat_id = ?
+                ORDER BY timestamp, id
+                """,
+                chat,
+            ).fetchall()
+            drop = _count_expired(
+                [(timestamp, size) for _, timestamp, size in entries],
+                policy, now if now is not None else time.time()
+            )
+            if drop == 0:
+                return []
+
+            # 按 (时间戳, id) 排序后，最后一条被删除记录之前（含）的都要删除
+            boundary_id, boundary_timestamp, _ = entries[drop - 1]
+            condition = (
+                "platform = ? AND chat_type = ? AND chat_id = ? "
+                "AND (timestamp < ? OR (timestamp = ? AND id <= ?))"
+            )
+            params = chat + (boundary_timestamp, boundary_timestamp, boundary_id)
+            self._conn.execute("BEGIN")
+            try:
+                rows = self._conn.execute(
+                    f"SELECT data FROM messages WHERE {condition} ORDER BY timestamp, id", params
+                ).fetchall()
+                self._conn.execute(f"DELETE FROM messages WHERE {condition}", params)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [row[0] for row in rows]
+
+    def import_records(self, platform_name: str, is_private_chat: bool, chat_id: str, records: List[HistoryRecord]) -> None:
+        """
+        导入记录，与已有记录按时间戳合并
+
+        读取按时间戳排序，同一批导入的记录中时间戳比前面的记录早的，按前一条的时间戳保存，
+        使这批记录读取时保持导入时的顺序
+        """
+        chat = self._chat_params(platform_name, is_private_chat, chat_id)
+        ordered: List[HistoryRecord] = []
+        for record in records:
+            if ordered and record.timestamp < ordered[-1].timestamp:
+                record = record._replace(timestamp=ordered[-1].timestamp)
+            ordered.append(record)
+        records = ordered
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._insert(chat, records)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def replace_records(self, platform_name: str, is_private_chat: bool, chat_id: str, records: List[HistoryRecord]) -> None:
+        """用给定记录整体替换聊天的记录，用于格式转换"""
+        chat = self._chat_params(platform_name, is_private_chat, chat_id)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "DELETE FROM messages WHERE platform = ? AND chat_type = ? AND chat_id = ?",
+                    chat,
+                )
+                self._insert(chat, records)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def list_chats(self) -> List[tuple]:
+        """列出数据库中所有聊天，返回 (平台名称, 是否私聊, 聊天ID) 列表"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT platform, chat_type, chat_id FROM messages"
+            ).fetchall()
+        return [(platform, chat_type == "private", chat_id) for platform, chat_type, chat_id in rows]
+
+    def clear(self, platform_name: str, is_private_chat: bool, chat_id: str) -> None:
+        """删除聊天的全部记录"""
+        chat = self._chat_params(platform_name, is_private_chat, chat_id)
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM messages WHERE platform = ? AND chat_type = ? AND chat_id = ?",
+                chat,
+            )
+
+    def close(self) -> None:
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
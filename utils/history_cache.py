@@ -0,0 +1,140 @@
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from astrbot.api.all import logger
+
+
+class _ChatEntry:
+    """单个聊天的缓存条目"""
+
+    __slots__ = ("chat", "messages", "sizes", "bytes", "pending")
+
+    def __init__(self, chat: Tuple[str, bool, str], retention: int):
+        # (平台名称, 是否私聊, 聊天ID)
+        self.chat = chat
+        # 最近的消息对象及其序列化后的大小
+        self.messages: Deque[Any] = deque(maxlen=retention)
+        self.sizes: Deque[int] = deque(maxlen=retention)
+        self.bytes = 0
+        # 尚未写入磁盘的已编码记录
+        self.pending: List[Any] = []
+
+
+class HistoryCache:
+    """
+    进程级历史消息缓存
+
+    每个聊天保存一个定长队列，所有聊天共享条数和字节预算，
+    超出预算时按最近最少使用淘汰整个聊天。
+    有未写入磁盘记录的聊天不会被淘汰，等下一次刷写后再淘汰。
+    """
+
+    def __init__(self, retention: int, max_messages: int, max_bytes: int):
+        self.retention = retention
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._chats: "OrderedDict[str, _ChatEntry]" = OrderedDict()
+        self._total_messages = 0
+        self._total_bytes = 0
+
+    def __contains__(self, chat_key: str) -> bool:
+        return chat_key in self._chats
+
+    def get(self, chat_key: str) -> Optional[List[Any]]:
+        """获取缓存的消息列表，未缓存返回None"""
+        entry = self._chats.get(chat_key)
+        if entry is None:
+            return None
+        self._chats.move_to_end(chat_key)
+        return list(entry.messages)
+
+    def load(self, chat_key: str, chat: Tuple[str, bool, str], messages: List[Tuple[Any, int]], retention: Optional[int] = None) -> None:
+        """
+        放入从磁盘读取的消息
+
+        Args:
+            chat_key: 聊天唯一标识
+            chat: (平台名称, 是否私聊, 聊天ID)
+            messages: (消息对象, 序列化大小) 列表，按时间顺序
+            retention: 该聊天的队列长度，为空则使用默认值
+        """
+        self.pop(chat_key)
+        entry = _ChatEntry(chat, retention or self.retention)
+        self._chats[chat_key] = entry
+        for message, size in messages:
+            self._push(entry, message, size)
+        self._evict()
+
+    def append(self, chat_key: str, message: Any, record: Any, size: int) -> bool:
+        """
+        追加一条新消息，并记录待写入磁盘的编码结果及其大小
+
+        Returns:
+            聊天未缓存时不追加并返回False，调用方需先从磁盘载入
+        """
+        entry = self._chats.get(chat_key)
+        if entry is None:
+            return False
+        self._chats.move_to_end(chat_key)
+        self._push(entry, message, size)
+        entry.pending.append(record)
+        self._evict()
+        return True
+
+    def _push(self, entry: _ChatEntry, message: Any, size: int) -> None:
+        """向队列末尾添加消息，队列满时同步扣减被挤出的消息"""
+        if len(entry.messages) == entry.messages.maxlen:
+            dropped = entry.sizes[0]
+            entry.bytes -= dropped
+            self._total_bytes -= dropped
+            self._total_messages -= 1
+        entry.messages.append(message)
+        entry.sizes.append(size)
+        entry.bytes += size
+        self._total_bytes += size
+        self._total_messages += 1
+
+    def take_pending(self, chat_key: str) -> Tuple[Optional[Tuple[str, bool, str]], List[Any]]:
+        """取出聊天待写入的记录，返回 (聊天信息, 记录列表)"""
+        entry = self._chats.get(chat_key)
+        if entry is None or not entry.pending:
+            return None, []
+        pending, entry.pending = entry.pending, []
+        return entry.chat, pending
+
+    def restore_pending(self, chat_key: str, records: List[Any]) -> None:
+        """写入失败时把记录放回待写入队列头部"""
+        entry = self._chats.get(chat_key)
+        if entry is not None:
+            entry.pending[:0] = records
+
+    def dirty_keys(self) -> List[str]:
+        """获取所有有待写入记录的聊天"""
+        return [key for key, entry in self._chats.items() if entry.pending]
+
+    def pop(self, chat_key: str) -> None:
+        """移除聊天的缓存（包括待写入记录）"""
+        entry = self._chats.pop(chat_key, None)
+        if entry is not None:
+            self._total_messages -= len(entry.messages)
+            self._total_bytes -= entry.bytes
+
+    def _evict(self) -> None:
+        """超出预算时淘汰最近最少使用的聊天"""
+        if self._total_messages <= self.max_messages and self._total_bytes <= self.max_bytes:
+            return
+        # 不淘汰最近使用的聊天（刚载入或刚追加消息的聊天），也不淘汰还没写入磁盘的聊天
+        for chat_key in list(self._chats.keys())[:-1]:
+            if self._total_messages <= self.max_messages and self._total_bytes <= self.max_bytes:
+                break
+            if self._chats[chat_key].pending:
+                continue
+            self.pop(chat_key)
+            logger.debug(f"历史记录缓存超出预算，淘汰聊天: {chat_key}")
+
+    def stats(self) -> Dict[str, int]:
+        """缓存使用情况"""
+        return {
+            "chats": len(self._chats),
+            "messages": self._total_messages,
+            "bytes": self._total_bytes,
+        }
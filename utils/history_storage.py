@@ -1,22 +1,55 @@
 import os
+import asyncio
 import jsonpickle
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 from astrbot.api.all import *
 import time
 import traceback
+import uuid
+from .history_backends import HistoryRecord, RetentionPolicy, SegmentLogBackend, SqliteBackend
+from .history_cache import HistoryCache
+from .caption_pipeline import CaptionPipeline
+from .chat_policy import ChatPolicy
+from .image_store import ImageStore
+from .io_pool import IOPool
+from .record_codec import RecordCodec
+from .token_estimator import TokenEstimator
 
 class HistoryStorage:
     """
     历史消息存储工具类
     
     按照平台->聊天类型->ID的层级结构存储消息
-    使用jsonpickle序列化AstrBotMessage对象为JSON格式
+    AstrBotMessage对象在存储边界由RecordCodec转换为带版本号的紧凑记录，
+    存储引擎可选追加写日志文件(jsonl)或单个SQLite数据库(sqlite)
+    最近的消息常驻内存缓存，新消息先进入缓存，再由后台任务批量写入磁盘
+    同一聊天的所有修改（追加、写入、压缩、清空）通过该聊天的锁串行执行
+    超出保留策略的记录由后台压缩任务删除，写入路径只追加
+    所有阻塞的文件读写和序列化都在IOPool线程池中执行
     """
     
     # 保存配置对象的静态变量
     config = None
     # 基础存储路径
     base_storage_path = None
+    # 存储后端
+    _backend: SegmentLogBackend | SqliteBackend | None = None
+    # 是否以msgpack编码记录
+    _msgpack_records: bool = False
+    # 已检查过旧版存储文件的聊天
+    _migrated_chats: Set[str] = set()
+    # 进程级历史消息缓存
+    _cache: HistoryCache | None = None
+    # 后台刷写任务
+    _flush_task: asyncio.Task | None = None
+    # 后台维护任务（压缩历史记录、回收图片）
+    _maintenance_task: asyncio.Task | None = None
+    # 每个聊天的写入锁
+    _chat_locks: Dict[str, asyncio.Lock] = {}
+    # 是否正在登记旧版图片
+    _backfilling: bool = False
+    # 登记旧版图片期间还没统计引用的聊天，不在登记时为None
+    _backfill_uncounted: Set[str] | None = None
     
     @staticmethod
     def init(config: AstrBotConfig):
@@ -25,10 +58,21 @@ class HistoryStorage:
         # 初始化基础存储路径
         HistoryStorage.base_storage_path = os.path.join(os.getcwd(), "data", "chat_history")
         HistoryStorage._ensure_dir(HistoryStorage.base_storage_path)
+        if HistoryStorage._backend:
+            HistoryStorage._backend.close()
+        HistoryStorage._backend = HistoryStorage._create_backend()
+        HistoryStorage._msgpack_records = HistoryStorage._should_use_msgpack()
+        HistoryStorage._migrated_chats = set()
+        HistoryStorage._cache = HistoryStorage._create_cache()
+        HistoryStorage._chat_locks = {}
+        HistoryStorage._backfilling = False
+        HistoryStorage._backfill_uncounted = None
+        images_dir = HistoryStorage._get_images_dir()
+        ImageStore.init(images_dir, os.path.join(os.path.dirname(images_dir), "images.db"))
         logger.info(f"消息存储路径初始化: {HistoryStorage.base_storage_path}")
         
-        # 配置jsonpickle
-        jsonpickle.set_encoder_options('json', ensure_ascii=False, indent=2)
+        # 配置jsonpickle，用于读取旧版记录和保存不认识的消息组件
+        jsonpickle.set_encoder_options('json', ensure_ascii=False)
         jsonpickle.set_preferred_backend('json')
     
     @staticmethod
@@ -38,20 +82,642 @@ class HistoryStorage:
             os.makedirs(directory, exist_ok=True)
     
     @staticmethod
-    def _get_storage_path(platform_name: str, is_private_chat: bool, chat_id: str) -> str:
-        """获取存储路径"""
-        if not HistoryStorage.base_storage_path:
+    def _create_backend() -> SegmentLogBackend | SqliteBackend:
+        """根据配置的存储引擎创建存储后端"""
+        engine = HistoryStorage._get_storage_config().get("engine", "jsonl")
+        if engine == "sqlite":
+            db_path = os.path.join(HistoryStorage.base_storage_path, "history.db")
+            return SqliteBackend(db_path)
+        return SegmentLogBackend(HistoryStorage.base_storage_path)
+
+    @staticmethod
+    def _get_backend() -> SegmentLogBackend | SqliteBackend:
+        """获取存储后端"""
+        if not HistoryStorage._backend:
             # 确保基础路径已初始化，未初始化则初始化一次
-            HistoryStorage.base_storage_path = os.path.join(os.getcwd(), "data", "chat_history")
-            HistoryStorage._ensure_dir(HistoryStorage.base_storage_path)
-            logger.info(f"消息存储路径初始化: {HistoryStorage.base_storage_path}")
-            
+            if not HistoryStorage.base_storage_path:
+                HistoryStorage.base_storage_path = os.path.join(os.getcwd(), "data", "chat_history")
+                HistoryStorage._ensure_dir(HistoryStorage.base_storage_path)
+                logger.info(f"消息存储路径初始化: {HistoryStorage.base_storage_path}")
+            HistoryStorage._backend = HistoryStorage._create_backend()
+        return HistoryStorage._backend
+
+    @staticmethod
+    def _should_use_msgpack() -> bool:
+        """是否以msgpack编码记录，仅sqlite引擎支持二进制记录"""
+        if HistoryStorage._get_storage_config().get("record_encoding", "json") != "msgpack":
+            return False
+        if not isinstance(HistoryStorage._backend, SqliteBackend):
+            logger.warning("msgpack记录编码仅支持sqlite存储引擎，将使用JSON编码")
+            return False
+        if not RecordCodec.msgpack_available():
+            logger.warning("未安装msgpack，将使用JSON编码历史记录")
+            return False
+        return True
+
+    @staticmethod
+    def _get_storage_config() -> dict:
+        """获取存储相关配置"""
+        if not HistoryStorage.config:
+            return {}
+        return HistoryStorage.config.get("storage", {})
+
+    @staticmethod
+    def _get_policy() -> ChatPolicy:
+        """获取编译后的聊天策略"""
+        return ChatPolicy.current(HistoryStorage.config)
+
+    @staticmethod
+    def _get_retention(is_private_chat: bool, chat_id: str) -> RetentionPolicy:
+        """获取聊天的保留策略，按群覆盖的配置由聊天策略解析"""
+        return HistoryStorage._get_policy().rule(is_private_chat, chat_id).retention
+
+    @staticmethod
+    def _create_cache() -> HistoryCache:
+        """根据配置创建历史消息缓存"""
+        storage_config = HistoryStorage._get_storage_config()
+        max_messages = storage_config.get("cache_max_messages", 20000)
+        max_mb = storage_config.get("cache_max_mb", 64)
+        retention = HistoryStorage._get_policy().retention
+        return HistoryCache(
+            retention=retention.max_messages,
+            max_messages=max(max_messages, retention.max_messages),
+            max_bytes=max(max_mb, 1) * 1024 * 1024,
+        )
+
+    @staticmethod
+    def _get_cache() -> HistoryCache:
+        """获取历史消息缓存"""
+        if not HistoryStorage._cache:
+            HistoryStorage._cache = HistoryStorage._create_cache()
+        return HistoryStorage._cache
+
+    @staticmethod
+    def _get_chat_key(platform_name: str, is_private_chat: bool, chat_id: str) -> str:
+        """获取聊天的唯一标识"""
         chat_type = "private" if is_private_chat else "group"
-        directory = os.path.join(HistoryStorage.base_storage_path, platform_name, chat_type)
-        
-        HistoryStorage._ensure_dir(directory)
-        return os.path.join(directory, f"{chat_id}.json")
+        return f"{platform_name}_{chat_type}_{chat_id}"
+
+    @staticmethod
+    def _get_chat_lock(chat_key: str) -> asyncio.Lock:
+        """获取聊天的写入锁，保证同一聊天的修改按顺序执行"""
+        lock = HistoryStorage._chat_locks.get(chat_key)
+        if lock is None:
+            lock = asyncio.Lock()
+            HistoryStorage._chat_locks[chat_key] = lock
+        return lock
+
+    @staticmethod
+    def _encode_record(message: AstrBotMessage) -> HistoryRecord:
+        """将消息对象编码为一条紧凑历史记录，同时计算消息的token估算值"""
+        message.token_estimate = TokenEstimator.estimate_message(message)
+        timestamp = getattr(message, "timestamp", None) or int(time.time())
+        message_id = str(getattr(message, "message_id", "") or "")
+        data = RecordCodec.dumps(message, use_msgpack=HistoryStorage._msgpack_records)
+        return HistoryRecord(int(timestamp), message_id, data)
+
+    @staticmethod
+    def _read_history_file(file_path: str) -> List[AstrBotMessage]:
+        """
+        读取单个历史记录文件（阻塞，在线程池中执行）
+
+        支持旧版整文件存储的 .json 和追加写日志 .jsonl（紧凑记录或旧版jsonpickle记录）
+
+        Returns:
+            按时间顺序排列的消息列表
+        """
+        if file_path.endswith(".jsonl"):
+            messages = []
+            with open(file_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if not line.strip():
+                        continue
+                    try:
+                        messages.append(RecordCodec.loads(line))
+                    except Exception as e:
+                        logger.warning(f"跳过无法解析的历史记录: {e}")
+            return messages
+
+        with open(file_path, "r", encoding="utf-8") as f:
+            return jsonpickle.decode(f.read()) or []
+
+    @staticmethod
+    def _needs_conversion(records: List[str | bytes]) -> bool:
+        """是否存在尚未转换为当前紧凑格式的记录"""
+        return any(not RecordCodec.is_current(record) for record in records)
+
+    @staticmethod
+    def _migrate_legacy_history(platform_name: str, is_private_chat: bool, chat_id: str) -> None:
+        """
+        将旧版整文件存储的 {chat_id}.json 合并到追加写日志
+
+        仅在使用jsonl引擎时生效，每个聊天只检查一次，转换成功后删除旧文件
+        """
+        backend = HistoryStorage._get_backend()
+        if not isinstance(backend, SegmentLogBackend):
+            return
+
+        chat_key = HistoryStorage._get_chat_key(platform_name, is_private_chat, chat_id)
+        if chat_key in HistoryStorage._migrated_chats:
+            return
+        HistoryStorage._migrated_chats.add(chat_key)
+
+        legacy_path = backend.get_legacy_path(platform_name, is_private_chat, chat_id)
+        if not os.path.exists(legacy_path):
+            return
+
+        try:
+            messages = HistoryStorage._read_history_file(legacy_path)
+            log_path = backend.get_log_path(platform_name, is_private_chat, chat_id)
+            if os.path.exists(log_path):
+                # 旧文件中的记录早于日志中的记录
+                messages += HistoryStorage._read_history_file(log_path)
+            records = [HistoryStorage._encode_record(message) for message in messages]
+            backend.replace_records(platform_name, is_private_chat, chat_id, records)
+            os.remove(legacy_path)
+            logger.info(f"已将旧版历史记录转换为日志格式: {legacy_path}，共 {len(records)} 条")
+        except Exception as e:
+            logger.error(f"转换旧版历史记录失败: {e}")
+            logger.debug(traceback.format_exc())
+
+    @staticmethod
+    def _find_history_files() -> Dict[Tuple[str, bool, str], List[str]]:
+        """
+        查找数据目录下所有历史记录文件（阻塞，在线程池中执行）
+
+        Returns:
+            {(平台名称, 是否私聊, 聊天ID): [文件路径, ...]}，旧版 .json 排在 .jsonl 之前
+        """
+        found: Dict[Tuple[str, bool, str], List[str]] = {}
+        base_path = HistoryStorage.base_storage_path
+        if not base_path or not os.path.isdir(base_path):
+            return found
+
+        for platform_name in os.listdir(base_path):
+            platform_dir = os.path.join(base_path, platform_name)
+            if not os.path.isdir(platform_dir) or platform_name == "images":
+                continue
+            for chat_type in ("group", "private"):
+                chat_dir = os.path.join(platform_dir, chat_type)
+                if not os.path.isdir(chat_dir):
+                    continue
+                for filename in sorted(os.listdir(chat_dir)):
+                    chat_id, ext = os.path.splitext(filename)
+                    if ext not in (".json", ".jsonl"):
+                        continue
+                    chat = (platform_name, chat_type == "private", chat_id)
+                    found.setdefault(chat, []).append(os.path.join(chat_dir, filename))
+
+        for paths in found.values():
+            paths.sort(key=lambda path: path.endswith(".jsonl"))
+        return found
+
+    @staticmethod
+    def _import_history_files(platform_name: str, is_private_chat: bool, chat_id: str, paths: List[str]) -> int:
+        """
+        将聊天的历史记录文件导入当前存储引擎（阻塞，在线程池中执行）
+
+        jsonl引擎下合并旧版 .json 文件，并把仍是jsonpickle格式的日志重写为紧凑记录；
+        sqlite引擎下导入全部文件，导入后的文件重命名为 .migrated 保留备份
+
+        Returns:
+            导入或转换的记录条数
+        """
+        backend = HistoryStorage._get_backend()
+        if isinstance(backend, SegmentLogBackend):
+            legacy_path = backend.get_legacy_path(platform_name, is_private_chat, chat_id)
+            if legacy_path not in paths:
+                lines = backend.load(platform_name, is_private_chat, chat_id)
+                if not HistoryStorage._needs_conversion(lines):
+                    return 0
+
+        messages: List[AstrBotMessage] = []
+        for path in paths:
+            messages += HistoryStorage._read_history_file(path)
+        records = [HistoryStorage._encode_record(message) for message in messages]
+
+        if isinstance(backend, SegmentLogBackend):
+            backend.replace_records(platform_name, is_private_chat, chat_id, records)
+            legacy_path = backend.get_legacy_path(platform_name, is_private_chat, chat_id)
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+        else:
+            backend.import_records(platform_name, is_private_chat, chat_id, records)
+            for path in paths:
+                os.replace(path, path + ".migrated")
+        return len(records)
+
+    @staticmethod
+    def _convert_backend_chat(platform_name: str, is_private_chat: bool, chat_id: str) -> int:
+        """
+        将sqlite中仍为旧格式的记录重写为当前的紧凑格式（阻塞，在线程池中执行）
+
+        Returns:
+            转换的记录条数
+        """
+        backend = HistoryStorage._get_backend()
+        rows = backend.load(platform_name, is_private_chat, chat_id)
+        if not HistoryStorage._needs_conversion(rows):
+            return 0
+        messages = [RecordCodec.loads(row) for row in rows]
+        records = [HistoryStorage._encode_record(message) for message in messages]
+        backend.replace_records(platform_name, is_private_chat, chat_id, records)
+        return len(records)
+
+    @staticmethod
+    async def migrate_history_files() -> Tuple[int, int]:
+        """
+        将数据目录中的历史记录文件导入当前存储引擎，并把旧格式记录转换为紧凑格式
+
+        Returns:
+            (导入或转换的聊天数, 导入或转换的记录条数)
+        """
+        # 先把内存中的记录写入，再按聊天逐个导入
+        await HistoryStorage.flush_all()
+        found = await IOPool.run(HistoryStorage._find_history_files)
+        tasks = [(chat, HistoryStorage._import_history_files, (*chat, paths)) for chat, paths in found.items()]
+
+        backend = HistoryStorage._get_backend()
+        if isinstance(backend, SqliteBackend):
+            chats = await IOPool.run(backend.list_chats)
+            tasks += [(chat, HistoryStorage._convert_backend_chat, chat) for chat in chats if chat not in found]
+
+        chat_count = 0
+        record_count = 0
+        cache = HistoryStorage._get_cache()
+        for chat, func, args in tasks:
+            chat_key = HistoryStorage._get_chat_key(*chat)
+            async with HistoryStorage._get_chat_lock(chat_key):
+                try:
+                    imported = await IOPool.run(func, *args)
+                except Exception as e:
+                    logger.error(f"迁移聊天 {chat_key} 的历史记录失败: {e}")
+                    logger.debug(traceback.format_exc())
+                    continue
+                # 导入后缓存中的内容已过期，下次读取时重新载入
+                cache.pop(chat_key)
+            if imported:
+                chat_count += 1
+                record_count += imported
+
+        logger.info(f"历史记录迁移完成: {chat_count} 个聊天，{record_count} 条记录")
+        return chat_count, record_count
     
+    @staticmethod
+    def _read_chat(platform_name: str, is_private_chat: bool, chat_id: str, limit: Optional[int] = None) -> List[tuple]:
+        """
+        读取并解码聊天的历史记录（阻塞，在线程池中执行）
+
+        Args:
+            limit: 只读取最后若干条，为空则读取整个保留窗口
+
+        Returns:
+            (消息对象, 序列化大小) 列表
+        """
+        HistoryStorage._migrate_legacy_history(platform_name, is_private_chat, chat_id)
+        if limit is None:
+            limit = HistoryStorage._get_retention(is_private_chat, chat_id).max_messages
+        records = HistoryStorage._get_backend().load(
+            platform_name, is_private_chat, chat_id, limit=limit
+        )
+
+        loaded = []
+        for record in records:
+            try:
+                loaded.append((RecordCodec.loads(record), len(record)))
+            except Exception as e:
+                # 跳过损坏的记录（如写入中途崩溃留下的半行）
+                logger.warning(f"跳过无法解析的历史记录: {e}")
+        return loaded
+
+    @staticmethod
+    async def _load_chat(platform_name: str, is_private_chat: bool, chat_id: str) -> List[AstrBotMessage]:
+        """从磁盘读取聊天的历史记录并放入缓存，调用方需持有该聊天的锁"""
+        loaded = await IOPool.run(HistoryStorage._read_chat, platform_name, is_private_chat, chat_id)
+
+        chat_key = HistoryStorage._get_chat_key(platform_name, is_private_chat, chat_id)
+        cache = HistoryStorage._get_cache()
+        retention = HistoryStorage._get_retention(is_private_chat, chat_id).max_messages
+        cache.load(chat_key, (platform_name, is_private_chat, chat_id), loaded, retention)
+        return [message for message, _ in loaded]
+
+    @staticmethod
+    async def flush_chat(chat_key: str) -> bool:
+        """
+        将聊天缓存中待写入的记录一次性追加到磁盘
+
+        排在锁后面的调用者会发现自己的记录已经被前一次写入带走，直接返回，
+        因此突发消息会被合并成一次写入
+
+        Args:
+            chat_key: 聊天唯一标识
+
+        Returns:
+            是否写入成功
+        """
+        async with HistoryStorage._get_chat_lock(chat_key):
+            return await HistoryStorage._write_pending(chat_key)
+
+    @staticmethod
+    async def _write_pending(chat_key: str) -> bool:
+        """写入聊天待写入的记录，调用方需持有该聊天的锁"""
+        cache = HistoryStorage._get_cache()
+        chat, records = cache.take_pending(chat_key)
+        if not records:
+            return True
+        try:
+            platform_name, is_private_chat, chat_id = chat
+            await IOPool.run(
+                HistoryStorage._get_backend().append,
+                platform_name, is_private_chat, chat_id, records
+            )
+            return True
+        except Exception as e:
+            # 写入失败时放回队列，等待下次刷写
+            cache.restore_pending(chat_key, records)
+            logger.error(f"写入历史记录失败: {e}")
+            logger.debug(traceback.format_exc())
+            return False
+
+    @staticmethod
+    async def flush_all() -> None:
+        """将所有聊天待写入的记录写入磁盘"""
+        for chat_key in HistoryStorage._get_cache().dirty_keys():
+            await HistoryStorage.flush_chat(chat_key)
+
+    @staticmethod
+    async def _flush_loop(interval: float) -> None:
+        """后台定时刷写任务"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await HistoryStorage.flush_all()
+            except Exception as e:
+                logger.error(f"定时写入历史记录时发生错误: {e}")
+
+    @staticmethod
+    def _ensure_flush_task(interval: float) -> None:
+        """确保后台刷写任务已启动"""
+        task = HistoryStorage._flush_task
+        if task is None or task.done():
+            HistoryStorage._flush_task = asyncio.get_running_loop().create_task(
+                HistoryStorage._flush_loop(interval)
+            )
+
+    @staticmethod
+    def _get_images_dir() -> str:
+        """图片持久化目录（使用 AstrBot 的数据路径，兼容 Docker）"""
+        from astrbot.core.utils.astrbot_path import get_astrbot_data_path
+        return os.path.join(get_astrbot_data_path(), "chat_history", "images")
+
+    @staticmethod
+    def _message_image_paths(messages: List[AstrBotMessage]) -> List[str]:
+        """获取消息中引用的持久化图片路径，每条引用出现一次"""
+        images_dir = os.path.abspath(HistoryStorage._get_images_dir())
+        paths = []
+        for message in messages:
+            for component in getattr(message, "message", None) or []:
+                if isinstance(component, Image) and component.file and component.file.startswith("file:///"):
+                    path = os.path.abspath(component.file[8:])
+                    if path.startswith(images_dir + os.sep):
+                        paths.append(path)
+        return paths
+
+    @staticmethod
+    def _persisted_image_paths(records: List[str | bytes]) -> List[str]:
+        """获取记录中引用的持久化图片路径，每条引用出现一次"""
+        messages = []
+        for record in records:
+            try:
+                messages.append(RecordCodec.loads(record))
+            except Exception:
+                continue
+        return HistoryStorage._message_image_paths(messages)
+
+    @staticmethod
+    def _release_images(records: List[str | bytes]) -> None:
+        """释放被删除记录引用的图片，图片由垃圾回收在超过保留天数后删除（阻塞，在线程池中执行）"""
+        image_paths = HistoryStorage._persisted_image_paths(records)
+        if image_paths:
+            ImageStore.release(image_paths)
+
+    @staticmethod
+    def _compact_chat(platform_name: str, is_private_chat: bool, chat_id: str) -> int:
+        """
+        按保留策略压缩聊天的历史记录，并释放已删除记录引用的图片（阻塞，在线程池中执行）
+
+        Returns:
+            删除的记录条数
+        """
+        backend = HistoryStorage._get_backend()
+        policy = HistoryStorage._get_retention(is_private_chat, chat_id)
+        dropped = backend.compact(platform_name, is_private_chat, chat_id, policy)
+        if dropped:
+            HistoryStorage._release_images(dropped)
+        return len(dropped)
+
+    @staticmethod
+    def _clear_chat(platform_name: str, is_private_chat: bool, chat_id: str, pending: List[str | bytes]) -> None:
+        """删除聊天的全部记录并释放其引用的图片（阻塞，在线程池中执行）"""
+        backend = HistoryStorage._get_backend()
+        records = backend.load(platform_name, is_private_chat, chat_id) + pending
+        backend.clear(platform_name, is_private_chat, chat_id)
+        HistoryStorage._release_images(records)
+
+    @staticmethod
+    async def compact_all() -> int:
+        """
+        按保留策略压缩所有聊天的历史记录
+
+        Returns:
+            删除的记录条数
+        """
+        backend = HistoryStorage._get_backend()
+        chats = await IOPool.run(backend.list_chats)
+        cache = HistoryStorage._get_cache()
+        record_count = 0
+        for chat in chats:
+            chat_key = HistoryStorage._get_chat_key(*chat)
+            async with HistoryStorage._get_chat_lock(chat_key):
+                # 先写入内存中的记录，压缩时看到的是完整的历史
+                if not await HistoryStorage._write_pending(chat_key):
+                    continue
+                try:
+                    dropped = await IOPool.run(HistoryStorage._compact_chat, *chat)
+                except Exception as e:
+                    logger.error(f"压缩聊天 {chat_key} 的历史记录失败: {e}")
+                    logger.debug(traceback.format_exc())
+                    continue
+                if dropped:
+                    # 缓存中可能还有已删除的记录，下次读取时重新载入
+                    cache.pop(chat_key)
+            record_count += dropped
+
+        if record_count:
+            logger.info(f"历史记录压缩完成: 删除 {record_count} 条记录")
+        return record_count
+
+    @staticmethod
+    def _list_reference_sources() -> Dict[Tuple[str, bool, str], List[str]]:
+        """
+        列出所有可能引用图片的聊天（阻塞，在线程池中执行）
+
+        Returns:
+            {(平台名称, 是否私聊, 聊天ID): [尚未导入存储引擎的历史记录文件, ...]}
+        """
+        backend = HistoryStorage._get_backend()
+        sources: Dict[Tuple[str, bool, str], List[str]] = {chat: [] for chat in backend.list_chats()}
+        for chat, paths in HistoryStorage._find_history_files().items():
+            if isinstance(backend, SegmentLogBackend):
+                # jsonl引擎下 .jsonl 就是存储引擎中的记录，只有旧版 .json 需要单独读取
+                paths = [path for path in paths if path.endswith(".json")]
+            if paths:
+                sources.setdefault(chat, []).extend(paths)
+        return sources
+
+    @staticmethod
+    def _count_chat_image_references(platform_name: str, is_private_chat: bool, chat_id: str, paths: List[str]) -> List[str]:
+        """
+        获取聊天所有记录引用的持久化图片路径，包括尚未导入的旧版文件（阻塞，在线程池中执行）
+
+        先读旧版文件再读存储引擎：读取期间旧版文件被转换时只会多算引用，不会漏算
+        """
+        image_paths = []
+        for path in paths:
+            try:
+                image_paths += HistoryStorage._message_image_paths(HistoryStorage._read_history_file(path))
+            except FileNotFoundError:
+                continue
+        backend = HistoryStorage._get_backend()
+        image_paths += HistoryStorage._persisted_image_paths(backend.load(platform_name, is_private_chat, chat_id))
+        return image_paths
+
+    @staticmethod
+    async def backfill_image_index() -> bool:
+        """
+        将旧版按uuid命名的图片及其引用数登记到图片索引，只执行一次
+
+        逐个聊天持有聊天锁写入内存中的记录后统计引用。统计期间保存的消息如果引用了
+        尚未登记的旧版图片：所在聊天还没统计时由之后的统计计入，否则暂存到登记时一并计入
+
+        Returns:
+            图片索引是否已完成登记，已有登记在进行时返回False
+        """
+        if HistoryStorage._backfilling:
+            return False
+        HistoryStorage._backfilling = True
+        try:
+            if not await IOPool.run(ImageStore.needs_backfill):
+                return True
+            sources = await IOPool.run(HistoryStorage._list_reference_sources)
+            uncounted = {HistoryStorage._get_chat_key(*chat) for chat in sources}
+            HistoryStorage._backfill_uncounted = uncounted
+            ImageStore.begin_backfill()
+            counts: Dict[str, int] = {}
+            for chat, paths in sources.items():
+                chat_key = HistoryStorage._get_chat_key(*chat)
+                async with HistoryStorage._get_chat_lock(chat_key):
+                    if not await HistoryStorage._write_pending(chat_key):
+                        raise OSError(f"写入聊天 {chat_key} 的历史记录失败")
+                    for path in await IOPool.run(HistoryStorage._count_chat_image_references, *chat, paths):
+                        counts[path] = counts.get(path, 0) + 1
+                    uncounted.discard(chat_key)
+            count = await IOPool.run(ImageStore.backfill_legacy, counts)
+        finally:
+            HistoryStorage._backfilling = False
+            HistoryStorage._backfill_uncounted = None
+            ImageStore.end_backfill()
+        logger.info(f"已将 {count} 张旧版图片登记到图片索引")
+        return True
+
+    @staticmethod
+    def _defer_legacy_refs(chat_key: str) -> bool:
+        """
+        聊天对尚未登记的旧版图片的新引用是否需要暂存
+
+        正在登记旧版图片、且该聊天已经统计过引用（或是统计开始后才出现的聊天）时需要暂存，
+        否则新记录会由之后的统计计入
+        """
+        uncounted = HistoryStorage._backfill_uncounted
+        return uncounted is not None and chat_key not in uncounted
+
+    @staticmethod
+    async def collect_images() -> int:
+        """
+        删除没有被历史记录引用且超过保留天数的图片
+
+        旧版图片登记到索引之前不回收，避免引用数不完整时误删图片
+
+        Returns:
+            删除的图片数
+        """
+        if await IOPool.run(ImageStore.needs_backfill):
+            logger.debug("旧版图片尚未登记到图片索引，跳过图片清理")
+            return 0
+
+        image_processing_config = HistoryStorage.config.get("image_processing", {}) if HistoryStorage.config else {}
+        retention_days = image_processing_config.get("image_retention_days", 7)
+        if retention_days < 1 or retention_days > 365:
+            logger.warning(f"图片保留天数配置无效: {retention_days}，使用默认值7天")
+            retention_days = 7
+
+        removed = await IOPool.run(ImageStore.collect_garbage, retention_days)
+        if removed:
+            logger.info(f"图片清理完成，清理了 {removed} 张没有引用且超过 {retention_days} 天的图片")
+        return removed
+
+    @staticmethod
+    async def _maintenance_loop(interval: float) -> None:
+        """后台定时维护任务：登记旧版图片，按保留策略压缩历史记录，再回收没有引用的图片"""
+        backfilled = False
+        while True:
+            if not backfilled:
+                # 登记失败时下次维护重试，登记完成之前不压缩也不回收图片
+                try:
+                    backfilled = await HistoryStorage.backfill_image_index()
+                except Exception as e:
+                    logger.error(f"登记旧版图片时发生错误: {e}")
+                    logger.debug(traceback.format_exc())
+            await asyncio.sleep(interval)
+            if not backfilled:
+                continue
+            try:
+                await HistoryStorage.compact_all()
+                await HistoryStorage.collect_images()
+            except Exception as e:
+                logger.error(f"定时维护历史记录时发生错误: {e}")
+
+    @staticmethod
+    def _ensure_maintenance_task() -> None:
+        """确保后台维护任务已启动"""
+        task = HistoryStorage._maintenance_task
+        if task is None or task.done():
+            interval = HistoryStorage._get_storage_config().get("compaction_interval", 10)
+            HistoryStorage._maintenance_task = asyncio.get_running_loop().create_task(
+                HistoryStorage._maintenance_loop(max(1, interval) * 60)
+            )
+
+    @staticmethod
+    async def shutdown() -> None:
+        """停止后台任务并写入所有未保存的记录，在插件卸载时调用"""
+        tasks = (HistoryStorage._flush_task, HistoryStorage._maintenance_task)
+        HistoryStorage._flush_task = None
+        HistoryStorage._maintenance_task = None
+        for task in tasks:
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        await HistoryStorage.flush_all()
+        if HistoryStorage._backend:
+            HistoryStorage._backend.close()
+            HistoryStorage._backend = None
+        ImageStore.close()
+        logger.info("历史记录已全部写入磁盘")
+
     @staticmethod
     def _sanitize_message(message: AstrBotMessage) -> AstrBotMessage:
         """
@@ -87,6 +753,8 @@ class HistoryStorage:
         Returns:
             是否保存成功
         """
+        # 这条消息增加了引用的图片，记录进入缓存之前失败时释放
+        image_refs: List[str] = []
         try:
             # 判断是群聊还是私聊
             is_private_chat = not bool(message.group_id)
@@ -98,47 +766,44 @@ class HistoryStorage:
             else:
                 chat_id = message.group_id
                 
-            # 获取存储路径
-            file_path = HistoryStorage._get_storage_path(platform_name, is_private_chat, chat_id)
-            
-            # 读取现有历史记录
-            history = HistoryStorage.get_history(platform_name, is_private_chat, chat_id)
-            if not history:
-                history = []
-                
-            # 处理图片持久化存储
-            await HistoryStorage._process_image_persistence(message)
-
-            # 清理消息对象，并添加到历史记录
-            sanitized_message = HistoryStorage._sanitize_message(message)
-            history.append(sanitized_message)
+            chat_key = HistoryStorage._get_chat_key(platform_name, is_private_chat, chat_id)
 
-            # 限制历史记录数量
-            if len(history) > 200:
-                history = history[-200:]
+            # 持有聊天锁完成图片处理和追加，保证同一聊天的消息按到达顺序入库
+            async with HistoryStorage._get_chat_lock(chat_key):
+                # 处理图片持久化存储
+                await HistoryStorage._process_image_persistence(message, chat_key, image_refs)
 
-            # 确保父目录存在
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                # 清理消息对象，并编码为紧凑记录
+                sanitized_message = HistoryStorage._sanitize_message(message)
+                record = await IOPool.run(HistoryStorage._encode_record, sanitized_message)
 
-            # 使用jsonpickle序列化对象
-            json_data = jsonpickle.encode(history, unpicklable=True)
+                # 冷启动或已被淘汰的聊天先从磁盘载入缓存再追加
+                cache = HistoryStorage._get_cache()
+                if not cache.append(chat_key, sanitized_message, record, len(record.data)):
+                    await HistoryStorage._load_chat(platform_name, is_private_chat, chat_id)
+                    if not cache.append(chat_key, sanitized_message, record, len(record.data)):
+                        raise RuntimeError(f"聊天 {chat_key} 载入后未能放入缓存")
+                # 记录已进入缓存，图片引用由记录持有
+                image_refs = []
 
-            # 写入文件
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(json_data)
-
-            # 随机执行清理操作（避免每次都执行，减少性能影响）
-            import random
-            if random.random() < 0.05:  # 5% 的概率执行清理
-                try:
-                    HistoryStorage._cleanup_old_images()
-                except Exception as e:
-                    logger.error(f"执行图片清理时发生错误: {e}")
+            # 写入磁盘：间隔为0时立即写入，否则交给后台任务批量写入
+            flush_interval = HistoryStorage._get_storage_config().get("flush_interval", 3)
+            if flush_interval <= 0:
+                if not await HistoryStorage.flush_chat(chat_key):
+                    return False
+            else:
+                HistoryStorage._ensure_flush_task(flush_interval)
+            HistoryStorage._ensure_maintenance_task()
 
             return True
         except Exception as e:
             logger.error(f"保存消息历史记录失败: {e}")
             logger.debug(traceback.format_exc())
+            if image_refs:
+                try:
+                    await IOPool.run(ImageStore.release, image_refs)
+                except Exception as release_error:
+                    logger.error(f"释放未保存消息的图片引用失败: {release_error}")
             return False
     
     @staticmethod
@@ -157,24 +822,10 @@ class HistoryStorage:
             return False
             
         is_private = event.is_private_chat()
-        if is_private:
-            return HistoryStorage.config.get("enabled_private", False)
-        else:
-            group_id = event.get_group_id()
-            if not group_id:
-                return False
-            group_id = str(group_id).strip()
-            
-            # 获取配置集合并规范化 (O(1) 查找)
-            blocked_groups = {str(g).strip() for g in HistoryStorage.config.get("blocked_groups", []) if str(g).strip()}
-            enabled_groups = {str(g).strip() for g in HistoryStorage.config.get("enabled_groups", []) if str(g).strip()}
-
-            # 优先级: 黑名单 > 全局开关 > 白名单
-            if group_id in blocked_groups:
-                return False
-            if HistoryStorage.config.get("enable_all_groups", False):
-                return True
-            return group_id in enabled_groups
+        chat_id = event.get_sender_id() if is_private else event.get_group_id()
+        if not is_private and not chat_id:
+            return False
+        return HistoryStorage._get_policy().store_allowed(is_private, chat_id)
     
     @staticmethod
     async def process_and_save_user_message(event: AstrMessageEvent) -> None:
@@ -200,6 +851,8 @@ class HistoryStorage:
         chat_type = "私聊" if event.is_private_chat() else "群聊"
         if success:
             logger.debug(f"已保存{chat_type}消息到历史记录")
+            # 提前转述消息中的图片，构建上下文时直接使用缓存的描述
+            CaptionPipeline.submit(event)
         else:
             logger.error(f"保存{chat_type}消息失败")
     
@@ -240,7 +893,8 @@ class HistoryStorage:
         # 设置其他必要字段
         msg.self_id = event.message_obj.self_id if hasattr(event.message_obj, "self_id") else "bot"
         msg.session_id = event.session_id
-        msg.message_id = f"bot_{int(time.time())}"  # 创建一个唯一的消息ID
+        # 同一秒内可能发出多条消息，加上随机后缀保证消息ID唯一
+        msg.message_id = f"bot_{int(time.time())}_{uuid.uuid4().hex[:8]}"
         
         return msg
     
@@ -274,7 +928,7 @@ class HistoryStorage:
             return False
     
     @staticmethod
-    def get_history(platform_name: str, is_private_chat: bool, chat_id: str) -> List[AstrBotMessage]:
+    async def get_history(platform_name: str, is_private_chat: bool, chat_id: str) -> List[AstrBotMessage]:
         """
         获取历史消息记录
         
@@ -287,23 +941,64 @@ class HistoryStorage:
             历史消息列表
         """
         try:
-            file_path = HistoryStorage._get_storage_path(platform_name, is_private_chat, chat_id)
-            
-            if not os.path.exists(file_path):
-                return []
-            
-            with open(file_path, "r", encoding="utf-8") as f:
-                # 使用jsonpickle反序列化JSON数据
-                history = jsonpickle.decode(f.read())
-                
-            return history
+            # 优先从内存缓存读取
+            chat_key = HistoryStorage._get_chat_key(platform_name, is_private_chat, chat_id)
+            history = HistoryStorage._get_cache().get(chat_key)
+            if history is not None:
+                return history
+
+            async with HistoryStorage._get_chat_lock(chat_key):
+                # 等锁期间可能已被其他调用载入
+                history = HistoryStorage._get_cache().get(chat_key)
+                if history is not None:
+                    return history
+                return await HistoryStorage._load_chat(platform_name, is_private_chat, chat_id)
         except Exception as e:
             logger.error(f"读取消息历史记录失败: {e}")
             logger.debug(traceback.format_exc())
             return []
     
     @staticmethod
-    def clear_history(platform_name: str, is_private_chat: bool, chat_id: str) -> bool:
+    async def get_recent(platform_name: str, is_private_chat: bool, chat_id: str, n: int) -> List[AstrBotMessage]:
+        """
+        获取最近的n条历史消息
+
+        已缓存的聊天直接从缓存截取；未缓存时只从存储末尾读取并解码n条记录，
+        不载入整个保留窗口，也不放入缓存
+
+        Args:
+            platform_name: 平台名称
+            is_private_chat: 是否为私聊
+            chat_id: 聊天ID
+            n: 需要的消息条数
+
+        Returns:
+            按时间顺序排列的最近n条消息
+        """
+        if n <= 0:
+            return []
+        try:
+            chat_key = HistoryStorage._get_chat_key(platform_name, is_private_chat, chat_id)
+            history = HistoryStorage._get_cache().get(chat_key)
+            if history is not None:
+                return history[-n:]
+
+            async with HistoryStorage._get_chat_lock(chat_key):
+                history = HistoryStorage._get_cache().get(chat_key)
+                if history is not None:
+                    return history[-n:]
+                loaded = await IOPool.run(
+                    HistoryStorage._read_chat, platform_name, is_private_chat, chat_id,
+                    min(n, HistoryStorage._get_retention(is_private_chat, chat_id).max_messages)
+                )
+                return [message for message, _ in loaded]
+        except Exception as e:
+            logger.error(f"读取最近消息记录失败: {e}")
+            logger.debug(traceback.format_exc())
+            return []
+
+    @staticmethod
+    async def clear_history(platform_name: str, is_private_chat: bool, chat_id: str) -> bool:
         """
         清空历史消息记录
         
@@ -316,25 +1011,33 @@ class HistoryStorage:
             是否清空成功
         """
         try:
-            file_path = HistoryStorage._get_storage_path(platform_name, is_private_chat, chat_id)
-            
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                
+            # 连同未写入磁盘的记录一起丢弃，持有锁避免与正在进行的写入交错
+            chat_key = HistoryStorage._get_chat_key(platform_name, is_private_chat, chat_id)
+            async with HistoryStorage._get_chat_lock(chat_key):
+                cache = HistoryStorage._get_cache()
+                _, pending = cache.take_pending(chat_key)
+                cache.pop(chat_key)
+                await IOPool.run(
+                    HistoryStorage._clear_chat, platform_name, is_private_chat, chat_id,
+                    [record.data for record in pending]
+                )
             return True
         except Exception as e:
             logger.error(f"清空消息历史记录失败: {e}")
             return False
 
     @staticmethod
-    async def _process_image_persistence(message: AstrBotMessage) -> None:
+    async def _process_image_persistence(message: AstrBotMessage, chat_key: str, image_refs: List[str]) -> None:
         """
         处理消息中的图片持久化存储
 
-        将图片保存为文件并在 file 字段中存储相对路径
+        将图片存入内容寻址的图片存储，并在 file 字段中存储其路径，
+        相同内容的图片只保存一份，每条记录增加一次引用
 
         Args:
             message: AstrBot消息对象
+            chat_key: 消息所在聊天的唯一标识，调用方需持有该聊天的锁
+            image_refs: 增加了引用的图片路径会追加到这里，记录没能保存时由调用方释放
         """
         try:
             # 检查是否启用图片持久化存储
@@ -350,16 +1053,13 @@ class HistoryStorage:
             if not hasattr(message, 'message') or not message.message:
                 return
 
-            # 确保图片存储目录存在（使用 AstrBot 的数据路径，兼容 Docker）
-            from astrbot.core.utils.astrbot_path import get_astrbot_data_path
-            astrbot_data_path = get_astrbot_data_path()
-            images_dir = os.path.join(astrbot_data_path, "chat_history", "images")
-            HistoryStorage._ensure_dir(images_dir)
-
             for component in message.message:
                 if isinstance(component, Image):
                     # 检查是否已经是持久化路径（file:/// 开头且指向 images 目录）
                     if component.file and component.file.startswith("file:///") and "/images/" in component.file:
+                        # 已在图片存储中的图片被新记录引用，增加引用数
+                        if await IOPool.run(ImageStore.acquire, component.file[8:], HistoryStorage._defer_legacy_refs(chat_key)):
+                            image_refs.append(component.file[8:])
                         logger.debug("图片已经是持久化路径，跳过处理")
                         continue
 
@@ -369,36 +1069,17 @@ class HistoryStorage:
                         temp_file_path = await component.convert_to_file_path()
                         logger.debug(f"获取的绝对路径:{temp_file_path}")
 
-                        if temp_file_path and os.path.exists(temp_file_path):
-                            # 生成唯一的文件名
-                            import uuid
-                            unique_id = uuid.uuid4().hex
-                            file_extension = ".jpg"  # 默认使用 jpg 扩展名
-
-                            # 尝试从原文件获取扩展名
-                            if "." in temp_file_path:
-                                original_ext = os.path.splitext(temp_file_path)[1].lower()
-                                if original_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
-                                    file_extension = original_ext
-
-                            # 构建持久化文件路径
-                            persistent_filename = f"{unique_id}{file_extension}"
-                            persistent_file_path = os.path.join(images_dir, persistent_filename)
-
-                            # 复制文件到持久化目录
-                            import shutil
-                            shutil.copy2(temp_file_path, persistent_file_path)
-
-                            # 规范化路径（兼容 Docker 环境）
-                            persistent_file_path = os.path.abspath(persistent_file_path)
-
-                            # 使用正斜杠规范化路径（兼容 Windows 和 Unix）
-                            normalized_path = persistent_file_path.replace('\\', '/')
+                        # 计算哈希和复制文件在线程池中执行
+                        normalized_path = None
+                        if temp_file_path:
+                            normalized_path = await IOPool.run(ImageStore.put, temp_file_path)
 
+                        if normalized_path:
+                            image_refs.append(normalized_path)
                             # 存储绝对路径到 file 字段（使用 file:/// 前缀，兼容 AstrBot）
                             component.file = f"file:///{normalized_path}"
 
-                            logger.debug(f"成功将图片保存为持久化文件: {persistent_file_path}")
+                            logger.debug(f"成功将图片保存为持久化文件: {normalized_path}")
                         else:
                             logger.warning("无法获取图片的本地文件路径")
                     except Exception as e:
@@ -409,58 +1090,3 @@ class HistoryStorage:
         except Exception as e:
             logger.error(f"处理图片持久化存储时发生错误: {e}")
             logger.debug(traceback.format_exc())
-
-    @staticmethod
-    def _cleanup_old_images() -> None:
-        """
-        清理超过配置天数的图片文件
-
-        防止图片文件无限增长
-        """
-        try:
-            # 检查是否启用图片持久化存储
-            if not HistoryStorage.config:
-                logger.debug("配置未初始化，跳过图片清理")
-                return
-
-            image_processing_config = HistoryStorage.config.get("image_processing", {})
-            if not image_processing_config.get("enable_image_persistence", True):
-                logger.debug("图片持久化存储已禁用，跳过清理")
-                return
-
-            # 获取配置的保留天数
-            retention_days = image_processing_config.get("image_retention_days", 7)
-            if retention_days < 1 or retention_days > 365:
-                logger.warning(f"图片保留天数配置无效: {retention_days}，使用默认值7天")
-                retention_days = 7
-
-            # 使用 AstrBot 的数据路径（兼容 Docker）
-            from astrbot.core.utils.astrbot_path import get_astrbot_data_path
-            astrbot_data_path = get_astrbot_data_path()
-            images_dir = os.path.join(astrbot_data_path, "chat_history", "images")
-            if not os.path.exists(images_dir):
-                return
-
-            current_time = time.time()
-            cleanup_threshold = retention_days * 24 * 3600  # 配置的天数转换为秒
-            cleaned_count = 0
-
-            for filename in os.listdir(images_dir):
-                file_path = os.path.join(images_dir, filename)
-                if os.path.isfile(file_path):
-                    # 检查文件创建时间
-                    file_ctime = os.path.getctime(file_path)
-                    if current_time - file_ctime > cleanup_threshold:
-                        try:
-                            os.remove(file_path)
-                            cleaned_count += 1
-                            logger.debug(f"清理过期图片文件: {filename}")
-                        except Exception as e:
-                            logger.error(f"删除过期图片文件失败 {filename}: {e}")
-
-            if cleaned_count > 0:
-                logger.info(f"图片清理完成，清理了 {cleaned_count} 个超过 {retention_days} 天的图片文件")
-
-        except Exception as e:
-            logger.error(f"清理图片文件时发生错误: {e}")
-
@@ -1,48 +1,192 @@
 from astrbot.api.all import *
-from typing import Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
 import asyncio
+import base64
+import hashlib
+import json
+import os
+import time
+from .caption_store import CaptionStore
+from .image_store import ImageStore
+from .io_pool import IOPool
 
 class ImageCaptionUtils:
     """
     图片转述工具类
 
     用于调用大语言模型将图片转述为文本描述
+    生成的描述按图片内容哈希缓存在CaptionStore中，重启后仍可复用
     """
 
     # 保存context和config对象的静态变量
     context: Optional[Context] = None
     config: Optional[AstrBotConfig] = None
-    # 图片描述缓存
-    caption_cache: dict[str, str] = {}
+    # 正在生成中的描述 {缓存键: Future}，同一图片的并发请求共享一次调用
+    _inflight: Dict[str, asyncio.Future] = {}
+    # 最近转述失败的图片 {缓存键: 失效时间}，在失效前不再重试
+    _failures: "OrderedDict[str, float]" = OrderedDict()
+    # 失败记录的最大条数
+    MAX_FAILURES = 1024
+    # 限制同时进行的转述请求数
+    _semaphore: Optional[asyncio.Semaphore] = None
+    # 超过截止时间后仍在后台完成的转述任务，保留引用避免被回收
+    _background_tasks: Set[asyncio.Task] = set()
+
+    # 批量转述的提示词，要求按图片顺序返回JSON字符串数组
+    BATCH_PROMPT = (
+        "下面按顺序给出了{count}张图片。对每张图片分别执行以下要求：{prompt}\n"
+        "只输出一个JSON字符串数组，数组中恰好有{count}个元素，第i个元素是第i张图片的描述，不要输出其他内容。"
+    )
     
     @staticmethod
     def init(context: Context, config: AstrBotConfig):
-        """初始化图片转述工具类，保存context和config引用"""
+        """初始化图片转述工具类，保存context和config引用，并打开图片描述缓存"""
         ImageCaptionUtils.context = context
         ImageCaptionUtils.config = config
-    
+        ImageCaptionUtils._inflight = {}
+        ImageCaptionUtils._failures = OrderedDict()
+        ImageCaptionUtils._semaphore = None
+
+        from astrbot.core.utils.astrbot_path import get_astrbot_data_path
+        data_dir = os.path.join(get_astrbot_data_path(), "chat_history")
+        os.makedirs(data_dir, exist_ok=True)
+        image_processing_config = config.get("image_processing", {}) if config else {}
+        CaptionStore.init(
+            os.path.join(data_dir, "captions.db"),
+            memory_entries=image_processing_config.get("caption_cache_memory_entries", 512),
+            max_entries=image_processing_config.get("caption_cache_max_entries", 10000),
+            ttl_days=image_processing_config.get("caption_cache_ttl_days", 30),
+        )
+
     @staticmethod
-    async def generate_image_caption(
-            image: str, # 图片的base64编码或URL
-            umo: Optional[str] = None, # unified_msg_origin，用于 UMO 路由
-            timeout: int = 30
-        ) -> Optional[str]:
+    def _content_hash(image: str) -> str:
         """
-        为单张图片生成文字描述
+        计算图片内容的哈希（阻塞，在线程池中执行）
+
+        本地文件按文件内容计算，图片存储中的文件直接取文件名中的哈希；
+        base64图片按解码后的内容计算；URL无法在不下载的情况下得到内容，按URL本身计算
+        """
+        if image.startswith("base64://") or image.startswith("data:"):
+            encoded = image.split(",", 1)[1] if image.startswith("data:") else image[len("base64://"):]
+            try:
+                return hashlib.sha256(base64.b64decode(encoded)).hexdigest()
+            except Exception:
+                return hashlib.sha256(image.encode("utf-8")).hexdigest()
+        if os.path.isfile(image):
+            return ImageStore.sha256_of(image) or ImageStore.hash_file(image)
+        return hashlib.sha256(image.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _provider_name(provider, provider_id: str) -> str:
+        """缓存键中使用的提供商标识，包含模型名称"""
+        name = provider_id
+        model = ""
+        try:
+            meta = provider.meta()
+            name = name or getattr(meta, "id", "")
+            model = getattr(meta, "model", "") or ""
+        except Exception:
+            pass
+        return f"{name or provider.__class__.__name__}:{model}"
+
+    @staticmethod
+    def _recently_failed(key: str) -> bool:
+        """图片是否在失败冷却期内"""
+        expires_at = ImageCaptionUtils._failures.get(key)
+        if expires_at is None:
+            return False
+        if expires_at > time.time():
+            return True
+        del ImageCaptionUtils._failures[key]
+        return False
+
+    @staticmethod
+    def _record_failure(key: str) -> None:
+        """记录转述失败，冷却时间由 caption_failure_ttl 配置"""
+        image_processing_config = ImageCaptionUtils.config.get("image_processing", {}) if ImageCaptionUtils.config else {}
+        ttl = image_processing_config.get("caption_failure_ttl", 120)
+        if ttl <= 0:
+            return
+        failures = ImageCaptionUtils._failures
+        failures[key] = time.time() + ttl
+        failures.move_to_end(key)
+        while len(failures) > ImageCaptionUtils.MAX_FAILURES:
+            failures.popitem(last=False)
+
+    @staticmethod
+    def _get_semaphore() -> asyncio.Semaphore:
+        """获取限制转述并发数的信号量"""
+        if ImageCaptionUtils._semaphore is None:
+            image_processing_config = ImageCaptionUtils.config.get("image_processing", {}) if ImageCaptionUtils.config else {}
+            concurrency = max(1, int(image_processing_config.get("caption_concurrency", 4)))
+            ImageCaptionUtils._semaphore = asyncio.Semaphore(concurrency)
+        return ImageCaptionUtils._semaphore
+
+    @staticmethod
+    async def generate_captions(images: List[str], umo: Optional[str] = None) -> Dict[str, Optional[str]]:
+        """
+        并发为多张图片生成描述
+
+        所有图片同时开始转述（实际请求数受 caption_concurrency 限制），
+        caption_batch_size 大于1时未缓存的图片按批合并为一次请求，
+        超过 caption_deadline 秒仍未完成的图片不再等待，在后台继续完成并写入缓存
 
         Args:
-            image: 图片的base64编码或URL
+            images: 图片的base64编码、URL或本地路径列表
             umo: unified_msg_origin，用于获取对应 UMO 的 provider
-            timeout: 超时时间（秒）
 
         Returns:
-            生成的图片描述文本，如果失败则返回None
+            {图片: 描述}，失败或未在截止时间内完成的图片描述为None
+        """
+        unique_images = list(dict.fromkeys(images))
+        if not unique_images:
+            return {}
+
+        image_processing_config = ImageCaptionUtils.config.get("image_processing", {}) if ImageCaptionUtils.config else {}
+        batch_size = int(image_processing_config.get("caption_batch_size", 1))
+        if batch_size > 1 and len(unique_images) > 1:
+            tasks = await ImageCaptionUtils._schedule_batches(unique_images, umo, batch_size)
+        else:
+            tasks = {
+                image: asyncio.ensure_future(ImageCaptionUtils.generate_image_caption(image, umo=umo))
+                for image in unique_images
+            }
+        deadline = image_processing_config.get("caption_deadline", 15)
+        await asyncio.wait(tasks.values(), timeout=deadline if deadline > 0 else None)
+
+        captions: Dict[str, Optional[str]] = {}
+        pending = 0
+        for image, task in tasks.items():
+            if task.done():
+                captions[image] = None if task.cancelled() or task.exception() else task.result()
+            else:
+                captions[image] = None
+                pending += 1
+                ImageCaptionUtils._background_tasks.add(task)
+                task.add_done_callback(ImageCaptionUtils._background_tasks.discard)
+        if pending:
+            logger.debug(f"图片转述超过截止时间，{pending} 张图片在后台继续转述")
+        return captions
+
+    @staticmethod
+    def shutdown() -> None:
+        """关闭图片描述缓存，在插件卸载时调用"""
+        CaptionStore.close()
+
+    @staticmethod
+    def cache_stats() -> dict:
+        """图片描述缓存的命中统计"""
+        return CaptionStore.stats()
+    
+    @staticmethod
+    def _get_provider(umo: Optional[str] = None):
+        """
+        获取转述使用的提供商
+
+        Returns:
+            (提供商, 配置的提供商ID)，未初始化、未启用转述或找不到提供商时返回None
         """
-        # 检查缓存
-        if image in ImageCaptionUtils.caption_cache:
-            logger.debug(f"命中图片描述缓存: {image[:50]}...")
-            return ImageCaptionUtils.caption_cache[image]
-            
         # 获取配置
         config = ImageCaptionUtils.config
         context = ImageCaptionUtils.context
@@ -66,28 +210,259 @@ class ImageCaptionUtils:
         if not provider or not hasattr(provider, "text_chat"):
              logger.warning(f"无法找到提供商: {provider_id if provider_id else '默认'}")
              return None
+        return provider, provider_id
+
+    @staticmethod
+    def _get_prompt() -> str:
+        """单张图片的转述提示词"""
+        image_processing_config = ImageCaptionUtils.config.get("image_processing", {})
+        return image_processing_config.get("image_caption_prompt", "请直接简短描述这张图片")
+
+    @staticmethod
+    async def _lookup(image: str, prompt: str, provider_name: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        查询图片描述缓存
+
+        Returns:
+            (缓存键, 缓存的描述)，计算缓存键失败时缓存键为None
+        """
+        try:
+            content_hash = await IOPool.run(ImageCaptionUtils._content_hash, image)
+            cache_key = CaptionStore.make_key(content_hash, prompt, provider_name)
+            caption = await CaptionStore.get(cache_key)
+            if caption is not None:
+                logger.debug(f"命中图片描述缓存: {image[:50]}...")
+            return cache_key, caption
+        except Exception as e:
+            logger.warning(f"读取图片描述缓存失败: {e}")
+            return None, None
+
+    @staticmethod
+    async def generate_image_caption(
+            image: str, # 图片的base64编码或URL
+            umo: Optional[str] = None, # unified_msg_origin，用于 UMO 路由
+            timeout: int = 30
+        ) -> Optional[str]:
+        """
+        为单张图片生成文字描述
+
+        Args:
+            image: 图片的base64编码或URL
+            umo: unified_msg_origin，用于获取对应 UMO 的 provider
+            timeout: 超时时间（秒）
+
+        Returns:
+            生成的图片描述文本，如果失败则返回None
+        """
+        resolved = ImageCaptionUtils._get_provider(umo)
+        if resolved is None:
+            return None
+        provider, provider_id = resolved
 
         text_chat = getattr(provider, "text_chat")
+        prompt = ImageCaptionUtils._get_prompt()
+        # 检查缓存
+        cache_key, caption = await ImageCaptionUtils._lookup(
+            image, prompt, ImageCaptionUtils._provider_name(provider, provider_id)
+        )
+        if caption is not None:
+            return caption
+
+        # 最近失败过的图片直接跳过，避免反复等待超时
+        flight_key = cache_key or image
+        if ImageCaptionUtils._recently_failed(flight_key):
+            logger.debug(f"图片转述最近失败过，暂不重试: {image[:50]}...")
+            return None
+
+        # 已有相同图片在生成中时等待同一个结果
+        inflight = ImageCaptionUtils._inflight.get(flight_key)
+        if inflight is not None:
+            logger.debug(f"等待进行中的图片转述: {image[:50]}...")
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        ImageCaptionUtils._inflight[flight_key] = future
+        caption = None
+        try:
+            caption = await ImageCaptionUtils._request_caption(text_chat, prompt, image, timeout, cache_key)
+            if not caption:
+                ImageCaptionUtils._record_failure(flight_key)
+            return caption
+        finally:
+            # 发起者被取消时等待者得到None
+            future.set_result(caption)
+            ImageCaptionUtils._inflight.pop(flight_key, None)
+
+    @staticmethod
+    async def _schedule_batches(
+            images: List[str],
+            umo: Optional[str],
+            batch_size: int,
+            timeout: int = 30
+        ) -> Dict[str, asyncio.Future]:
+        """
+        查询缓存后将未缓存的图片按批发起转述
+
+        与单张转述共用缓存、失败记录和进行中的请求，批内的每张图片各自登记一个Future
+
+        Returns:
+            {图片: 得到描述的Future}
+        """
+        loop = asyncio.get_running_loop()
+
+        def resolved_future(caption: Optional[str]) -> asyncio.Future:
+            future = loop.create_future()
+            future.set_result(caption)
+            return future
+
+        resolved = ImageCaptionUtils._get_provider(umo)
+        if resolved is None:
+            return {image: resolved_future(None) for image in images}
+        provider, provider_id = resolved
+
+        text_chat = getattr(provider, "text_chat")
+        prompt = ImageCaptionUtils._get_prompt()
+        provider_name = ImageCaptionUtils._provider_name(provider, provider_id)
+        lookups = await asyncio.gather(
+            *(ImageCaptionUtils._lookup(image, prompt, provider_name) for image in images)
+        )
+
+        futures: Dict[str, asyncio.Future] = {}
+        # 需要转述的图片 [(图片, 缓存键, 去重键)]
+        misses: List[Tuple[str, Optional[str], str]] = []
+        for image, (cache_key, caption) in zip(images, lookups):
+            flight_key = cache_key or image
+            if caption is not None:
+                futures[image] = resolved_future(caption)
+            elif ImageCaptionUtils._recently_failed(flight_key):
+                futures[image] = resolved_future(None)
+            elif flight_key in ImageCaptionUtils._inflight:
+                futures[image] = ImageCaptionUtils._inflight[flight_key]
+            else:
+                future = loop.create_future()
+                ImageCaptionUtils._inflight[flight_key] = future
+                futures[image] = future
+                misses.append((image, cache_key, flight_key))
+
+        for start in range(0, len(misses), batch_size):
+            task = asyncio.ensure_future(
+                ImageCaptionUtils._run_batch(text_chat, prompt, misses[start:start + batch_size], timeout)
+            )
+            ImageCaptionUtils._background_tasks.add(task)
+            task.add_done_callback(ImageCaptionUtils._background_tasks.discard)
+        return futures
+
+    @staticmethod
+    async def _run_batch(
+            text_chat,
+            prompt: str,
+            batch: List[Tuple[str, Optional[str], str]],
+            timeout: int
+        ) -> None:
+        """转述一批图片并写入缓存，批量结果无法解析时逐张转述，最后完成各图片的Future"""
+        captions: Dict[str, Optional[str]] = {}
+        try:
+            if len(batch) > 1:
+                results = await ImageCaptionUtils._request_batch(
+                    text_chat, prompt, [image for image, _, _ in batch], timeout
+                )
+                if results is not None:
+                    for (image, cache_key, _), caption in zip(batch, results):
+                        captions[image] = caption
+                        await ImageCaptionUtils._store_caption(cache_key, image, caption)
+                else:
+                    logger.debug(f"批量图片转述失败，改为逐张转述 {len(batch)} 张图片")
+
+            missing = [item for item in batch if not captions.get(item[0])]
+            results = await asyncio.gather(
+                *(ImageCaptionUtils._request_caption(text_chat, prompt, image, timeout, cache_key)
+                  for image, cache_key, _ in missing)
+            )
+            for (image, _, flight_key), caption in zip(missing, results):
+                captions[image] = caption
+                if not caption:
+                    ImageCaptionUtils._record_failure(flight_key)
+        finally:
+            for image, _, flight_key in batch:
+                future = ImageCaptionUtils._inflight.pop(flight_key, None)
+                if future is not None and not future.done():
+                    future.set_result(captions.get(image))
+
+    @staticmethod
+    async def _request_batch(text_chat, prompt: str, images: List[str], timeout: int) -> Optional[List[str]]:
+        """在一次请求中转述多张图片，返回按图片顺序的描述，失败或结果无法解析时返回None"""
+        batch_prompt = ImageCaptionUtils.BATCH_PROMPT.format(count=len(images), prompt=prompt)
+        try:
+            async with ImageCaptionUtils._get_semaphore():
+                llm_response = await asyncio.wait_for(
+                    text_chat(
+                        prompt=batch_prompt,
+                        contexts=[],
+                        image_urls=images,
+                        func_tool=None,
+                        system_prompt=""
+                    ),
+                    timeout=timeout
+                )
+        except asyncio.TimeoutError:
+            logger.warning(f"批量图片转述超时，超过了{timeout}秒")
+            return None
+        except Exception as e:
+            logger.error(f"批量图片转述失败: {e}")
+            return None
+        return ImageCaptionUtils._parse_batch(llm_response.completion_text, len(images))
+
+    @staticmethod
+    def _parse_batch(text: Optional[str], count: int) -> Optional[List[str]]:
+        """从回复中取出JSON字符串数组，数量不符或有空描述时返回None"""
+        if not text:
+            return None
+        start = text.find("[")
+        end = text.rfind("]")
+        if start < 0 or end <= start:
+            return None
+        try:
+            captions = json.loads(text[start:end + 1])
+        except ValueError:
+            return None
+        if not isinstance(captions, list) or len(captions) != count:
+            return None
+        if not all(isinstance(caption, str) and caption.strip() for caption in captions):
+            return None
+        return [caption.strip() for caption in captions]
+
+    @staticmethod
+    async def _store_caption(cache_key: Optional[str], image: str, caption: Optional[str]) -> None:
+        """将描述写入缓存"""
+        if not caption or not cache_key:
+            return
+        try:
+            await CaptionStore.put(cache_key, caption)
+            logger.debug(f"缓存图片描述: {image[:50]}... -> {caption}")
+        except Exception as e:
+            logger.warning(f"保存图片描述缓存失败: {e}")
+
+    @staticmethod
+    async def _request_caption(text_chat, prompt: str, image: str, timeout: int, cache_key: Optional[str]) -> Optional[str]:
+        """调用提供商生成一张图片的描述并写入缓存，失败返回None"""
         try:
             # 带超时控制的调用大模型进行图片转述
             async def call_llm():
                 return await text_chat(
-                    prompt=image_processing_config.get("image_caption_prompt", "请直接简短描述这张图片"),
+                    prompt=prompt,
                     contexts=[],
                     image_urls=[image],
                     func_tool=None,
                     system_prompt=""
                 )
-            
-            # 使用asyncio.wait_for添加超时控制
-            llm_response = await asyncio.wait_for(call_llm(), timeout=timeout)
+
+            # 使用asyncio.wait_for添加超时控制，并限制同时进行的请求数
+            async with ImageCaptionUtils._get_semaphore():
+                llm_response = await asyncio.wait_for(call_llm(), timeout=timeout)
             caption = llm_response.completion_text
-            
+
             # 缓存结果
-            if caption:
-                 ImageCaptionUtils.caption_cache[image] = caption
-                 logger.debug(f"缓存图片描述: {image[:50]}... -> {caption}")
-                 
+            await ImageCaptionUtils._store_caption(cache_key, image, caption)
             return caption
         except asyncio.TimeoutError:
             logger.warning(f"图片转述超时，超过了{timeout}秒")
@@ -0,0 +1,341 @@
+import os
+import re
+import shutil
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+from astrbot.api.all import logger
+
+
+class ImageStore:
+    """
+    内容寻址的图片存储工具类
+
+    图片按内容的SHA-256存放在分片目录中: {根目录}/ab/cd/{sha256}{扩展名}，
+    相同内容的图片只保存一份。索引数据库记录每张图片的创建时间和被多少条历史记录引用，
+    由定时的垃圾回收删除没有引用且超过保留天数的图片。
+    旧版直接放在根目录下、按uuid命名的图片以 "legacy/文件名" 为键登记在同一索引中。
+    """
+
+    # 图片根目录
+    _root: Optional[str] = None
+    # 索引数据库连接，会在I/O线程池的不同线程中使用，由锁保证同一时间只有一个线程访问
+    _conn: Optional[sqlite3.Connection] = None
+    _lock = threading.Lock()
+    # 登记旧版图片期间暂存的引用 {键: 引用数}，不在登记时为None
+    _deferred_refs: Optional[Dict[str, int]] = None
+
+    # 读取文件计算哈希时的块大小
+    HASH_BLOCK_SIZE = 1024 * 1024
+    # 支持保留的扩展名，其余统一为 .jpg
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+    _SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+    # 旧版图片在索引中的键前缀
+    LEGACY_PREFIX = "legacy/"
+
+    @staticmethod
+    def init(root_dir: str, index_path: str) -> None:
+        """
+        打开图片存储
+
+        Args:
+            root_dir: 图片根目录
+            index_path: 索引数据库路径
+        """
+        ImageStore.close()
+        os.makedirs(root_dir, exist_ok=True)
+        with ImageStore._lock:
+            ImageStore._root = os.path.abspath(root_dir)
+            conn = sqlite3.connect(index_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS images (
+                    sha256 TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_images_gc ON images (refcount, created_at)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            ImageStore._conn = conn
+        logger.debug(f"图片存储初始化: {root_dir}")
+
+    @staticmethod
+    def close() -> None:
+        """关闭索引数据库"""
+        with ImageStore._lock:
+            if ImageStore._conn is not None:
+                ImageStore._conn.close()
+                ImageStore._conn = None
+
+    @staticmethod
+    def hash_file(file_path: str) -> str:
+        """计算文件内容的SHA-256"""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(ImageStore.HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _path_for(sha256: str, extension: str) -> str:
+        """图片在分片目录中的路径"""
+        return os.path.join(ImageStore._root, sha256[:2], sha256[2:4], f"{sha256}{extension}")
+
+    @staticmethod
+    def _normalize(path: str) -> str:
+        """使用正斜杠的绝对路径（兼容 Windows 和 Unix）"""
+        return os.path.abspath(path).replace('\\', '/')
+
+    @staticmethod
+    def sha256_of(path: str) -> Optional[str]:
+        """
+        从路径中取出图片的SHA-256
+
+        Returns:
+            路径属于图片存储时返回SHA-256，否则返回None
+        """
+        if ImageStore._root is None:
+            return None
+        path = os.path.abspath(path)
+        if os.path.dirname(os.path.dirname(os.path.dirname(path))) != ImageStore._root:
+            return None
+        sha256 = os.path.splitext(os.path.basename(path))[0]
+        return sha256 if ImageStore._SHA256_PATTERN.match(sha256) else None
+
+    @staticmethod
+    def _key_of(path: str) -> Optional[str]:
+        """图片在索引中的键，不属于图片目录时返回None"""
+        sha256 = ImageStore.sha256_of(path)
+        if sha256:
+            return sha256
+        if ImageStore._root is not None and os.path.dirname(os.path.abspath(path)) == ImageStore._root:
+            return ImageStore.LEGACY_PREFIX + os.path.basename(path)
+        return None
+
+    @staticmethod
+    def put(source_path: str) -> Optional[str]:
+        """
+        存入一张图片并增加一次引用（阻塞，在线程池中执行）
+
+        已存在相同内容的图片时只计算一次哈希，不再复制文件
+
+        Args:
+            source_path: 图片的本地路径
+
+        Returns:
+            图片在存储中的路径（正斜杠），源文件不存在或存储未初始化时返回None
+        """
+        if ImageStore._root is None or not os.path.exists(source_path):
+            return None
+
+        sha256 = ImageStore.hash_file(source_path)
+        extension = os.path.splitext(source_path)[1].lower()
+        if extension not in ImageStore.IMAGE_EXTENSIONS:
+            extension = ".jpg"
+
+        with ImageStore._lock:
+            conn = ImageStore._conn
+            row = conn.execute("SELECT path FROM images WHERE sha256 = ?", (sha256,)).fetchone()
+            if row and os.path.exists(row[0]):
+                conn.execute("UPDATE images SET refcount = refcount + 1 WHERE sha256 = ?", (sha256,))
+                return row[0]
+
+            target_path = ImageStore._path_for(sha256, extension)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            # 先复制到临时文件再替换，避免留下不完整的图片
+            tmp_path = target_path + ".tmp"
+            shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, target_path)
+
+            normalized_path = ImageStore._normalize(target_path)
+            conn.execute(
+                """
+                INSERT INTO images (sha256, path, size, created_at, refcount) VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT(sha256) DO UPDATE SET path = excluded.path, size = excluded.size, refcount = refcount + 1
+                """,
+                (sha256, normalized_path, os.path.getsize(target_path), int(time.time())),
+            )
+            return normalized_path
+
+    @staticmethod
+    def acquire(path: str, defer_missing: bool = False) -> bool:
+        """
+        为已在存储中的图片增加一次引用（阻塞，在线程池中执行）
+
+        Args:
+            path: 图片路径
+            defer_missing: 旧版图片尚未登记时是否暂存这次引用，在登记时计入
+
+        Returns:
+            图片是否在存储中
+        """
+        key = ImageStore._key_of(path)
+        if key is None:
+            return False
+        with ImageStore._lock:
+            cursor = ImageStore._conn.execute(
+                "UPDATE images SET refcount = refcount + 1 WHERE sha256 = ?", (key,)
+            )
+            if cursor.rowcount > 0:
+                return True
+            deferred = ImageStore._deferred_refs
+            if defer_missing and deferred is not None and key.startswith(ImageStore.LEGACY_PREFIX):
+                deferred[key] = deferred.get(key, 0) + 1
+                return True
+            return False
+
+    @staticmethod
+    def release(paths: Iterable[str]) -> None:
+        """
+        释放图片的引用（阻塞，在线程池中执行）
+
+        没有引用的图片不会立即删除，由垃圾回收在超过保留天数后删除。引用数最小为0
+
+        Args:
+            paths: 图片路径，同一图片出现几次就释放几次引用
+        """
+        counts: Dict[str, int] = {}
+        for path in paths:
+            key = ImageStore._key_of(path)
+            if key:
+                counts[key] = counts.get(key, 0) + 1
+        if not counts:
+            return
+
+        with ImageStore._lock:
+            ImageStore._conn.executemany(
+                "UPDATE images SET refcount = MAX(0, refcount - ?) WHERE sha256 = ?",
+                [(count, key) for key, count in counts.items()],
+            )
+
+    @staticmethod
+    def collect_garbage(retention_days: float, now: Optional[float] = None) -> int:
+        """
+        删除没有引用且创建时间超过保留天数的图片（阻塞，在线程池中执行）
+
+        只通过索引查询待删除的图片，不扫描图片目录
+
+        Args:
+            retention_days: 保留天数
+            now: 当前时间戳，为空则使用当前时间
+
+        Returns:
+            删除的图片数
+        """
+        if ImageStore._conn is None:
+            return 0
+        cutoff = int((now if now is not None else time.time()) - retention_days * 86400)
+        removed = 0
+        with ImageStore._lock:
+            conn = ImageStore._conn
+            rows = conn.execute(
+                "SELECT sha256, path FROM images WHERE refcount <= 0 AND created_at < ?", (cutoff,)
+            ).fetchall()
+            for key, path in rows:
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                    conn.execute("DELETE FROM images WHERE sha256 = ?", (key,))
+                    removed += 1
+                except Exception as e:
+                    logger.error(f"删除过期图片失败 {path}: {e}")
+        return removed
+
+    @staticmethod
+    def needs_backfill() -> bool:
+        """旧版图片是否还未登记到索引"""
+        if ImageStore._conn is None:
+            return False
+        with ImageStore._lock:
+            row = ImageStore._conn.execute(
+                "SELECT value FROM meta WHERE key = 'legacy_backfilled'"
+            ).fetchone()
+        return row is None
+
+    @staticmethod
+    def begin_backfill() -> None:
+        """开始登记旧版图片，之后对尚未登记的旧版图片的引用可以暂存"""
+        with ImageStore._lock:
+            ImageStore._deferred_refs = {}
+
+    @staticmethod
+    def end_backfill() -> None:
+        """结束登记旧版图片"""
+        with ImageStore._lock:
+            ImageStore._deferred_refs = None
+
+    @staticmethod
+    def backfill_legacy(reference_counts: Dict[str, int]) -> int:
+        """
+        将根目录下的旧版图片登记到索引（阻塞，在线程池中执行）
+
+        登记时一并计入 begin_backfill 之后暂存的引用；图片已在索引中时增加引用数
+
+        Args:
+            reference_counts: {图片路径: 被历史记录引用的次数}
+
+        Returns:
+            登记的图片数
+        """
+        counts: Dict[str, int] = {}
+        for path, count in reference_counts.items():
+            key = ImageStore._key_of(path)
+            if key and key.startswith(ImageStore.LEGACY_PREFIX):
+                counts[key] = counts.get(key, 0) + count
+
+        rows: List[tuple] = []
+        with os.scandir(ImageStore._root) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.endswith(".tmp"):
+                    continue
+                stat = entry.stat()
+                key = ImageStore.LEGACY_PREFIX + entry.name
+                rows.append((
+                    key, ImageStore._normalize(entry.path), stat.st_size,
+                    int(stat.st_ctime), counts.get(key, 0),
+                ))
+
+        with ImageStore._lock:
+            # 暂存的引用和登记在同一次加锁中完成，之后的引用直接更新索引
+            deferred = ImageStore._deferred_refs or {}
+            ImageStore._deferred_refs = None
+            rows = [row[:4] + (row[4] + deferred.get(row[0], 0),) for row in rows]
+            conn = ImageStore._conn
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
+                    """
+                    INSERT INTO images (sha256, path, size, created_at, refcount) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + excluded.refcount
+                    """,
+                    rows,
+                )
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_backfilled', '1')")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        """图片存储使用情况"""
+        if ImageStore._conn is None:
+            return {"images": 0, "bytes": 0, "references": 0}
+        with ImageStore._lock:
+            row = ImageStore._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount), 0) FROM images"
+            ).fetchone()
+        return {"images": row[0], "bytes": row[1], "references": row[2]}
@@ -0,0 +1,87 @@
+from astrbot.api.all import *
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+import asyncio
+import functools
+
+
+class IOPool:
+    """
+    阻塞I/O线程池工具类
+
+    文件读写、序列化等阻塞操作统一交给专用线程池执行，事件循环只等待结果。
+    同时提交的任务数（执行中 + 排队中）不超过 线程数 + 队列深度，
+    超出时调用方在事件循环上等待，形成背压。
+    """
+
+    _executor: Optional[ThreadPoolExecutor] = None
+    _semaphore: Optional[asyncio.Semaphore] = None
+    max_workers: int = 4
+    queue_size: int = 64
+
+    @staticmethod
+    def init(config: AstrBotConfig):
+        """根据配置初始化线程池"""
+        storage_config = config.get("storage", {}) if config else {}
+        # 重新初始化时不等待旧线程池中的任务，已提交的任务在旧线程池中继续执行完
+        old_executor = IOPool._executor
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+        IOPool.max_workers = max(1, int(storage_config.get("io_workers", 4)))
+        IOPool.queue_size = max(0, int(storage_config.get("io_queue_size", 64)))
+        IOPool._executor = ThreadPoolExecutor(
+            max_workers=IOPool.max_workers, thread_name_prefix="spectrecore_io"
+        )
+        IOPool._semaphore = None
+        logger.debug(f"I/O线程池初始化: 线程数 {IOPool.max_workers}，队列深度 {IOPool.queue_size}")
+
+    @staticmethod
+    def _get_executor() -> ThreadPoolExecutor:
+        """获取线程池，未初始化时使用默认配置创建"""
+        if IOPool._executor is None:
+            IOPool._executor = ThreadPoolExecutor(
+                max_workers=IOPool.max_workers, thread_name_prefix="spectrecore_io"
+            )
+        return IOPool._executor
+
+    @staticmethod
+    def _get_semaphore() -> asyncio.Semaphore:
+        """获取限制提交数量的信号量"""
+        if IOPool._semaphore is None:
+            IOPool._semaphore = asyncio.Semaphore(IOPool.max_workers + IOPool.queue_size)
+        return IOPool._semaphore
+
+    @staticmethod
+    async def run(func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        在I/O线程池中执行阻塞函数
+
+        Args:
+            func: 要执行的阻塞函数
+            *args: 位置参数
+            **kwargs: 关键字参数
+
+        Returns:
+            函数的返回值，函数抛出的异常会原样抛出
+        """
+        async with IOPool._get_semaphore():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                IOPool._get_executor(), functools.partial(func, *args, **kwargs)
+            )
+
+    @staticmethod
+    def shutdown() -> None:
+        """关闭线程池，等待已提交的任务完成"""
+        executor = IOPool._executor
+        IOPool._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    @staticmethod
+    async def shutdown_async() -> None:
+        """关闭线程池，在单独的线程中等待已提交的任务完成，不阻塞事件循环"""
+        executor = IOPool._executor
+        IOPool._executor = None
+        if executor is not None:
+            await asyncio.to_thread(executor.shutdown, wait=True)
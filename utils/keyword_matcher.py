@@ -0,0 +1,129 @@
+from astrbot.api.all import *
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+import re
+import unicodedata
+
+
+class KeywordMatcher:
+    """
+    多模式关键词匹配器
+
+    由触发关键词和黑名单关键词共同编译出一个Aho-Corasick自动机，
+    对消息文本只扫描一遍即可同时得到两类关键词是否命中，耗时与关键词数量无关。
+    以 "re:" 开头的条目按正则表达式匹配，同一类的正则合并为一个表达式。
+    可选在匹配前对关键词和文本做NFKC规范化（全角转半角）和大小写折叠。
+    """
+
+    # 命中结果的位标记
+    TRIGGER = 1
+    BLACKLIST = 2
+    # 正则条目的前缀
+    REGEX_PREFIX = "re:"
+
+    def __init__(self, keywords: Iterable[str] = (), blacklist: Iterable[str] = (), normalize: bool = False):
+        """
+        编译匹配器
+
+        Args:
+            keywords: 触发回复的关键词
+            blacklist: 黑名单关键词
+            normalize: 是否做NFKC规范化和大小写折叠
+        """
+        self.normalize = normalize
+        # 自动机：每个状态的转移表、失配指针和命中标记
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[int] = [0]
+        self._regex: Dict[int, re.Pattern] = {}
+        self.size = 0
+
+        for kind, entries in ((KeywordMatcher.TRIGGER, keywords), (KeywordMatcher.BLACKLIST, blacklist)):
+            patterns = []
+            for entry in entries:
+                entry = str(entry)
+                if entry.startswith(KeywordMatcher.REGEX_PREFIX):
+                    pattern = entry[len(KeywordMatcher.REGEX_PREFIX):]
+                    try:
+                        re.compile(pattern)
+                    except re.error as e:
+                        logger.warning(f"关键词正则无效，已忽略: {pattern}，{e}")
+                        continue
+                    patterns.append(f"(?:{pattern})")
+                elif entry:
+                    self._add(self._normalize(entry), kind)
+                else:
+                    continue
+                self.size += 1
+            if patterns:
+                flags = re.IGNORECASE if normalize else 0
+                self._regex[kind] = re.compile("|".join(patterns), flags)
+        self._build_fail_links()
+
+    def __bool__(self) -> bool:
+        return self.size > 0
+
+    def _normalize(self, text: str) -> str:
+        """按配置规范化文本"""
+        if not self.normalize:
+            return text
+        return unicodedata.normalize("NFKC", text).casefold()
+
+    def _add(self, keyword: str, kind: int) -> None:
+        """向字典树中加入一个关键词"""
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(0)
+            state = next_state
+        self._output[state] |= kind
+
+    def _build_fail_links(self) -> None:
+        """按广度优先计算失配指针，并把后缀状态的命中标记合并到当前状态"""
+        # 第一层状态的失配指针都指向根
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] |= self._output[self._fail[next_state]]
+
+    def scan(self, text: Optional[str]) -> int:
+        """
+        扫描文本
+
+        Args:
+            text: 消息文本
+
+        Returns:
+            命中的关键词类别，TRIGGER 和 BLACKLIST 的按位或，未命中为0
+        """
+        if not text or not self.size:
+            return 0
+        text = self._normalize(text)
+        found = 0
+        everything = KeywordMatcher.TRIGGER | KeywordMatcher.BLACKLIST
+        if len(self._goto) > 1:
+            goto, fail, output = self._goto, self._fail, self._output
+            state = 0
+            for char in text:
+                while state and char not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(char, 0)
+                if output[state]:
+                    found |= output[state]
+                    if found == everything:
+                        return found
+        for kind, pattern in self._regex.items():
+            if not found & kind and pattern.search(text):
+                found |= kind
+        return found
@@ -0,0 +1,193 @@
+from astrbot.api.all import *
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+import asyncio
+import time
+
+
+class _Waiter:
+    """排队等待调用大模型的一次触发"""
+
+    __slots__ = ("future", "queued_at")
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.queued_at = time.time()
+
+
+class LLMScheduler:
+    """
+    全局大模型调用调度器
+
+    所有聊天的自动回复共用 max_concurrency 个调用名额，名额用完时触发进入队列排队。
+    队列分为两条通道：私聊、@机器人和回复机器人的消息走优先通道，其余走普通通道，
+    优先通道有排队的触发时先处理优先通道。同一通道内按聊天轮转，
+    每个聊天轮流放行一次，刷屏的聊天不会占满所有名额。
+    排队超过 max_queue_age 秒的触发直接放弃，不再回复已经过时的消息。
+    """
+
+    # 通道，数值越小越先处理
+    LANE_PRIORITY = 0
+    LANE_NORMAL = 1
+    LANE_NAMES = ("priority", "normal")
+
+    config: Optional[AstrBotConfig] = None
+    # 每条通道按聊天排队 {聊天标识: 等待者队列}，字典顺序即轮转顺序
+    _lanes: List["OrderedDict[str, Deque[_Waiter]]"] = [OrderedDict(), OrderedDict()]
+    _running = 0
+    _stats: Dict[str, float] = {"granted": 0, "queued": 0, "expired": 0, "peak_queue": 0, "total_wait": 0.0, "max_wait": 0.0}
+
+    @staticmethod
+    def init(config: AstrBotConfig):
+        """保存配置并清空队列"""
+        LLMScheduler.config = config
+        LLMScheduler._lanes = [OrderedDict(), OrderedDict()]
+        LLMScheduler._running = 0
+        LLMScheduler._stats = {"granted": 0, "queued": 0, "expired": 0, "peak_queue": 0, "total_wait": 0.0, "max_wait": 0.0}
+
+    @staticmethod
+    def _get_config() -> dict:
+        """获取调度相关配置"""
+        if not LLMScheduler.config:
+            return {}
+        return LLMScheduler.config.get("llm_scheduler", {})
+
+    @staticmethod
+    def _max_concurrency() -> int:
+        """同时进行的大模型调用数上限，0为不限制"""
+        return max(0, int(LLMScheduler._get_config().get("max_concurrency", 4)))
+
+    @staticmethod
+    def _max_queue_age() -> float:
+        """触发最多排队多少秒，0为不限制"""
+        return max(0.0, float(LLMScheduler._get_config().get("max_queue_age", 60)))
+
+    @staticmethod
+    def queue_depth() -> int:
+        """当前排队的触发数"""
+        return sum(len(waiters) for lane in LLMScheduler._lanes for waiters in lane.values())
+
+    @staticmethod
+    def _has_slot() -> bool:
+        """是否还有空闲的调用名额"""
+        max_concurrency = LLMScheduler._max_concurrency()
+        return max_concurrency == 0 or LLMScheduler._running < max_concurrency
+
+    @staticmethod
+    def _grant(waited: float) -> None:
+        """占用一个调用名额并记录等待时间"""
+        LLMScheduler._running += 1
+        stats = LLMScheduler._stats
+        stats["granted"] += 1
+        stats["total_wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+
+    @staticmethod
+    async def acquire(chat_key: str, lane: int = LANE_NORMAL) -> bool:
+        """
+        等待一个调用名额
+
+        Args:
+            chat_key: 聊天标识
+            lane: 通道，LANE_PRIORITY 或 LANE_NORMAL
+
+        Returns:
+            是否拿到名额，返回True后必须调用release；排队超时返回False
+        """
+        if LLMScheduler._has_slot() and not LLMScheduler.queue_depth():
+            LLMScheduler._grant(0.0)
+            return True
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future())
+        LLMScheduler._lanes[lane].setdefault(chat_key, deque()).append(waiter)
+        stats = LLMScheduler._stats
+        stats["queued"] += 1
+        stats["peak_queue"] = max(stats["peak_queue"], LLMScheduler.queue_depth())
+        LLMScheduler._dispatch()
+
+        max_queue_age = LLMScheduler._max_queue_age()
+        try:
+            if max_queue_age > 0:
+                await asyncio.wait_for(asyncio.shield(waiter.future), max_queue_age)
+            else:
+                await waiter.future
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if waiter.future.done() and waiter.future.result():
+                # 已经拿到名额后被取消，归还名额
+                LLMScheduler.release()
+            else:
+                LLMScheduler._remove(lane, chat_key, waiter)
+            raise
+
+        if waiter.future.done() and waiter.future.result():
+            return True
+        LLMScheduler._remove(lane, chat_key, waiter)
+        stats["expired"] += 1
+        logger.debug(f"聊天 {chat_key} 的触发排队超过 {max_queue_age} 秒，放弃回复")
+        return False
+
+    @staticmethod
+    def _remove(lane: int, chat_key: str, waiter: _Waiter) -> None:
+        """从队列中移除等待者"""
+        if not waiter.future.done():
+            waiter.future.set_result(False)
+        waiters = LLMScheduler._lanes[lane].get(chat_key)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            pass
+        if not waiters:
+            LLMScheduler._lanes[lane].pop(chat_key, None)
+
+    @staticmethod
+    def _dispatch() -> None:
+        """按通道优先、通道内按聊天轮转放行排队的触发，直到名额用完"""
+        now = time.time()
+        max_queue_age = LLMScheduler._max_queue_age()
+        for lane in LLMScheduler._lanes:
+            while lane and LLMScheduler._has_slot():
+                chat_key, waiters = next(iter(lane.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    # 该聊天还有排队的触发，移到轮转的末尾
+                    lane.move_to_end(chat_key)
+                else:
+                    del lane[chat_key]
+                if waiter.future.done():
+                    continue
+                waited = now - waiter.queued_at
+                if max_queue_age > 0 and waited > max_queue_age:
+                    waiter.future.set_result(False)
+                    continue
+                LLMScheduler._grant(waited)
+                waiter.future.set_result(True)
+
+    @staticmethod
+    def release() -> None:
+        """归还调用名额并放行下一个排队的触发"""
+        LLMScheduler._running = max(0, LLMScheduler._running - 1)
+        LLMScheduler._dispatch()
+
+    @staticmethod
+    def stats() -> Dict[str, float]:
+        """调度器的运行情况和累计统计"""
+        stats = LLMScheduler._stats
+        return {
+            "running": LLMScheduler._running,
+            "max_concurrency": LLMScheduler._max_concurrency(),
+            **{
+                f"queue_{name}": sum(len(waiters) for waiters in lane.values())
+                for name, lane in zip(LLMScheduler.LANE_NAMES, LLMScheduler._lanes)
+            },
+            "queued_chats": sum(len(lane) for lane in LLMScheduler._lanes),
+            "granted": stats["granted"],
+            "queued": stats["queued"],
+            "expired": stats["expired"],
+            "peak_queue": stats["peak_queue"],
+            "avg_wait": round(stats["total_wait"] / stats["granted"], 2) if stats["granted"] else 0.0,
+            "max_wait": round(stats["max_wait"], 2),
+        }
@@ -4,6 +4,7 @@ import time
 import threading
 from .history_storage import HistoryStorage
 from .message_utils import MessageUtils
+from .prompt_builder import PromptBuilder
 from astrbot.core.provider.entites import ProviderRequest
 
 class LLMUtils:
@@ -96,7 +97,12 @@ class LLMUtils:
             return LLMUtils._llm_call_status[chat_key].get("last_call_time")
     
     @staticmethod
-    async def call_llm(event: AstrMessageEvent, config: AstrBotConfig, context: Context) -> ProviderRequest:
+    async def call_llm(
+            event: AstrMessageEvent,
+            config: AstrBotConfig,
+            context: Context,
+            directed: bool = False
+        ) -> ProviderRequest:
         """
         构建调用大模型的请求对象
 
@@ -104,6 +110,7 @@ class LLMUtils:
             event: 消息对象
             config: 配置对象
             context: Context 对象，用于获取LLM工具管理器
+            directed: 是否是对机器人说的消息，是则使用 directed_history_limit 指定的较小聊天记录窗口
 
         Returns:
             ProviderRequest 对象
@@ -177,37 +184,32 @@ class LLMUtils:
             logger.error(f"获取人格信息失败: {e}")
 
         # 构建环境描述（注入到 system_prompt，不污染 prompt）
-        env_description = f"\n\n你正在浏览聊天软件，你在聊天软件上的id是{event.get_self_id()}"
+        env_description = await PromptBuilder.build_environment(event, platform_name, is_private, chat_id)
 
-        # 对于aiocqhttp平台，尝试获取bot用户名
-        if platform_name == "aiocqhttp" and hasattr(event, "bot"):
-            try:
-                bot = getattr(event, "bot")
-                bot_name = (await bot.api.get_login_info())["nickname"]
-                env_description += f"，用户名是{bot_name}"
-            except Exception as e:
-                logger.warning(f"通过 event.bot 获取机器人昵称失败: {e}")
-
-        if is_private:
-            sender_display_name = event.get_sender_name() if event.get_sender_name() else f"ID为 {event.get_sender_id()} 的人"
-            env_description += f"，你正在和 {sender_display_name} 私聊页面中。"
-        else:
-            group_display_name = chat_id
-            if platform_name in ["aiocqhttp", "gewechat"]:
-                try:
-                    group = await event.get_group()
-                    if group and group.group_name:
-                        group_display_name = f"{group.group_name}({chat_id})"
-                except Exception as e:
-                    logger.warning(f"为 {platform_name} 获取群组信息失败: {e}")
-            env_description += f"，你正在群聊 {group_display_name} 中。"
+        # 行为指引放在聊天记录之前，使人格、环境和指引组成的前缀在多次调用之间保持不变
+        env_description += PromptBuilder.GUIDELINES
 
         # 添加历史记录（文本格式，注入到 system_prompt）
         # 注意：基于 message_id 精确排除当前消息，避免重复
         history_limit = config.get("group_msg_history", 10)
-        history_messages = HistoryStorage.get_history(platform_name, is_private, chat_id)
+        history_drop_chunk = config.get("history_drop_chunk", 5)
+        window_key = LLMUtils.get_chat_key(platform_name, is_private, chat_id)
+        directed_history_limit = config.get("directed_history_limit", 0)
+        if directed and 0 < directed_history_limit < history_limit:
+            # 较小的窗口单独保存窗口状态，不影响普通回复的窗口起点
+            history_limit = directed_history_limit
+            window_key += PromptBuilder.DIRECTED_SUFFIX
+        # 大于0时在消息数上限内再按估算的token数限制聊天记录
+        history_token_budget = config.get("history_token_budget", 0)
+        # 窗口起点之后的消息都要取到，否则起点会落在取到的消息之外，窗口退化为逐条平移；
+        # 再多取一条，排除当前消息后条数不变
+        history_messages = await HistoryStorage.get_recent(
+            platform_name, is_private, chat_id,
+            PromptBuilder.fetch_count(history_limit, history_drop_chunk) + 1
+        )
 
         try:
+            history_for_context = []
             if history_messages:
                 # 获取当前消息的 message_id 用于精确排除
                 current_msg_id = getattr(event.message_obj, 'message_id', None) if hasattr(event, 'message_obj') else None
@@ -216,20 +218,13 @@ class LLMUtils:
                 else:
                     # 回退到排除最后一条
                     history_for_context = history_messages[:-1] if len(history_messages) > 1 else []
-                if history_for_context:
-                    formatted_history = await MessageUtils.format_history_for_llm(history_for_context, max_messages=history_limit, umo=umo)
-                    env_description += "\n\n以下是最近的聊天记录：\n" + formatted_history
-                else:
-                    env_description += "\n\n你没看见任何聊天记录，看来最近没有消息。"
-            else:
-                env_description += "\n\n你没看见任何聊天记录，看来最近没有消息。"
+            env_description += await PromptBuilder.build_history(
+                window_key, history_for_context, history_limit, history_drop_chunk,
+                umo=umo, token_budget=history_token_budget
+            )
         except Exception as e:
             logger.error(f"获取或格式化历史记录失败: {e}")
-            env_description += "\n\n你没看见任何聊天记录，看来最近没有消息。"
-
-        # 行为指引
-        env_description += "\n(在聊天记录中，你的用户名以AstrBot被代替了)"
-        env_description += "\n(如果你想回复某人，不要使用类似 [At:id(昵称)]这样的格式)"
+            env_description += PromptBuilder.EMPTY_HISTORY
 
         if config.get("read_air", False):
             env_description += "\n\n现在你收到了一条新消息，你的反应是:\n(如果你想发送一条消息，直接输出发送的内容，如果你选择忽略，直接输出<NO_RESPONSE>)"
@@ -284,6 +279,8 @@ class LLMUtils:
         else:
             prompt = event.get_message_outline()
 
+        # 标记这次请求由插件发起，只统计插件自己的token用量
+        LLMUtils.mark_own_request(event)
         return event.request_llm(
             prompt=prompt,
             func_tool_manager=func_tools_mgr,
@@ -292,6 +289,19 @@ class LLMUtils:
             image_urls=image_urls,
         )
     
+    @staticmethod
+    def mark_own_request(event: AstrMessageEvent) -> None:
+        """标记事件的大模型请求由插件发起"""
+        try:
+            event._spectrecore_llm_request = True
+        except AttributeError:
+            pass
+
+    @staticmethod
+    def is_own_request(event: AstrMessageEvent) -> bool:
+        """事件的大模型请求是否由插件发起"""
+        return getattr(event, "_spectrecore_llm_request", False) is True
+
     @staticmethod
     def clear_call_status(platform_name: str, is_private_chat: bool, chat_id: str) -> None:
         """
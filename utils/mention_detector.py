@@ -0,0 +1,78 @@
+from astrbot.api.all import *
+from typing import Optional, Tuple
+from .prompt_builder import PromptBuilder
+
+
+class MentionDetector:
+    """
+    判断群消息是否是对机器人说的
+
+    按消息链的结构判断，不依赖关键词配置：
+    @了机器人、回复了机器人的消息，或文本中提到机器人的昵称。
+    昵称包括配置的 bot_nicknames 和从平台获取的机器人昵称（需要先调用 PromptBuilder.resolve_bot_name）。
+    只带唤醒词的指令（如 /sc help）不算。结果记在事件对象上，同一条消息只判断一次。
+    """
+
+    REASON_AT = "at"
+    REASON_REPLY = "reply"
+    REASON_NAME = "name"
+    # 昵称至少多长才按文本匹配，太短的昵称容易误判
+    MIN_NAME_LENGTH = 2
+
+    # 配置的机器人昵称
+    nicknames: Tuple[str, ...] = ()
+
+    @staticmethod
+    def init(config: AstrBotConfig):
+        """读取配置的机器人昵称"""
+        MentionDetector.nicknames = tuple(
+            str(name).strip() for name in (config.get("bot_nicknames", []) if config else [])
+            if len(str(name).strip()) >= MentionDetector.MIN_NAME_LENGTH
+        )
+
+    @staticmethod
+    def _get_nicknames(event: AstrMessageEvent) -> Tuple[str, ...]:
+        """配置的昵称和从平台获取的昵称"""
+        bot_name = PromptBuilder.get_bot_name(event.get_platform_name(), str(event.get_self_id()))
+        if bot_name and len(bot_name) >= MentionDetector.MIN_NAME_LENGTH and bot_name not in MentionDetector.nicknames:
+            return MentionDetector.nicknames + (bot_name,)
+        return MentionDetector.nicknames
+
+    @staticmethod
+    def detect(event: AstrMessageEvent) -> Optional[str]:
+        """
+        判断消息是否是对机器人说的
+
+        Args:
+            event: 消息事件
+
+        Returns:
+            判断依据（REASON_*），不是对机器人说的返回None
+        """
+        cached = getattr(event, "_spectrecore_mention", False)
+        if cached is not False:
+            return cached
+
+        reason = None
+        self_id = str(event.get_self_id())
+        nicknames = MentionDetector._get_nicknames(event)
+        for component in getattr(event.message_obj, "message", None) or []:
+            if isinstance(component, At) and str(getattr(component, "qq", "")) == self_id:
+                reason = MentionDetector.REASON_AT
+            elif isinstance(component, Reply) and str(getattr(component, "sender_id", "")) == self_id:
+                reason = MentionDetector.REASON_REPLY
+            elif nicknames and isinstance(component, Plain) and any(name in (component.text or "") for name in nicknames):
+                reason = MentionDetector.REASON_NAME
+            if reason:
+                break
+
+        try:
+            event._spectrecore_mention = reason
+        except AttributeError:
+            pass
+        return reason
+
+    @staticmethod
+    def is_directed(event: AstrMessageEvent) -> bool:
+        """消息是否是对机器人说的"""
+        return MentionDetector.detect(event) is not None
@@ -1,5 +1,6 @@
 from astrbot.api.all import *
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from typing import List, Dict, Any, NamedTuple, Optional, Tuple, Union
 import os
 import time
 from datetime import datetime
@@ -9,16 +10,68 @@ import json
 import traceback
 
 
+class ImageSlot(NamedTuple):
+    """概要中待填入描述的图片"""
+    # 用于转述的图片来源（本地路径、URL或base64）
+    source: str
+
+
+class ReplySlot(NamedTuple):
+    """概要中的引用消息，内容可能包含图片，渲染时再截断"""
+    sender_info: str
+    # 被引用消息的概要模板，为空时使用fallback
+    parts: Optional[List["OutlinePart"]]
+    fallback: str
+
+
+OutlinePart = Union[str, ImageSlot, ReplySlot]
+
+
+class OutlineTemplate:
+    """
+    单条历史消息的概要模板
+
+    组件类型分派、卡片解析、时间格式化和图片文件检查只在生成模板时执行一次，
+    图片位置留空，渲染时填入描述；描述不变时直接复用上次的渲染结果
+    """
+
+    __slots__ = ("header", "parts", "images", "_rendered", "_rendered_captions")
+
+    def __init__(self, header: str, parts: List[OutlinePart]):
+        self.header = header
+        self.parts = parts
+        self.images = MessageUtils.template_images(parts)
+        self._rendered: Optional[str] = None
+        self._rendered_captions: Optional[Tuple[Optional[str], ...]] = None
+
+    def render(self, captions: Dict[str, Optional[str]]) -> str:
+        """填入图片描述，得到完整的消息文本"""
+        used = tuple(captions.get(image) for image in self.images)
+        if self._rendered is None or used != self._rendered_captions:
+            self._rendered = self.header + MessageUtils.render_outline(self.parts, captions)
+            self._rendered_captions = used
+        return self._rendered
+
+
 class MessageUtils:
     """
     消息处理工具类
     """
-        
+
+    # 历史消息的概要模板缓存 {(消息ID, 时间戳, 发送者ID, 群号): 模板}
+    _templates: "OrderedDict[tuple, OutlineTemplate]" = OrderedDict()
+    # 缓存的模板条数上限
+    TEMPLATE_CACHE_SIZE = 4096
+    # 历史消息之间的分割线
+    HISTORY_DIVIDER = "\n" + "-" + "\n"
+
     @staticmethod
     async def format_history_for_llm(history_messages: List[AstrBotMessage], max_messages: int = 20, umo: Optional[str] = None) -> str:
         """
         将历史消息列表格式化为适合输入给大模型的文本格式
 
+        每条消息的概要模板只生成一次并按消息缓存，窗口内所有图片统一并发转述后填入模板
+
         Args:
             history_messages: 历史消息列表
             max_messages: 最大消息数量，默认20条
@@ -29,50 +82,142 @@ class MessageUtils:
         """
         if not history_messages:
             return ""
-        
+
         # 限制消息数量
         if len(history_messages) > max_messages:
             history_messages = history_messages[-max_messages:]
-        
-        formatted_text = ""
-        divider = "\n" + "-" + "\n"
-        
-        for idx, msg in enumerate(history_messages):
-            # 获取发送者信息
-            sender_name = "未知用户"
-            sender_id = "unknown"
-            if hasattr(msg, "sender") and msg.sender:
-                sender_name = msg.sender.nickname or "未知用户"
-                sender_id = msg.sender.user_id or "unknown"
-            
-            # 获取发送时间
-            send_time = "未知时间"
-            if hasattr(msg, "timestamp") and msg.timestamp:
-                try:
-                    time_obj = datetime.fromtimestamp(msg.timestamp)
-                    send_time = time_obj.strftime("%Y-%m-%d %H:%M:%S")
-                except:
-                    pass
-            
-            # 获取消息内容 (异步调用)
-            message_content = await MessageUtils.outline_message_list(msg.message, umo=umo) if hasattr(msg, "message") and msg.message else ""
-            
-            # 格式化该条消息
-            message_text = f"发送者: {sender_name} (ID: {sender_id})\n"
-            message_text += f"时间: {send_time}\n"
-            message_text += f"内容: {message_content}"
-            
-            # 添加到结果中
-            formatted_text += message_text
-            
-            # 除了最后一条消息，每条消息后添加分割线
-            if idx < len(history_messages) - 1:
-                formatted_text += divider
-        
-        return formatted_text
-           
+
+        # 每条消息之间添加分割线
+        return MessageUtils.HISTORY_DIVIDER.join(await MessageUtils.render_history(history_messages, umo=umo))
+
+    @staticmethod
+    async def render_history(history_messages: List[AstrBotMessage], umo: Optional[str] = None) -> List[str]:
+        """
+        将历史消息逐条渲染为文本
+
+        窗口内所有图片先统一并发转述，再填入各条消息的概要模板；
+        描述没有变化的消息返回与上次相同的字符串对象
+
+        Args:
+            history_messages: 历史消息列表
+            umo: unified_msg_origin，用于 UMO 路由
+
+        Returns:
+            每条消息的文本
+        """
+        templates = [MessageUtils.get_outline_template(msg) for msg in history_messages]
+
+        # 收集窗口内的所有图片，一次性并发转述
+        images = [image for template in templates for image in template.images]
+        captions = await ImageCaptionUtils.generate_captions(images, umo=umo)
+        return [template.render(captions) for template in templates]
+
+    @staticmethod
+    def message_key(msg: AstrBotMessage) -> Optional[tuple]:
+        """历史消息的唯一标识 (消息ID, 时间戳, 发送者ID, 群号)，没有消息ID时返回None"""
+        message_id = str(getattr(msg, "message_id", "") or "")
+        if not message_id:
+            return None
+        sender = getattr(msg, "sender", None)
+        return (
+            message_id,
+            getattr(msg, "timestamp", 0),
+            getattr(sender, "user_id", "") if sender else "",
+            getattr(msg, "group_id", ""),
+        )
+
+    @staticmethod
+    def get_outline_template(msg: AstrBotMessage) -> OutlineTemplate:
+        """
+        获取历史消息的概要模板，有消息ID的消息按 (消息ID, 时间戳, 发送者, 群号) 缓存
+
+        Args:
+            msg: 历史消息
+
+        Returns:
+            概要模板
+        """
+        key = MessageUtils.message_key(msg)
+        if key is not None:
+            template = MessageUtils._templates.get(key)
+            if template is not None:
+                MessageUtils._templates.move_to_end(key)
+                return template
+
+        template = MessageUtils._build_template(msg)
+        if key is not None:
+            MessageUtils._templates[key] = template
+            while len(MessageUtils._templates) > MessageUtils.TEMPLATE_CACHE_SIZE:
+                MessageUtils._templates.popitem(last=False)
+        return template
+
+    @staticmethod
+    def _build_template(msg: AstrBotMessage) -> OutlineTemplate:
+        """生成一条历史消息的概要模板"""
+        # 获取发送者信息
+        sender_name = "未知用户"
+        sender_id = "unknown"
+        if hasattr(msg, "sender") and msg.sender:
+            sender_name = msg.sender.nickname or "未知用户"
+            sender_id = msg.sender.user_id or "unknown"
+
+        # 获取发送时间
+        send_time = "未知时间"
+        if hasattr(msg, "timestamp") and msg.timestamp:
+            try:
+                time_obj = datetime.fromtimestamp(msg.timestamp)
+                send_time = time_obj.strftime("%Y-%m-%d %H:%M:%S")
+            except:
+                pass
+
+        header = f"发送者: {sender_name} (ID: {sender_id})\n"
+        header += f"时间: {send_time}\n"
+        header += "内容: "
+        parts = MessageUtils.build_outline(msg.message) if hasattr(msg, "message") and msg.message else []
+        return OutlineTemplate(header, parts)
+
     @staticmethod
-    async def outline_message_list(message_list: List[BaseMessageComponent], umo: Optional[str] = None) -> str:
+    def _image_source(component: Image) -> Optional[str]:
+        """
+        获取用于转述的图片来源
+
+        Returns:
+            本地路径、URL或base64，持久化文件不存在时返回空字符串，没有图片时返回None
+        """
+        image = component.file if component.file else component.url
+        if not image:
+            return None
+        if image.startswith("file:///"):
+            image_path = image[8:]
+            return image_path if os.path.exists(image_path) else ""
+        return image
+
+    @staticmethod
+    def collect_image_sources(message_list: List[BaseMessageComponent]) -> List[str]:
+        """收集消息组件（包括引用消息）中需要转述的图片"""
+        images = []
+        for component in message_list:
+            if isinstance(component, Image):
+                image = MessageUtils._image_source(component)
+                if image:
+                    images.append(image)
+            elif isinstance(component, Reply) and getattr(component, "chain", None):
+                images += MessageUtils.collect_image_sources(component.chain)
+        return images
+
+    @staticmethod
+    def template_images(parts: List[OutlinePart]) -> List[str]:
+        """收集概要模板（包括引用消息）中待填入描述的图片"""
+        images = []
+        for part in parts:
+            if isinstance(part, ImageSlot):
+                images.append(part.source)
+            elif isinstance(part, ReplySlot) and part.parts:
+                images += MessageUtils.template_images(part.parts)
+        return images
+
+    @staticmethod
+    async def outline_message_list(message_list: List[BaseMessageComponent], umo: Optional[str] = None, captions: Optional[Dict[str, Optional[str]]] = None) -> str:
         """
         获取消息概要。
         使用类型检查而不是类实例检查，避免依赖不存在的类。
@@ -80,77 +225,116 @@ class MessageUtils:
         Args:
             message_list: 消息组件列表
             umo: unified_msg_origin，用于 UMO 路由
+            captions: 预先生成的 {图片: 描述}，为空时先并发转述本消息中的图片
+        """
+        parts = MessageUtils.build_outline(message_list)
+        if captions is None:
+            captions = await ImageCaptionUtils.generate_captions(MessageUtils.template_images(parts), umo=umo)
+        return MessageUtils.render_outline(parts, captions)
+
+    @staticmethod
+    def render_outline(parts: List[OutlinePart], captions: Dict[str, Optional[str]]) -> str:
+        """
+        将概要模板渲染为文本
+
+        Args:
+            parts: 概要模板
+            captions: {图片: 描述}，没有描述的图片显示为[图片]
+        """
+        outline = []
+        for part in parts:
+            if isinstance(part, str):
+                outline.append(part)
+            elif isinstance(part, ImageSlot):
+                caption = captions.get(part.source)
+                outline.append(f"[图片: {caption}]" if caption else "[图片]")
+            else:
+                reply_content = MessageUtils.render_outline(part.parts, captions) if part.parts else part.fallback
+                # 限制回复内容长度，避免过长
+                if len(reply_content) > 150:
+                    reply_content = reply_content[:150] + "..."
+                outline.append(f"「↪ 引用消息 {part.sender_info}：{reply_content}」")
+        return "".join(outline)
+
+    @staticmethod
+    def build_outline(message_list: List[BaseMessageComponent]) -> List[OutlinePart]:
         """
-        outline = ""
+        生成消息概要模板，图片和引用消息留待渲染时填入描述
+
+        Args:
+            message_list: 消息组件列表
+
+        Returns:
+            由文本、ImageSlot和ReplySlot组成的列表，相邻文本已合并
+        """
+        parts: List[OutlinePart] = []
+
+        def append(part: OutlinePart) -> None:
+            if isinstance(part, str) and parts and isinstance(parts[-1], str):
+                parts[-1] += part
+            else:
+                parts.append(part)
+
         for i in message_list:
             try:
                 # 获取组件类型
                 component_type = getattr(i, 'type', None)
                 if not component_type:
                     component_type = i.__class__.__name__.lower()
-                
+
                 # 特别优化 Reply 组件的处理
                 if component_type == "reply" or isinstance(i, Reply):
-                    outline += await MessageUtils._format_reply_component(i, umo=umo)
+                    append(MessageUtils._format_reply_component(i))
                     continue
-                
+
                 # 根据类型处理不同的消息组件
                 elif component_type == "plain" or isinstance(i, Plain):
-                    outline += i.text
+                    append(i.text)
                 elif component_type == "image" or isinstance(i, Image):
                     # 图片处理逻辑
                     try:
-                        image = i.file if i.file else i.url
-                        if image:
-                            if image.startswith("file:///"):
-                                image_path = image[8:]
-                                if not os.path.exists(image_path):
-                                    logger.warning(f"持久化图片文件不存在: {image_path}")
-                                    outline += f"[图片: 文件不存在]"
-                                    continue
-                                image = image_path
-
-                            caption = await ImageCaptionUtils.generate_image_caption(image, umo=umo)
-                            if caption:
-                                outline += f"[图片: {caption}]"
-                            else:
-                                outline += f"[图片]"
+                        image = MessageUtils._image_source(i)
+                        if image == "":
+                            logger.warning(f"持久化图片文件不存在: {i.file[8:]}")
+                            append(f"[图片: 文件不存在]")
+                        elif image:
+                            append(ImageSlot(image))
                         else:
-                            outline += f"[图片]"
+                            append(f"[图片]")
                     except Exception as e:
                         logger.error(f"处理图片消息失败: {e}")
-                        outline += "[图片]"
+                        append("[图片]")
                 elif component_type == "face" or isinstance(i, Face):
-                    outline += f"[表情:{getattr(i, 'id', '')}]"
+                    append(f"[表情:{getattr(i, 'id', '')}]")
                 elif component_type == "at" or isinstance(i, At):
                     qq = getattr(i, 'qq', '')
                     name = getattr(i, 'name', '')
-                    
+
                     # 处理全体@
                     if str(qq).lower() == "all":
-                        outline += "@全体成员"
+                        append("@全体成员")
                     # 有昵称时显示昵称+QQ
                     elif name:
-                        outline += f"@{name}({qq})"
+                        append(f"@{name}({qq})")
                     # 没有昵称时只显示QQ
                     else:
-                        outline += f"@{qq}"
+                        append(f"@{qq}")
                 elif component_type == "record" or isinstance(i, Record):
-                    outline += "[语音]"
+                    append("[语音]")
                 elif component_type == "video" or isinstance(i, Video):
-                    outline += "[视频]"
+                    append("[视频]")
                 elif component_type == "share" or isinstance(i, Share):
-                    outline += f"[分享:《{getattr(i, 'title', '')}》{getattr(i, 'content', '') if hasattr(i, 'content') and i.content else ''}]"
+                    append(f"[分享:《{getattr(i, 'title', '')}》{getattr(i, 'content', '') if hasattr(i, 'content') and i.content else ''}]")
                 elif component_type == "contact" or isinstance(i, Contact):
-                    outline += f"[联系人:{getattr(i, 'id', '')}]"
+                    append(f"[联系人:{getattr(i, 'id', '')}]")
                 elif component_type == "location" or isinstance(i, Location):
-                    outline += f"[位置:{getattr(i, 'title', '')}{f'({i.content})' if hasattr(i, 'content') and i.content else ''}]"
+                    append(f"[位置:{getattr(i, 'title', '')}{f'({i.content})' if hasattr(i, 'content') and i.content else ''}]")
                 elif component_type == "music" or isinstance(i, Music):
-                    outline += f"[音乐:{getattr(i, 'title', '')}{f'({i.content})' if hasattr(i, 'content') and i.content else ''}]"
+                    append(f"[音乐:{getattr(i, 'title', '')}{f'({i.content})' if hasattr(i, 'content') and i.content else ''}]")
                 elif component_type == "poke" or isinstance(i, Poke):
-                    outline += f"[戳一戳 对:{getattr(i, 'qq', '')}]"
+                    append(f"[戳一戳 对:{getattr(i, 'qq', '')}]")
                 elif component_type in ["forward", "node", "nodes"] or isinstance(i, (Forward, Node, Nodes)):
-                    outline += f"[合并转发消息]"
+                    append(f"[合并转发消息]")
                 elif component_type == "json" or isinstance(i, Json):
                     # JSON处理逻辑
                     data = getattr(i, 'data', None)
@@ -158,60 +342,62 @@ class MessageUtils:
                         try:
                             json_data = json.loads(data)
                             if "prompt" in json_data:
-                                outline += f"[JSON卡片:{json_data.get('prompt', '')}]"
+                                append(f"[JSON卡片:{json_data.get('prompt', '')}]")
                             elif "app" in json_data:
-                                outline += f"[小程序:{json_data.get('app', '')}]"
+                                append(f"[小程序:{json_data.get('app', '')}]")
                             else:
-                                outline += "[JSON消息]"
+                                append("[JSON消息]")
                         except (json.JSONDecodeError, ValueError, TypeError):
-                            outline += "[JSON消息]"
+                            append("[JSON消息]")
                     else:
-                        outline += "[JSON消息]"
+                        append("[JSON消息]")
                 elif component_type in ["rps", "dice", "shake"] or isinstance(i, (RPS, Dice, Shake)):
                     # 这些可能是游戏类型的消息
-                    outline += f"[{component_type}]"
+                    append(f"[{component_type}]")
                 elif component_type == "file" or isinstance(i, File):
-                    outline += f"[文件:{getattr(i, 'name', '')}]"
+                    append(f"[文件:{getattr(i, 'name', '')}]")
                 elif component_type == "wechatemoji" or isinstance(i, WechatEmoji):
-                    outline += "[微信表情]"
+                    append("[微信表情]")
                 else:
                     # 处理被移除的组件类型
                     if component_type == "anonymous":
-                        outline += "[匿名]"
+                        append("[匿名]")
                     elif component_type == "redbag":
-                        outline += "[红包]"
+                        append("[红包]")
                     elif component_type == "xml":
-                        outline += "[XML消息]"
+                        append("[XML消息]")
                     elif component_type == "cardimage":
-                        outline += "[卡片图片]"
+                        append("[卡片图片]")
                     elif component_type == "tts":
-                        outline += "[TTS]"
+                        append("[TTS]")
                     else:
                         # 未知类型的消息组件
-                        outline += f"[{component_type}]"
-                    
+                        append(f"[{component_type}]")
+
             except Exception as e:
                 logger.error(f"处理消息组件时出错: {e}")
                 logger.error(f"错误详情: {traceback.format_exc()}")
-                outline += f"[处理失败的消息组件]"
+                append(f"[处理失败的消息组件]")
                 continue
-                
-        return outline
+
+        return parts
 
     @staticmethod
-    async def _format_reply_component(reply_component: Reply, umo: Optional[str] = None) -> str:
+    def _format_reply_component(reply_component: Reply) -> OutlinePart:
         """
         优化格式化引用回复组件
 
         Args:
             reply_component: 回复组件
-            umo: unified_msg_origin，用于 UMO 路由
+
+        Returns:
+            引用消息的模板，内容在渲染时填入图片描述并截断
         """
         try:
             # 构建发送者信息
             sender_id = getattr(reply_component, 'sender_id', '')
             sender_nickname = getattr(reply_component, 'sender_nickname', '')
-            
+
             sender_info = ""
             if sender_nickname:
                 sender_info = f"{sender_nickname}({sender_id})"
@@ -219,13 +405,10 @@ class MessageUtils:
                 sender_info = f"{sender_id}"
             else:
                 sender_info = "未知用户"
-            
-            # 获取被引用消息的内容
-            reply_content = ""
-            
+
             # 优先使用 chain（原始消息组件）
             if hasattr(reply_component, 'chain') and reply_component.chain:
-                reply_content = await MessageUtils.outline_message_list(reply_component.chain, umo=umo)
+                return ReplySlot(sender_info, MessageUtils.build_outline(reply_component.chain), "")
             # 其次使用 message_str（纯文本消息）
             elif hasattr(reply_component, 'message_str') and reply_component.message_str:
                 reply_content = reply_component.message_str
@@ -234,16 +417,9 @@ class MessageUtils:
                 reply_content = reply_component.text
             else:
                 reply_content = "[内容不可用]"
-            
-            # 限制回复内容长度，避免过长
-            if len(reply_content) > 150:
-                reply_content = reply_content[:150] + "..."
-            
-            # 构建格式化的回复显示
-            formatted_reply = f"「↪ 引用消息 {sender_info}：{reply_content}」"
-            
-            return formatted_reply
-            
+
+            return ReplySlot(sender_info, None, reply_content)
+
         except Exception as e:
             logger.error(f"格式化回复组件时出错: {e}")
             return "[回复消息]"
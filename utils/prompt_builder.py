@@ -0,0 +1,309 @@
+from astrbot.api.all import *
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import time
+from .message_utils import MessageUtils
+from .token_estimator import TokenEstimator
+
+
+class PromptBuilder:
+    """
+    系统提示词构建工具类
+
+    系统提示词按 人格 | 环境 | 行为指引 | 聊天记录 | 当前指令 的顺序拼接，
+    前三部分在同一聊天的多次调用之间保持逐字节不变，便于提供商的前缀缓存命中。
+    聊天记录窗口的起点固定在某条消息上，新消息只追加在末尾，
+    窗口超过上限时一次从头部丢弃一整块消息，而不是每条新消息都整体平移一条。
+    每个聊天保留上次渲染的聊天记录文本，新消息到来时只拼接新增的部分。
+    设置了token预算时，窗口同样按块丢弃直到估算的token数不超过预算，过长的消息按比例截断。
+    """
+
+    # 行为指引
+    GUIDELINES = (
+        "\n(在聊天记录中，你的用户名以AstrBot被代替了)"
+        "\n(如果你想回复某人，不要使用类似 [At:id(昵称)]这样的格式)"
+    )
+    HISTORY_HEADER = "\n\n以下是最近的聊天记录：\n"
+    EMPTY_HISTORY = "\n\n你没看见任何聊天记录，看来最近没有消息。"
+    # 机器人昵称和群名称的缓存时间（秒）
+    NAME_CACHE_TTL = 3600
+    # 获取失败后多久再重试（秒）
+    NAME_RETRY_TTL = 60
+    # 最多保留多少个聊天的窗口状态
+    MAX_CHATS = 1024
+    # token预算模式下单条消息最多占预算的比例
+    MESSAGE_TOKEN_SHARE = 0.25
+    # 对机器人说的消息使用较小窗口时，窗口状态保存在 聊天标识+后缀 下
+    DIRECTED_SUFFIX = "_directed"
+
+    # 每个聊天的窗口起点 {聊天标识: 起点消息的标识}
+    _anchors: "OrderedDict[str, tuple]" = OrderedDict()
+    # 每个聊天上次渲染的聊天记录 {聊天标识: (每条消息的文本, 拼接后的文本)}
+    _buffers: "OrderedDict[str, Tuple[List[str], str]]" = OrderedDict()
+    # 机器人昵称和群名称缓存 {键: (名称, 过期时间)}
+    _names: Dict[str, Tuple[str, float]] = {}
+
+    @staticmethod
+    def _remember(cache: OrderedDict, chat_key: str, value) -> None:
+        """保存聊天的状态，超出聊天数上限时淘汰最久未使用的聊天"""
+        cache[chat_key] = value
+        cache.move_to_end(chat_key)
+        while len(cache) > PromptBuilder.MAX_CHATS:
+            cache.popitem(last=False)
+
+    @staticmethod
+    def message_token_cap(token_budget: int) -> int:
+        """token预算模式下单条消息的token上限"""
+        return max(1, int(token_budget * PromptBuilder.MESSAGE_TOKEN_SHARE))
+
+    @staticmethod
+    def fetch_count(limit: int, chunk: int) -> int:
+        """
+        选取窗口时需要读取的最近消息数
+
+        上次的窗口最多有 limit 条，两次调用之间新增的消息也要包含在内，
+        否则起点不在读取的消息中。这里多读 max(chunk, limit) 条，
+        两次调用之间新增的消息超过这个数时窗口重新从最近的 limit 条开始。
+
+        Args:
+            limit: 窗口最多包含的消息数
+            chunk: 每次从头部丢弃的消息数
+
+        Returns:
+            需要读取的消息数
+        """
+        if limit <= 0:
+            return 0
+        return limit + max(chunk, limit)
+
+    @staticmethod
+    def select_window(
+            chat_key: str,
+            messages: List[AstrBotMessage],
+            limit: int,
+            chunk: int,
+            token_budget: int = 0
+        ) -> List[AstrBotMessage]:
+        """
+        选出放入提示词的聊天记录窗口
+
+        窗口从上次的起点开始包含之后的所有消息，超过 limit 条时按 chunk 条一块从头部丢弃，
+        窗口长度在 limit-chunk+1 到 limit 之间。起点不在 messages 中时（如记录被重置）
+        重新从最近的 limit 条开始。设置了 token_budget 时继续按块丢弃，
+        直到窗口内消息的估算token数（单条按上限截断后）不超过预算，至少保留最近一条。
+
+        Args:
+            chat_key: 聊天标识
+            messages: 按时间顺序排列的最近消息，应包含最近 fetch_count(limit, chunk) 条
+            limit: 窗口最多包含的消息数
+            chunk: 每次从头部丢弃的消息数
+            token_budget: 聊天记录的token预算，0为不限制
+
+        Returns:
+            窗口内的消息
+        """
+        if limit <= 0 or not messages:
+            PromptBuilder._anchors.pop(chat_key, None)
+            return []
+        chunk = max(1, min(chunk, limit))
+
+        start = None
+        anchor = PromptBuilder._anchors.get(chat_key)
+        if anchor is not None:
+            for index, msg in enumerate(messages):
+                if MessageUtils.message_key(msg) == anchor:
+                    start = index
+                    break
+        if start is None:
+            start = max(0, len(messages) - limit)
+
+        overflow = len(messages) - start - limit
+        if overflow > 0:
+            # 向上取整到整块
+            start += -(-overflow // chunk) * chunk
+
+        if token_budget > 0:
+            max_tokens = PromptBuilder.message_token_cap(token_budget)
+            tokens = [min(TokenEstimator.get(msg), max_tokens) for msg in messages[start:]]
+            total = sum(tokens)
+            dropped = 0
+            while total > token_budget and len(tokens) - dropped > 1:
+                step = min(chunk, len(tokens) - dropped - 1)
+                total -= sum(tokens[dropped:dropped + step])
+                dropped += step
+            start += dropped
+
+        window = messages[start:]
+        key = MessageUtils.message_key(window[0])
+        if key is None:
+            PromptBuilder._anchors.pop(chat_key, None)
+        else:
+            PromptBuilder._remember(PromptBuilder._anchors, chat_key, key)
+        return window
+
+    @staticmethod
+    def join_history(chat_key: str, texts: List[str]) -> str:
+        """
+        拼接聊天记录文本
+
+        上次的文本是本次的前缀时只拼接新增的消息，否则重新拼接
+
+        Args:
+            chat_key: 聊天标识
+            texts: 每条消息的文本
+
+        Returns:
+            用分割线连接的聊天记录
+        """
+        divider = MessageUtils.HISTORY_DIVIDER
+        buffer = PromptBuilder._buffers.get(chat_key)
+        text = None
+        if buffer is not None:
+            previous, previous_text = buffer
+            count = len(previous)
+            if count <= len(texts) and all(a is b or a == b for a, b in zip(previous, texts)):
+                added = texts[count:]
+                if not added:
+                    text = previous_text
+                elif count:
+                    text = previous_text + divider + divider.join(added)
+        if text is None:
+            text = divider.join(texts)
+        PromptBuilder._remember(PromptBuilder._buffers, chat_key, (list(texts), text))
+        return text
+
+    @staticmethod
+    async def build_history(
+            chat_key: str,
+            history_messages: List[AstrBotMessage],
+            limit: int,
+            chunk: int,
+            umo: Optional[str] = None,
+            token_budget: int = 0
+        ) -> str:
+        """
+        生成系统提示词中的聊天记录部分
+
+        Args:
+            chat_key: 聊天标识
+            history_messages: 已排除当前消息的最近历史消息
+            limit: 窗口最多包含的消息数
+            chunk: 每次从头部丢弃的消息数
+            umo: unified_msg_origin，用于 UMO 路由
+            token_budget: 聊天记录的token预算，0为不限制
+
+        Returns:
+            聊天记录部分的文本
+        """
+        window = PromptBuilder.select_window(chat_key, history_messages, limit, chunk, token_budget)
+        if not window:
+            return PromptBuilder.EMPTY_HISTORY
+        texts = await MessageUtils.render_history(window, umo=umo)
+        if token_budget > 0:
+            # 超出单条上限的消息（包括其中的引用内容）按比例截断
+            max_tokens = PromptBuilder.message_token_cap(token_budget)
+            texts = [
+                TokenEstimator.truncate(text, TokenEstimator.get(msg), max_tokens)
+                for msg, text in zip(window, texts)
+            ]
+        return PromptBuilder.HISTORY_HEADER + PromptBuilder.join_history(chat_key, texts)
+
+    @staticmethod
+    def _get_cached_name(key: str) -> Optional[str]:
+        """读取未过期的名称缓存"""
+        cached = PromptBuilder._names.get(key)
+        if cached and cached[1] > time.time():
+            return cached[0]
+        return None
+
+    @staticmethod
+    def _set_cached_name(key: str, name: str, ttl: Optional[float] = None) -> None:
+        """缓存名称"""
+        ttl = PromptBuilder.NAME_CACHE_TTL if ttl is None else ttl
+        PromptBuilder._names[key] = (name, time.time() + ttl)
+
+    @staticmethod
+    def get_bot_name(platform_name: str, self_id: str) -> Optional[str]:
+        """获取缓存的机器人昵称，还没有获取过或获取失败时返回None"""
+        return PromptBuilder._get_cached_name(f"bot:{platform_name}:{self_id}") or None
+
+    @staticmethod
+    async def resolve_bot_name(event: AstrMessageEvent) -> Optional[str]:
+        """
+        获取机器人昵称，未缓存时请求平台接口并缓存
+
+        目前只有aiocqhttp平台可以获取，获取失败时 NAME_RETRY_TTL 秒内不再重试
+
+        Args:
+            event: 消息事件
+
+        Returns:
+            机器人昵称，无法获取时返回None
+        """
+        platform_name = event.get_platform_name()
+        name_key = f"bot:{platform_name}:{event.get_self_id()}"
+        bot_name = PromptBuilder._get_cached_name(name_key)
+        if bot_name is not None:
+            return bot_name or None
+        if platform_name != "aiocqhttp" or not hasattr(event, "bot"):
+            return None
+        try:
+            bot = getattr(event, "bot")
+            bot_name = (await bot.api.get_login_info())["nickname"]
+            PromptBuilder._set_cached_name(name_key, bot_name)
+            return bot_name or None
+        except Exception as e:
+            logger.warning(f"通过 event.bot 获取机器人昵称失败: {e}")
+            PromptBuilder._set_cached_name(name_key, "", PromptBuilder.NAME_RETRY_TTL)
+            return None
+
+    @staticmethod
+    async def build_environment(event: AstrMessageEvent, platform_name: str, is_private: bool, chat_id: str) -> str:
+        """
+        生成系统提示词中的环境描述
+
+        机器人昵称和群名称会缓存一段时间，不在每次调用时请求平台接口
+
+        Args:
+            event: 消息事件
+            platform_name: 平台名称
+            is_private: 是否为私聊
+            chat_id: 聊天ID
+
+        Returns:
+            环境描述文本
+        """
+        self_id = event.get_self_id()
+        env_description = f"\n\n你正在浏览聊天软件，你在聊天软件上的id是{self_id}"
+
+        # 对于aiocqhttp平台，尝试获取bot用户名
+        bot_name = await PromptBuilder.resolve_bot_name(event)
+        if bot_name:
+            env_description += f"，用户名是{bot_name}"
+
+        if is_private:
+            sender_display_name = event.get_sender_name() if event.get_sender_name() else f"ID为 {event.get_sender_id()} 的人"
+            env_description += f"，你正在和 {sender_display_name} 私聊页面中。"
+        else:
+            group_display_name = chat_id
+            if platform_name in ["aiocqhttp", "gewechat"]:
+                name_key = f"group:{platform_name}:{chat_id}"
+                group_name = PromptBuilder._get_cached_name(name_key)
+                if group_name is None:
+                    try:
+                        group = await event.get_group()
+                        group_name = group.group_name if group and group.group_name else ""
+                        PromptBuilder._set_cached_name(name_key, group_name)
+                    except Exception as e:
+                        logger.warning(f"为 {platform_name} 获取群组信息失败: {e}")
+                if group_name:
+                    group_display_name = f"{group_name}({chat_id})"
+            env_description += f"，你正在群聊 {group_display_name} 中。"
+        return env_description
+
+    @staticmethod
+    def clear_chat(chat_key: str) -> None:
+        """清除聊天的窗口状态，在重置历史记录时调用"""
+        for key in (chat_key, chat_key + PromptBuilder.DIRECTED_SUFFIX):
+            PromptBuilder._anchors.pop(key, None)
+            PromptBuilder._buffers.pop(key, None)
@@ -0,0 +1,192 @@
+from astrbot.api.all import *
+from typing import Any, Dict
+import json
+import jsonpickle
+
+try:
+    import msgpack
+except ImportError:  # msgpack 为可选依赖
+    msgpack = None
+
+
+class RecordCodec:
+    """
+    历史记录编解码工具类
+
+    将AstrBotMessage转换为带版本号的紧凑记录，只保留构建上下文需要的字段：
+    {"v": 1, "id": 消息ID, "ts": 时间戳, "type": 消息类型, "gid": 群号,
+     "self": 机器人ID, "sess": 会话ID, "sender": {"id": 发送者ID, "name": 昵称},
+     "text": 纯文本, "chain": [消息组件, ...], "tok": token估算值}
+    消息组件以 {"t": 类型, ...字段} 表示，不认识的组件保留jsonpickle结构。
+    记录可编码为紧凑JSON文本，或在安装了msgpack时编码为二进制。
+    """
+
+    # 当前记录格式版本
+    VERSION = 1
+
+    @staticmethod
+    def msgpack_available() -> bool:
+        """是否安装了msgpack"""
+        return msgpack is not None
+
+    @staticmethod
+    def encode_component(component: BaseMessageComponent) -> Dict[str, Any]:
+        """将消息组件转换为紧凑结构"""
+        if isinstance(component, Plain):
+            return {"t": "plain", "text": component.text}
+        if isinstance(component, Image):
+            return {"t": "image", "file": component.file or "", "url": getattr(component, "url", "") or ""}
+        if isinstance(component, At):
+            return {"t": "at", "qq": component.qq, "name": getattr(component, "name", "") or ""}
+        if isinstance(component, Face):
+            return {"t": "face", "id": getattr(component, "id", "")}
+        if isinstance(component, Reply):
+            return {
+                "t": "reply",
+                "id": getattr(component, "id", ""),
+                "sender_id": getattr(component, "sender_id", ""),
+                "sender_nickname": getattr(component, "sender_nickname", "") or "",
+                "time": getattr(component, "time", 0) or 0,
+                "message_str": getattr(component, "message_str", "") or "",
+                "text": getattr(component, "text", "") or "",
+                "chain": [RecordCodec.encode_component(c) for c in (getattr(component, "chain", None) or [])],
+            }
+        if isinstance(component, Record):
+            return {"t": "record", "file": getattr(component, "file", "") or "", "url": getattr(component, "url", "") or ""}
+        if isinstance(component, Video):
+            return {"t": "video", "file": getattr(component, "file", "") or ""}
+        if isinstance(component, Json):
+            return {"t": "json", "data": getattr(component, "data", "")}
+        if isinstance(component, File):
+            return {"t": "file", "name": getattr(component, "name", "") or ""}
+
+        # 其他组件保留完整的jsonpickle结构
+        return {"t": "obj", "o": jsonpickle.Pickler(unpicklable=True).flatten(component)}
+
+    @staticmethod
+    def decode_component(data: Dict[str, Any]) -> BaseMessageComponent:
+        """将紧凑结构还原为消息组件"""
+        component_type = data.get("t")
+        try:
+            if component_type == "plain":
+                return Plain(text=data.get("text", ""))
+            if component_type == "image":
+                return Image(file=data.get("file", ""), url=data.get("url", ""))
+            if component_type == "at":
+                return At(qq=data.get("qq", ""), name=data.get("name", ""))
+            if component_type == "face":
+                return Face(id=data.get("id", ""))
+            if component_type == "reply":
+                return Reply(
+                    id=data.get("id", ""),
+                    chain=[RecordCodec.decode_component(c) for c in data.get("chain", [])],
+                    sender_id=data.get("sender_id", ""),
+                    sender_nickname=data.get("sender_nickname", ""),
+                    time=data.get("time", 0),
+                    message_str=data.get("message_str", ""),
+                    text=data.get("text", ""),
+                )
+            if component_type == "record":
+                return Record(file=data.get("file", ""), url=data.get("url", ""))
+            if component_type == "video":
+                return Video(file=data.get("file", ""))
+            if component_type == "json":
+                return Json(data=data.get("data", ""))
+            if component_type == "file":
+                return File(name=data.get("name", ""), file="")
+            if component_type == "obj":
+                return jsonpickle.Unpickler().restore(data.get("o"))
+        except Exception as e:
+            logger.warning(f"还原消息组件失败({component_type}): {e}")
+        return Plain(text=f"[{component_type}]")
+
+    @staticmethod
+    def to_record(message: AstrBotMessage) -> Dict[str, Any]:
+        """将AstrBotMessage转换为紧凑记录"""
+        sender = getattr(message, "sender", None)
+        message_type = getattr(message, "type", None)
+        record = {
+            "v": RecordCodec.VERSION,
+            "id": str(getattr(message, "message_id", "") or ""),
+            "ts": int(getattr(message, "timestamp", 0) or 0),
+            "type": getattr(message_type, "value", message_type),
+            "gid": str(getattr(message, "group_id", "") or ""),
+            "self": str(getattr(message, "self_id", "") or ""),
+            "sess": str(getattr(message, "session_id", "") or ""),
+            "sender": {
+                "id": str(getattr(sender, "user_id", "") or "") if sender else "",
+                "name": (getattr(sender, "nickname", "") or "") if sender else "",
+            },
+            "text": getattr(message, "message_str", "") or "",
+            "chain": [RecordCodec.encode_component(c) for c in (getattr(message, "message", None) or [])],
+        }
+        # token估算值为可选字段，旧记录没有该字段
+        tokens = getattr(message, "token_estimate", None)
+        if tokens is not None:
+            record["tok"] = tokens
+        return record
+
+    @staticmethod
+    def from_record(record: Dict[str, Any]) -> AstrBotMessage:
+        """将紧凑记录还原为AstrBotMessage"""
+        message = AstrBotMessage()
+        message.message_id = record.get("id", "")
+        message.timestamp = record.get("ts", 0)
+        try:
+            message.type = MessageType(record.get("type"))
+        except Exception:
+            message.type = MessageType.GROUP_MESSAGE if record.get("gid") else MessageType.FRIEND_MESSAGE
+        if record.get("gid"):
+            message.group_id = record["gid"]
+        message.self_id = record.get("self", "")
+        message.session_id = record.get("sess", "")
+        sender = record.get("sender") or {}
+        message.sender = MessageMember(user_id=sender.get("id", ""), nickname=sender.get("name", ""))
+        message.message_str = record.get("text", "")
+        message.message = [RecordCodec.decode_component(c) for c in record.get("chain", [])]
+        message.token_estimate = record.get("tok")
+        return message
+
+    @staticmethod
+    def dumps(message: AstrBotMessage, use_msgpack: bool = False) -> str | bytes:
+        """
+        编码消息
+
+        Args:
+            message: AstrBot消息对象
+            use_msgpack: 是否编码为msgpack二进制，未安装msgpack时回退为JSON
+
+        Returns:
+            紧凑JSON文本或msgpack二进制
+        """
+        record = RecordCodec.to_record(message)
+        if use_msgpack and msgpack is not None:
+            return msgpack.packb(record, use_bin_type=True)
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def loads(data: str | bytes) -> AstrBotMessage:
+        """
+        解码消息，兼容紧凑JSON、msgpack及旧版jsonpickle记录
+
+        Args:
+            data: 编码后的记录
+
+        Returns:
+            AstrBot消息对象
+        """
+        if isinstance(data, (bytes, bytearray)):
+            if msgpack is None:
+                raise RuntimeError("记录为msgpack格式，但未安装msgpack")
+            return RecordCodec.from_record(msgpack.unpackb(data, raw=False))
+        if RecordCodec.is_current(data):
+            return RecordCodec.from_record(json.loads(data))
+        # 旧版jsonpickle对象图
+        return jsonpickle.decode(data)
+
+    @staticmethod
+    def is_current(data: str | bytes) -> bool:
+        """判断记录是否已是当前的紧凑格式"""
+        if isinstance(data, (bytes, bytearray)):
+            return True
+        return data.startswith('{"v":')
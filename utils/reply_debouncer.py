@@ -0,0 +1,120 @@
+from astrbot.api.all import *
+from typing import Dict, Optional
+import asyncio
+import time
+
+
+class _ChatState:
+    """单个聊天的合并状态"""
+
+    __slots__ = ("generation", "burst_started", "in_progress", "idle")
+
+    def __init__(self):
+        # 每次触发加一，等待结束时不是最新一次触发的等待者放弃回复
+        self.generation = 0
+        # 当前这一波触发中第一次触发的时间
+        self.burst_started: Optional[float] = None
+        self.in_progress = False
+        # 没有进行中的回复时置位
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+
+class ReplyDebouncer:
+    """
+    回复合并工具类
+
+    同一聊天短时间内的多次触发合并为一次回复：每次触发后等待一段安静时间，
+    期间有新的触发则由最新的一次接替等待，较早的触发放弃回复；
+    从这一波的第一次触发起最多等待 max_delay 秒。
+    回复进行中到达的触发不再被丢弃，而是在回复结束后补一次回复，且最多只补一次。
+    最后发出的回复使用最新一条消息，历史记录中包含这期间的所有消息。
+    """
+
+    config: Optional[AstrBotConfig] = None
+    _chats: Dict[str, _ChatState] = {}
+
+    @staticmethod
+    def init(config: AstrBotConfig):
+        """保存配置"""
+        ReplyDebouncer.config = config
+        ReplyDebouncer._chats = {}
+
+    @staticmethod
+    def _get_config() -> dict:
+        """获取回复合并相关配置"""
+        if not ReplyDebouncer.config:
+            return {}
+        return ReplyDebouncer.config.get("reply_debounce", {})
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """是否启用回复合并"""
+        return bool(ReplyDebouncer._get_config().get("enable", False))
+
+    @staticmethod
+    def _get_state(chat_key: str) -> _ChatState:
+        """获取聊天的合并状态"""
+        state = ReplyDebouncer._chats.get(chat_key)
+        if state is None:
+            state = _ChatState()
+            ReplyDebouncer._chats[chat_key] = state
+        return state
+
+    @staticmethod
+    async def acquire(chat_key: str, debounce: bool = True) -> bool:
+        """
+        等待轮到本次触发回复
+
+        Args:
+            chat_key: 聊天标识
+            debounce: 是否等待安静时间，为False时只等待进行中的回复结束
+
+        Returns:
+            是否由本次触发发出回复，返回True后必须调用release
+        """
+        debounce_config = ReplyDebouncer._get_config()
+        quiet = max(0.0, float(debounce_config.get("quiet_seconds", 3)))
+        max_delay = max(quiet, float(debounce_config.get("max_delay_seconds", 10)))
+
+        state = ReplyDebouncer._get_state(chat_key)
+        state.generation += 1
+        generation = state.generation
+        if state.burst_started is None:
+            state.burst_started = time.time()
+
+        while True:
+            if state.in_progress:
+                # 回复进行中，结束后只由最新的触发补一次回复
+                await state.idle.wait()
+                if state.generation != generation:
+                    logger.debug(f"聊天 {chat_key} 有更新的触发，本次不再回复")
+                    return False
+                continue
+
+            if debounce:
+                wait = min(quiet, state.burst_started + max_delay - time.time())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                if state.generation != generation:
+                    logger.debug(f"聊天 {chat_key} 有更新的触发，本次不再回复")
+                    return False
+                if state.in_progress:
+                    continue
+
+            state.in_progress = True
+            state.idle.clear()
+            state.burst_started = None
+            return True
+
+    @staticmethod
+    def release(chat_key: str) -> None:
+        """回复结束，唤醒等待补回复的触发"""
+        state = ReplyDebouncer._chats.get(chat_key)
+        if state is None:
+            return
+        state.in_progress = False
+        state.idle.set()
+        if state.burst_started is None:
+            # 没有等待中的触发，释放聊天状态
+            ReplyDebouncer._chats.pop(chat_key, None)
@@ -3,6 +3,13 @@ from typing import Dict, Any, Optional
 import random
 import time
 from .llm_utils import LLMUtils
+from .chat_policy import ChatPolicy, ChatRule
+from .keyword_matcher import KeywordMatcher
+from .reply_debouncer import ReplyDebouncer
+from .llm_scheduler import LLMScheduler
+from .budget_tracker import BudgetTracker
+from .activity_tracker import ActivityTracker
+from .mention_detector import MentionDetector
 
 class ReplyDecision:
     """
@@ -28,8 +35,8 @@ class ReplyDecision:
             is_private_chat = event.is_private_chat()
             chat_id = event.get_sender_id() if is_private_chat else event.get_group_id()
             
-            # 检查是否已有大模型在处理
-            if LLMUtils.is_llm_in_progress(platform_name, is_private_chat, chat_id):
+            # 检查是否已有大模型在处理，启用回复合并时由 ReplyDebouncer 排队补回复
+            if not ReplyDebouncer.is_enabled() and LLMUtils.is_llm_in_progress(platform_name, is_private_chat, chat_id):
                 logger.debug(f"当前聊天已有大模型处理中，不进行回复")
                 return False
             
@@ -39,139 +46,123 @@ class ReplyDecision:
                 logger.debug(f"当前处于临时静默状态，不进行回复")
                 return False
                 
+            policy = ChatPolicy.current(config)
+            if not is_private_chat and not chat_id:
+                logger.debug("群聊ID为空，不进行回复")
+                return False
+            rule = policy.rule(is_private_chat, chat_id)
+
+            # 一次扫描同时检查触发关键词和黑名单关键词
+            keyword_hits = ReplyDecision._scan_keywords(event, rule)
+
             # 检查消息是否包含黑名单关键词
-            blacklist_keywords = config.get("model_frequency", {}).get("blacklist_keywords", [])
-            if blacklist_keywords and ReplyDecision._check_blacklist_keywords(event, blacklist_keywords):
+            if keyword_hits & KeywordMatcher.BLACKLIST:
                 logger.debug("消息中包含黑名单关键词，不进行回复")
                 return False
             
             # 检查配置中的回复规则
-            return ReplyDecision._check_reply_rules(event, config)
+            return ReplyDecision._check_reply_rules(event, policy, rule, keyword_hits)
         except Exception as e:
             logger.error(f"判断是否回复时发生错误: {e}")
             return False
     
     @staticmethod
-    def _check_reply_rules(event: AstrMessageEvent, config: AstrBotConfig) -> bool:
+    def _check_reply_rules(event: AstrMessageEvent, policy: ChatPolicy, rule: ChatRule, keyword_hits: int) -> bool:
         """
         检查回复规则
         
         Args:
             event: 消息事件
-            config: 配置对象
+            policy: 编译后的聊天策略
+            rule: 当前聊天的规则
+            keyword_hits: 关键词扫描结果
             
         Returns:
             是否应该回复
         """
-        # 检查是否是开启回复的群聊/私聊
-        if event.is_private_chat():
-            if not config.get("enabled_private", False):
-                logger.debug("未开启私聊回复功能")
-                return False
-        else:
-            group_id = event.get_group_id()
-            if not group_id:
-                logger.debug("群聊ID为空，不进行回复")
-                return False
-            group_id = str(group_id).strip()
+        is_private_chat = event.is_private_chat()
+        chat_id = event.get_sender_id() if is_private_chat else event.get_group_id()
 
-            # 获取配置集合并规范化类型 (O(1) 查找)
-            blocked_groups = {str(g).strip() for g in config.get("blocked_groups", []) if str(g).strip()}
-            enabled_groups = {str(g).strip() for g in config.get("enabled_groups", []) if str(g).strip()}
+        # 检查是否是开启回复的群聊/私聊（私聊开关，群聊黑名单 > 全局开关 > 白名单）
+        if not rule.enabled:
+            logger.debug(f"{'私聊' if is_private_chat else f'群聊{chat_id}'}未开启回复，不进行回复")
+            return False
 
-            # 1. 黑名单检查 - 最高优先级
-            if group_id in blocked_groups:
-                logger.debug(f"群聊{group_id}在黑名单中，不进行回复")
-                return False
+        # @机器人、回复机器人或提到机器人昵称的消息总是回复
+        if policy.directed_fast_path and MentionDetector.is_directed(event):
+            logger.debug(f"消息是对机器人说的（{MentionDetector.detect(event)}），触发回复")
+            return True
 
-            # 2. 全局开关检查
-            if config.get("enable_all_groups", False):
-                logger.debug(f"全局群聊回复已开启，允许回复群聊{group_id}")
-                # 继续执行下面的频率检查
-            elif group_id not in enabled_groups:
-                # 3. 白名单检查 (仅在全局开关关闭时)
-                logger.debug(f"群聊{group_id}未在白名单中，不进行回复")
-                return False
-            
-        # 获取消息频率配置
-        frequency_config = config.get("model_frequency", {})
         # 检查关键词触发
-        keywords = frequency_config.get("keywords", [])
-        if keywords and ReplyDecision._check_keywords(event, keywords):
+        if keyword_hits & KeywordMatcher.TRIGGER:
             logger.debug("消息中包含关键词，触发回复")
             return True
         
-        # 获取回复方法
-        method = frequency_config.get("method", "概率回复")
-        
         # 根据不同方法判断
-        if method == "概率回复":
-            prob_config = frequency_config.get("probability", {})
-            
-            # 私聊固定概率为1，群聊使用配置概率
-            if event.is_private_chat():
-                probability = 1.0  # 私聊总是回复
-                logger.debug("私聊消息，固定概率为1，总是回复")
-            else:
-                probability = prob_config.get("probability", 0.1)  # 群聊使用配置概率
-                logger.debug(f"群聊消息，使用配置概率: {probability}")
-            
-            # 使用概率计算是否回复
-            should_reply = random.random() < probability
-            if should_reply:
-                logger.debug(f"概率触发回复，当前概率: {probability}")
-            else:
-                logger.debug(f"概率回复未触发，当前概率: {probability}")
-            return should_reply
-        
-        # 为未来扩展预留接口
-        # 可以在这里添加更多回复方法的判断逻辑
-        
-        return False
+        chat_key = LLMUtils.get_chat_key(event.get_platform_name(), is_private_chat, chat_id)
+        if policy.method in ("概率回复", "令牌桶"):
+            # 私聊固定概率为1，群聊使用配置概率（可按群覆盖）
+            probability = rule.probability
+        elif policy.method == "自适应":
+            # 按群最近的消息速率计算概率，使每小时的期望回复次数接近目标，私聊固定为1；
+            # 重启后消息还不够时使用基础回复概率
+            probability = 1.0 if is_private_chat else ActivityTracker.probability(
+                chat_key, rule.probability, rule.target_per_hour, policy.adaptive_window,
+                policy.min_probability, policy.max_probability,
+            )
+        else:
+            # 为未来扩展预留接口
+            # 可以在这里添加更多回复方法的判断逻辑
+            return False
+
+        # 群当天的token用量超过预算后降低回复概率
+        probability *= BudgetTracker.probability_factor(chat_key, rule.daily_tokens, policy.exhausted_factor)
+        logger.debug(f"{'私聊' if is_private_chat else '群聊'}消息，回复方式: {policy.method}，回复概率: {probability}")
+
+        # 使用概率计算是否回复
+        if random.random() >= probability:
+            logger.debug(f"概率回复未触发，当前概率: {probability}")
+            return False
+        logger.debug(f"概率触发回复，当前概率: {probability}")
+
+        # 令牌桶方式下还要从该聊天和全局的令牌桶中各取一个令牌
+        if policy.method == "令牌桶" and not BudgetTracker.take_token(
+            chat_key, rule.per_minute, policy.global_per_minute
+        ):
+            logger.debug("令牌桶中没有令牌，不进行回复")
+            return False
+        return True
     
     @staticmethod
-    def _check_keywords(event: AstrMessageEvent, keywords: list) -> bool:
+    def _scan_keywords(event: AstrMessageEvent, rule: ChatRule) -> int:
         """
-        检查消息是否包含关键词
+        扫描消息中的触发关键词和黑名单关键词
         
         Args:
             event: 消息事件
-            keywords: 关键词列表
+            rule: 当前聊天的规则
             
         Returns:
-            是否包含关键词
+            命中的关键词类别（KeywordMatcher.TRIGGER / KeywordMatcher.BLACKLIST 的按位或）
         """
-        # 获取消息文本
-        message_text = event.get_message_outline()
-        
-        # 检查是否包含关键词
-        for keyword in keywords:
-            if keyword in message_text:
-                return True
-                
-        return False
-        
+        if not rule.matcher:
+            return 0
+        return rule.matcher.scan(event.get_message_outline())
+
     @staticmethod
-    def _check_blacklist_keywords(event: AstrMessageEvent, blacklist_keywords: list) -> bool:
+    def _get_lane(event: AstrMessageEvent) -> int:
         """
-        检查消息是否包含黑名单关键词
+        获取调度通道，私聊和对机器人说的消息（@机器人、回复机器人等）走优先通道
         
         Args:
             event: 消息事件
-            blacklist_keywords: 黑名单关键词列表
             
         Returns:
-            是否包含黑名单关键词
+            LLMScheduler.LANE_PRIORITY 或 LLMScheduler.LANE_NORMAL
         """
-        # 获取消息文本
-        message_text = event.get_message_outline()
-        
-        # 检查是否包含黑名单关键词
-        for keyword in blacklist_keywords:
-            if keyword in message_text:
-                return True
-                
-        return False
+        if event.is_private_chat() or MentionDetector.is_directed(event):
+            return LLMScheduler.LANE_PRIORITY
+        return LLMScheduler.LANE_NORMAL
 
     @staticmethod
     async def process_and_reply(event: AstrMessageEvent, config: AstrBotConfig, context: Context):
@@ -191,12 +182,31 @@ class ReplyDecision:
         is_private = event.is_private_chat()
         chat_id = event.get_sender_id() if is_private else event.get_group_id()
 
-        # 标记开始处理
+        # 对机器人说的消息走快速通道：不等待合并的安静时间，使用较小的聊天记录窗口
+        directed = ChatPolicy.current(config).directed_fast_path and MentionDetector.is_directed(event)
+
+        # 启用回复合并时等待一段安静时间，期间的后续触发合并为一次回复
+        debounced = ReplyDebouncer.is_enabled()
+        chat_key = LLMUtils.get_chat_key(platform_name, is_private, chat_id)
+        if debounced and not await ReplyDebouncer.acquire(chat_key, debounce=not directed):
+            return
+
+        # 标记开始处理，排队等待调用名额期间也视为处理中，同一聊天的后续触发不会再排队
         LLMUtils.set_llm_in_progress(platform_name, is_private, chat_id)
 
+        granted = False
         try:
+            # 等待全局调用名额，排队过久的触发放弃回复
+            granted = await LLMScheduler.acquire(chat_key, ReplyDecision._get_lane(event))
+            if not granted:
+                return
+
             # 调用大模型并发送回复
-            yield await LLMUtils.call_llm(event, config, context)
+            yield await LLMUtils.call_llm(event, config, context, directed=directed)
         finally:
             # 标记处理完成
             LLMUtils.set_llm_in_progress(platform_name, is_private, chat_id, False)
+            if granted:
+                LLMScheduler.release()
+            if debounced:
+                ReplyDebouncer.release(chat_key)
@@ -0,0 +1,93 @@
+from astrbot.api.all import *
+from typing import Optional
+import re
+from .message_utils import MessageUtils
+
+
+class TokenEstimator:
+    """
+    token数估算工具类
+
+    不依赖具体模型的分词器，按字符粗略估算：中日韩字符每个约1个token，
+    其他字符约4个字符1个token。每条历史消息的估算值在保存时计算一次，
+    随记录一起保存在 "tok" 字段中。
+    """
+
+    # 中日韩文字、假名、谚文和全角标点
+    _CJK_PATTERN = re.compile(
+        r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+    )
+    # 其他字符每个token对应的字符数
+    CHARS_PER_TOKEN = 4
+    # 一条图片描述大约占用的token数
+    IMAGE_CAPTION_TOKENS = 48
+    # 消息头（发送者、时间）中除昵称和ID外的固定部分
+    _HEADER_TEXT = "发送者:  (ID: )\n时间: 0000-00-00 00:00:00\n内容: "
+
+    @staticmethod
+    def estimate_text(text: str) -> int:
+        """估算一段文本的token数"""
+        if not text:
+            return 0
+        cjk = len(TokenEstimator._CJK_PATTERN.findall(text))
+        other = len(text) - cjk
+        return cjk + -(-other // TokenEstimator.CHARS_PER_TOKEN)
+
+    @staticmethod
+    def estimate_message(message: AstrBotMessage) -> int:
+        """
+        估算一条历史消息放入上下文后的token数，图片按转述后的描述估算
+
+        Args:
+            message: 历史消息
+
+        Returns:
+            估算的token数
+        """
+        sender = getattr(message, "sender", None)
+        header = TokenEstimator._HEADER_TEXT
+        if sender:
+            header += f"{getattr(sender, 'nickname', '') or ''}{getattr(sender, 'user_id', '') or ''}"
+        parts = MessageUtils.build_outline(message.message) if getattr(message, "message", None) else []
+        content = MessageUtils.render_outline(parts, {})
+        images = len(MessageUtils.template_images(parts))
+        return (
+            TokenEstimator.estimate_text(header)
+            + TokenEstimator.estimate_text(content)
+            + images * TokenEstimator.IMAGE_CAPTION_TOKENS
+        )
+
+    @staticmethod
+    def get(message: AstrBotMessage) -> int:
+        """
+        获取历史消息的token估算值，旧版记录没有保存估算值时现场计算并记在消息对象上
+
+        Args:
+            message: 历史消息
+
+        Returns:
+            估算的token数
+        """
+        tokens: Optional[int] = getattr(message, "token_estimate", None)
+        if tokens is None:
+            tokens = TokenEstimator.estimate_message(message)
+            message.token_estimate = tokens
+        return tokens
+
+    @staticmethod
+    def truncate(text: str, tokens: int, max_tokens: int) -> str:
+        """
+        按比例截断超出token上限的文本
+
+        Args:
+            text: 渲染后的消息文本
+            tokens: 文本的token估算值
+            max_tokens: token上限
+
+        Returns:
+            未超出上限时原样返回，否则保留开头按比例计算的长度
+        """
+        if tokens <= max_tokens or tokens <= 0:
+            return text
+        keep = max(1, len(text) * max_tokens // tokens)
+        return text[:keep] + "...(消息过长，已截断)"